@@ -10,3 +10,17 @@ MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "procurement_db")
 
 if not MONGO_URI:
     raise RuntimeError("MONGO_URI is not set. Add it to backend/.env")
+
+# Pool for the synchronous client used by background workers
+MONGO_SYNC_MAX_POOL_SIZE = int(os.getenv("MONGO_SYNC_MAX_POOL_SIZE", "20"))
+MONGO_SYNC_MIN_POOL_SIZE = int(os.getenv("MONGO_SYNC_MIN_POOL_SIZE", "1"))
+
+# ── Room analysis ──────────────────────────────────────────────────────────────
+# Preprocessing, analysis-result and SAM-embedding caches. Keep this outside
+# local_file_db, which is served as static files.
+ANALYSIS_CACHE_ROOT = os.getenv("ANALYSIS_CACHE_ROOT", os.path.join(os.path.dirname(__file__), "_cache"))
+# Long-side limit for SAM input; larger room images are segmented downscaled
+# and the masks upsampled (0 = always run at native resolution)
+SAM_MAX_SIDE = int(os.getenv("SAM_MAX_SIDE", "1536"))
+# Speculatively embed newly selected diagrams / extracted rooms (0 = off)
+SAM_PREWARM = int(os.getenv("SAM_PREWARM", "1"))
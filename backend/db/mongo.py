@@ -1,9 +1,15 @@
+import threading
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGO_URI, MONGO_DB_NAME
+from pymongo import MongoClient, monitoring
+from config import MONGO_URI, MONGO_DB_NAME, MONGO_SYNC_MAX_POOL_SIZE, MONGO_SYNC_MIN_POOL_SIZE
 
 # Single shared client (created once at startup)
 _client: AsyncIOMotorClient | None = None
 
+# Shared synchronous client for background workers (threadpool tasks)
+_sync_client: MongoClient | None = None
+_sync_client_lock = threading.Lock()
+
 
 def get_client() -> AsyncIOMotorClient:
     global _client
@@ -34,3 +40,92 @@ def get_diagrams_collection():
 
 def get_rooms_collection():
     return get_db()["rooms"]
+
+
+# ── Synchronous client for background workers ─────────────────────────────────
+class _PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so reuse is visible in /health."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.checkout_failures = 0
+            self.pool_clears = 0
+
+    def _bump(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+    def pool_cleared(self, event): self._bump("pool_clears")
+    def connection_created(self, event): self._bump("connections_created")
+    def connection_closed(self, event): self._bump("connections_closed")
+    def connection_checked_out(self, event): self._bump("checkouts")
+    def connection_checked_in(self, event): self._bump("checkins")
+    def connection_check_out_failed(self, event): self._bump("checkout_failures")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connections_open": self.connections_created - self.connections_closed,
+                "connections_in_use": self.checkouts - self.checkins,
+                "connections_created_total": self.connections_created,
+                "checkouts_total": self.checkouts,
+                "checkout_failures_total": self.checkout_failures,
+                "pool_clears_total": self.pool_clears,
+            }
+
+
+_sync_pool_metrics = _PoolMetrics()
+
+
+def get_sync_client() -> MongoClient:
+    """
+    Process-wide pooled pymongo client. Background workers share it instead of
+    opening (and paying TCP/TLS + server discovery for) a client per update.
+    """
+    global _sync_client
+    if _sync_client is None:
+        with _sync_client_lock:
+            if _sync_client is None:
+                _sync_client = MongoClient(
+                    MONGO_URI,
+                    maxPoolSize=MONGO_SYNC_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_SYNC_MIN_POOL_SIZE,
+                    event_listeners=[_sync_pool_metrics],
+                )
+    return _sync_client
+
+
+def get_sync_db():
+    return get_sync_client()[MONGO_DB_NAME]
+
+
+def close_sync_client():
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+            _sync_pool_metrics.reset()
+
+
+def get_sync_pool_stats() -> dict:
+    return {
+        "active": _sync_client is not None,
+        "max_pool_size": MONGO_SYNC_MAX_POOL_SIZE,
+        "min_pool_size": MONGO_SYNC_MIN_POOL_SIZE,
+        **_sync_pool_metrics.snapshot(),
+    }
@@ -9,7 +9,7 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 
 from db.database import engine, Base, SessionLocal
-from db.mongo import get_client
+from db.mongo import get_client, get_sync_client, close_sync_client, get_sync_pool_stats
 from models import sql_models  # Initialize metadata
 from middlewares.cors import add_cors_middleware
 from services.pdf_processing import load_yolo_model, LOCAL_FILE_DB
@@ -65,6 +65,9 @@ async def lifespan(app: FastAPI):
         print("[MongoDB] ✅ Connected to Atlas")
     except Exception as e:
         print(f"[MongoDB] ⚠️  Could not connect: {e}")
+
+    # Pooled sync client shared by background workers (PDF processing, room analysis)
+    get_sync_client()
         
     yield
     
@@ -73,6 +76,8 @@ async def lifespan(app: FastAPI):
     if client:
         client.close()
         print("[MongoDB] 🔌 Connection closed")
+    close_sync_client()
+    print("[MongoDB] 🔌 Worker connection pool closed")
 
 app = FastAPI(title="Procurement and Co. API", version="2.0.0", lifespan=lifespan)
 
@@ -102,4 +107,5 @@ def health():
         "service": "Procurement and Co. API v2",
         "yolo_ready": yolo_status["model_loaded"],
         "yolo_error": yolo_status["error"],
+        "mongo_sync_pool": get_sync_pool_stats(),
     }
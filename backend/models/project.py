@@ -50,6 +50,15 @@ class ProjectUpdate(BaseModel):
     status:                     Optional[str]  = None   # "draft"|"active"|"archived"
 
 
+# ── Request body: regroup a room's masks ──────────────────────────────────────
+class RoomRegroupRequest(BaseModel):
+    # Omitted tolerances keep the grouping defaults (see grouping_engine.is_similar)
+    area_tol:                   Optional[float] = Field(None, ge=0, lt=1)
+    size_tol:                   Optional[float] = Field(None, ge=0, lt=1)
+    shape_tol:                  Optional[float] = Field(None, ge=0)
+    vertex_tol:                 Optional[int]   = Field(None, ge=0)
+
+
 # ── Response model ─────────────────────────────────────────────────────────────
 class ProjectOut(BaseModel):
     id:                         str            = Field(alias="_id")
@@ -10,6 +10,7 @@ from schemas.budget import JobOut
 from services.pdf_processing import run_processing, LOCAL_FILE_DB, get_yolo_status
 from routes.pdf import UPLOAD_DIR
 from db.mongo import get_diagrams_collection, get_pages_collection
+from services import sam_prewarm
 from bson import ObjectId
 
 router = APIRouter(prefix="/floorplan", tags=["Floorplan"])
@@ -149,6 +150,9 @@ async def save_selected_images(job_id: int, body: dict, db: Session = Depends(ge
     with open(meta_path, "w") as f:
         json.dump(metadata, f, indent=2)
 
+    # Selected diagrams are the ones analysed next: embed them while the user moves on
+    sam_prewarm.schedule([img["original_path"] for img in result_images])
+
     return metadata
 
 @router.get("/jobs")
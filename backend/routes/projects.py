@@ -4,10 +4,16 @@ routes/projects.py
 All /projects/* REST endpoints, backed by MongoDB via the project service.
 """
 
-from fastapi import APIRouter, HTTPException, File, Form, UploadFile, Depends, BackgroundTasks
-from models.project import ProjectCreate, ProjectOut, ProjectUpdate
+from fastapi import APIRouter, HTTPException, File, Form, UploadFile, Depends, BackgroundTasks, Request, Query
+from models.project import ProjectCreate, ProjectOut, ProjectUpdate, RoomRegroupRequest
 from services import project_service
-from services.room_analysis_orchestrator import run_room_analysis_pipeline
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from services import analysis_events, sam_prewarm
+from services.room_analysis_orchestrator import run_room_analysis_pipeline, run_diagram_analysis_pipeline, get_debug_overlay_path, get_room_analysis_dir, regroup_room, get_room_merge_tree, cut_room_merge_tree, get_room_label_map_path, get_room_label_map_url
+from services.room_analysis.polygon_codec import pick_polygon_variant, pick_lod_level, ensure_polygon_lod
+from services.room_analysis.mask_edit_log import compact_room_masks, get_room_masks_version
+from services.room_analysis.symbol_index import find_similar_symbols
 import os, json, shutil
 from datetime import datetime
 from services.project_service import LOCAL_FILE_DB
@@ -422,6 +428,9 @@ async def extract_rooms(project_id: str, body: dict):
                 {"_id": diagram["_id"]},
                 {"$addToSet": {"rooms": {"$each": room_ids}}}
             )
+
+    # Extracted rooms are the next to be analysed: embed them speculatively
+    sam_prewarm.schedule([res["saved_path"] for res in results])
         
     return {"ok": True, "rooms": results}
 
@@ -485,9 +494,11 @@ async def delete_room(project_id: str, room_id: str, image_filename: str):
 
 # ── Room Analysis Orchestration ───────────────────────────────────────────────
 @router.post("/{project_id}/rooms/{room_id}/analyze")
-async def analyze_room(project_id: str, room_id: str, background_tasks: BackgroundTasks):
+async def analyze_room(project_id: str, room_id: str, background_tasks: BackgroundTasks, force: bool = False):
     """
     Trigger the background SAM mask generation pipeline for a specific room.
+    A room image analysed before (same model and parameters) reuses the
+    cached result; pass `force=true` to run SAM again.
     """
     rooms_coll = get_rooms_collection()
     # Check if Room exists
@@ -496,12 +507,16 @@ async def analyze_room(project_id: str, room_id: str, background_tasks: Backgrou
     if not room_doc:
         raise HTTPException(status_code=404, detail="Room not found in this project.")
         
+    # Open the live event stream before the job can publish anything
+    analysis_events.open_channel(str(room_doc["_id"]))
+
     # Queue the background process
     background_tasks.add_task(
         run_room_analysis_pipeline, 
         room_id=str(room_doc["_id"]), 
         project_id=project_id, 
-        room_image_url=room_doc.get("room_image_url", "")
+        room_image_url=room_doc.get("room_image_url", ""),
+        force=force
     )
     
     # Initialize state
@@ -517,6 +532,90 @@ async def analyze_room(project_id: str, room_id: str, background_tasks: Backgrou
     return {"ok": True, "message": "Room analysis started in the background."}
 
 
+@router.post("/{project_id}/rooms/{room_id}/regroup")
+async def regroup_room_masks(project_id: str, room_id: str, body: RoomRegroupRequest):
+    """
+    Re-run grouping and polygon combination on the room's stored masks with
+    custom similarity tolerances, without touching the SAM model. Manual
+    mask edits are replaced by the new result.
+    """
+    tolerances = body.model_dump(exclude_none=True)
+    result = await run_in_threadpool(regroup_room, project_id, room_id, tolerances)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No stored masks for this room; run the analysis first.")
+    return {"ok": True, **result}
+
+
+@router.get("/{project_id}/rooms/{room_id}/merge-tree")
+async def get_room_grouping_tree(project_id: str, room_id: str):
+    """
+    Precomputed single-linkage merge tree of the room's masks. Edges are
+    sorted by weight; the groups at strictness t are the connected components
+    of the edges with weight <= t (1.0 = default grouping tolerances), so a
+    slider can regroup client-side.
+    """
+    tree = await run_in_threadpool(get_room_merge_tree, project_id, room_id)
+    if tree is None:
+        raise HTTPException(status_code=404, detail="No stored masks for this room; run the analysis first.")
+
+    n, edges, weights, max_threshold, mask_ids = tree
+    return {
+        "mask_count": n,
+        # Masks left out of grouping (no polygons) are not nodes of the tree
+        "mask_ids": mask_ids.tolist(),
+        "max_threshold": max_threshold,
+        "edges": edges.tolist(),
+        "weights": weights.tolist()
+    }
+
+
+@router.get("/{project_id}/rooms/{room_id}/groups-at")
+async def get_room_groups_at_threshold(project_id: str, room_id: str, threshold: float = Query(1.0, ge=0)):
+    """
+    Cut the room's merge tree at grouping strictness `threshold` and return
+    the resulting groups as lists of mask ids. Nothing is recomputed or saved.
+    """
+    groups = await run_in_threadpool(cut_room_merge_tree, project_id, room_id, threshold)
+    if groups is None:
+        raise HTTPException(status_code=404, detail="No stored masks for this room; run the analysis first.")
+    return {"threshold": threshold, "groups": groups}
+
+
+@router.post("/{project_id}/diagrams/{diagram_id}/rooms/analyze")
+async def analyze_diagram_rooms(project_id: str, diagram_id: str, background_tasks: BackgroundTasks):
+    """
+    Batch mode: run SAM once over the whole diagram and split the masks
+    across every extracted room of that diagram in a single job.
+    """
+    rooms_coll = get_rooms_collection()
+    room_docs = await rooms_coll.find({"diagram": ObjectId(diagram_id), "project": ObjectId(project_id)}).to_list(length=None)
+
+    if not room_docs:
+        raise HTTPException(status_code=404, detail="No rooms found for this diagram.")
+
+    room_ids = [str(r["_id"]) for r in room_docs]
+    for room_id in room_ids:
+        analysis_events.open_channel(room_id)
+
+    background_tasks.add_task(
+        run_diagram_analysis_pipeline,
+        diagram_id=diagram_id,
+        project_id=project_id,
+        room_ids=room_ids
+    )
+
+    await rooms_coll.update_many(
+        {"_id": {"$in": [r["_id"] for r in room_docs]}},
+        {"$set": {
+            "analysis_status": "pending",
+            "analysis_progress": 0,
+            "analysis_message": "Queued for diagram-level processing..."
+        }}
+    )
+
+    return {"ok": True, "message": "Diagram analysis started in the background.", "room_ids": room_ids}
+
+
 @router.get("/{project_id}/rooms/{room_id}/analysis-status")
 async def get_room_analysis_status(project_id: str, room_id: str):
     """
@@ -527,7 +626,15 @@ async def get_room_analysis_status(project_id: str, room_id: str):
     
     if not room_doc:
         raise HTTPException(status_code=404, detail="Room not found.")
-        
+
+    label_map_url = room_doc.get("masks_label_map_url", "")
+    if label_map_url and room_doc.get("analysis_status") == "completed":
+        # Versioned so the editor refetches the picking texture after edits or re-analysis
+        json_path = os.path.join(get_room_analysis_dir(project_id, room_id), "masks_polygons.json")
+        if os.path.exists(json_path):
+            version = await run_in_threadpool(get_room_masks_version, json_path)
+            label_map_url = get_room_label_map_url(project_id, room_id, version)
+
     return {
         "ok": True,
         "status": room_doc.get("analysis_status", "idle"),
@@ -535,5 +642,141 @@ async def get_room_analysis_status(project_id: str, room_id: str):
         "message": room_doc.get("analysis_message", ""),
         "masks_polygons_url": room_doc.get("masks_polygons_url", ""),
         "masks_groups_url": room_doc.get("masks_groups_url", ""),
+        "masks_store_url": room_doc.get("masks_store_url", ""),
+        "masks_label_map_url": label_map_url,
+        # Rooms analysed before the mask store existed only have the pickle
         "masks_pkl_url": room_doc.get("masks_pkl_url", "")
     }
+
+
+@router.get("/{project_id}/rooms/{room_id}/debug-overlay")
+async def get_room_debug_overlay(project_id: str, room_id: str):
+    """
+    Mask debug overlay for a room's analysis. Rendered on the first request
+    and cached next to the other analysis artifacts.
+    """
+    overlay_path = await run_in_threadpool(get_debug_overlay_path, project_id, room_id)
+    if not overlay_path:
+        raise HTTPException(status_code=404, detail="No analysis masks found for this room.")
+    return FileResponse(overlay_path, media_type="image/png")
+
+
+@router.get("/{project_id}/rooms/{room_id}/masks-polygons")
+async def get_room_masks_polygons(project_id: str, room_id: str, request: Request, scale: float = Query(None, gt=0)):
+    """
+    masks_polygons.json with content negotiation:
+    Accept: application/x-masks-polygons selects the compact binary layout,
+    Accept-Encoding: br / gzip serves the pre-compressed sibling.
+    `scale` (screen pixels per image pixel) selects the coarsest level of
+    detail that still looks exact at that zoom; omitted = full detail.
+    """
+    json_path = os.path.join(get_room_analysis_dir(project_id, room_id), "masks_polygons.json")
+    # Fold any logged PATCH edits into the snapshot so every variant is current
+    await run_in_threadpool(compact_room_masks, json_path)
+
+    level = pick_lod_level(scale) if scale else 0
+    level_path = await run_in_threadpool(ensure_polygon_lod, json_path, level)
+    variant = level_path and pick_polygon_variant(
+        level_path,
+        accept=request.headers.get("accept", ""),
+        accept_encoding=request.headers.get("accept-encoding", "")
+    )
+    if not variant:
+        raise HTTPException(status_code=404, detail="No analysis polygons found for this room.")
+
+    path, media_type, encoding = variant
+    headers = {"Vary": "Accept, Accept-Encoding", "X-Polygon-LOD": str(level)}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@router.get("/{project_id}/rooms/{room_id}/label-map")
+async def get_room_label_map(project_id: str, room_id: str, rev: str = Query(None)):
+    """
+    Picking texture for the editor: an RGB PNG where each pixel holds
+    mask id + 1 (R + G * 256 + B * 65536; 0 = background), smaller masks on
+    top. Re-rendered from the current polygons after manual edits.
+    With `rev` set to the current masks version (as in the analysis-status
+    URL) the response may be cached for good; otherwise it is revalidated.
+    """
+    json_path = os.path.join(get_room_analysis_dir(project_id, room_id), "masks_polygons.json")
+    # Checked before rendering: a concurrent edit can only make the file newer than `rev`
+    current = rev is not None and os.path.exists(json_path) and rev == await run_in_threadpool(get_room_masks_version, json_path)
+
+    label_map_path = await run_in_threadpool(get_room_label_map_path, project_id, room_id)
+    if not label_map_path:
+        raise HTTPException(status_code=404, detail="No analysis polygons found for this room.")
+
+    headers = {"Cache-Control": "public, max-age=31536000, immutable" if current else "no-cache"}
+    return FileResponse(label_map_path, media_type="image/png", headers=headers)
+
+
+@router.get("/{project_id}/rooms/{room_id}/analysis-stream")
+async def stream_room_analysis(project_id: str, room_id: str):
+    """
+    Server-Sent Events stream of a running analysis: `status` events for every
+    progress update, `polygons` events with mask chunks as they are produced
+    (group_id still null), then `groups`, whose mask_indices give each mask's group. The stream ends on completion or error.
+    A client joining late gets the latest status / groups and, instead of the
+    chunks it missed, `polygons_skipped` ({"count"}): it loads masks_polygons
+    once the analysis completes. Without a running analysis, the current
+    status is sent once.
+    """
+    rooms_coll = get_rooms_collection()
+    room_doc = await rooms_coll.find_one({"_id": ObjectId(room_id) if len(room_id) == 24 else room_id, "project": ObjectId(project_id)})
+
+    if not room_doc:
+        raise HTTPException(status_code=404, detail="Room not found.")
+
+    channel = analysis_events.get_channel(str(room_doc["_id"]))
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    async def event_source():
+        if channel is None:
+            yield sse("status", {
+                "status": room_doc.get("analysis_status", "idle"),
+                "progress": room_doc.get("analysis_progress", 0),
+                "message": room_doc.get("analysis_message", ""),
+                "masks_polygons_url": room_doc.get("masks_polygons_url", ""),
+                "masks_groups_url": room_doc.get("masks_groups_url", "")
+            })
+            return
+
+        async for event, data in channel.subscribe():
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield sse(event, data)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/{project_id}/rooms/{room_id}/masks/{mask_id}/similar")
+async def find_similar_masks(
+    project_id: str,
+    room_id: str,
+    mask_id: int,
+    limit: int = Query(200, ge=1, le=5000),
+    area_tol: float = Query(0.08, ge=0, lt=1),
+    size_tol: float = Query(0.20, ge=0, lt=1),
+    shape_tol: float = Query(0.04, ge=0),
+    vertex_tol: int = Query(2, ge=0)
+):
+    """
+    Every mask in the project (any room, any diagram) with the same shape as
+    `mask_id` of `room_id`, using the room grouping rules. Backed by a
+    project-level descriptor index that is refreshed for rooms analysed or
+    regrouped since the last query.
+    """
+    tolerances = {"area_tol": area_tol, "size_tol": size_tol, "shape_tol": shape_tol, "vertex_tol": vertex_tol}
+    result = await run_in_threadpool(find_similar_symbols, project_id, room_id, mask_id, tolerances, limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Mask not found in the project's symbol index.")
+    return result
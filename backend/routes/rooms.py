@@ -1,7 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from db.mongo import get_rooms_collection
 from bson import ObjectId
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+import math
+import os
+from services.room_analysis_orchestrator import get_room_analysis_dir
+from services.room_analysis.mask_edit_log import (
+    get_room_masks,
+    apply_room_mask_edits,
+    replace_room_masks,
+    MaskEditConflict,
+    MaskEditError,
+)
+from services.room_analysis.similarity_graph import regroup_room_masks
+from services.room_analysis.spatial_index import hit_test, query_viewport
+from services.room_analysis.template_matcher import add_template_matches, MAX_MATCHES_LIMIT
 
 class RoomCreate(BaseModel):
     name: str
@@ -59,35 +73,188 @@ class MasksUpdate(BaseModel):
     masks: list
     groups: dict
 
-@router.put("/{room_id}/masks")
-async def update_room_masks(room_id: str, body: MasksUpdate):
+class MasksPatch(BaseModel):
+    base_revision: int
+    base_analysis_id: str | None = None
+    ops: list[dict]
+
+class TemplateMatchRequest(BaseModel):
+    base_revision: int
+    base_analysis_id: str | None = None
+    threshold: float = Field(0.8, gt=0, le=1)
+    scales: list[float] = Field([0.9, 1.0, 1.1], max_length=8)
+    rotations: list[int] = Field([0, 90, 180, 270], max_length=4)
+    max_matches: int = Field(500, ge=1, le=MAX_MATCHES_LIMIT)
+
+class MasksRegroup(BaseModel):
+    base_revision: int
+    base_analysis_id: str | None = None
+    changed_mask_ids: list[int] = []
+
+async def _masks_polygons_path(room_id: str, create: bool = False) -> str:
     """
-    Overwrites the masks_polygons.json file for a given room.
+    Path of the room's masks_polygons.json. The analysis folder is only
+    created for writes (`create`); otherwise a missing one is a 404.
     """
-    import os, json
-    from services.project_service import LOCAL_FILE_DB
-
     room_doc = await get_room(room_id)
     project_id = room_doc.get("project")
-    
+
     if not project_id:
         raise HTTPException(status_code=400, detail="Room does not have a valid project ID.")
 
     # Construct the path to where the masks_polygons.json is stored
-    room_output_dir = os.path.join(LOCAL_FILE_DB, f"project_{project_id}", "rooms", str(room_id), "analysis")
-    masks_polygons_json_path = os.path.join(room_output_dir, "masks_polygons.json")
-
-    if not os.path.exists(room_output_dir):
+    room_output_dir = get_room_analysis_dir(project_id, room_id)
+    if create:
         os.makedirs(room_output_dir, exist_ok=True)
+    elif not os.path.isdir(room_output_dir):
+        raise HTTPException(status_code=404, detail="No analysis found for this room.")
+    return os.path.join(room_output_dir, "masks_polygons.json")
 
-    data_to_save = {
-        "groups": body.groups,
-        "masks": body.masks
-    }
+def _revision_conflict(e: MaskEditConflict) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={
+            "message": str(e),
+            "current_revision": e.current_revision,
+            "current_analysis_id": e.current_analysis_id
+        }
+    )
+
+@router.get("/{room_id}/masks")
+async def get_room_masks_state(room_id: str):
+    """
+    Current masks and groups including edits not yet compacted into
+    masks_polygons.json, with the revision to send back on PATCH.
+    """
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+    return await run_in_threadpool(get_room_masks, masks_polygons_json_path)
+
+@router.put("/{room_id}/masks")
+async def update_room_masks(room_id: str, body: MasksUpdate):
+    """
+    Overwrites the masks_polygons.json file for a given room.
+    """
+    masks_polygons_json_path = await _masks_polygons_path(room_id, create=True)
 
     try:
-        with open(masks_polygons_json_path, 'w') as f:
-            json.dump(data_to_save, f, indent=4)
-        return {"ok": True, "message": "Masks and groups successfully persisted."}
+        # Keeps the binary / pre-compressed siblings in step and resets the edit log
+        revision = await run_in_threadpool(replace_room_masks, masks_polygons_json_path, body.groups, body.masks)
+        return {"ok": True, "message": "Masks and groups successfully persisted.", "revision": revision}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write file: {e}")
+
+@router.patch("/{room_id}/masks")
+async def patch_room_masks(room_id: str, body: MasksPatch):
+    """
+    Incremental edit: apply add/delete/update mask, regroup and group
+    operations on top of `base_revision` (of analysis `base_analysis_id`).
+    Returns 409 if the masks changed since that revision.
+    """
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+
+    try:
+        revision = await run_in_threadpool(
+            apply_room_mask_edits, masks_polygons_json_path, body.base_revision, body.ops,
+            base_analysis_id=body.base_analysis_id
+        )
+    except MaskEditConflict as e:
+        raise _revision_conflict(e)
+    except MaskEditError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"ok": True, "revision": revision}
+
+@router.post("/{room_id}/masks/regroup")
+async def regroup_room_masks_endpoint(room_id: str, body: MasksRegroup):
+    """
+    Incremental regroup after manual edits: only masks that were added,
+    deleted or listed in `changed_mask_ids` (redrawn) are re-compared, and
+    only the groups they touch are rebuilt. The resulting group changes are
+    recorded as a normal edit and returned with the new revision.
+    """
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+
+    try:
+        revision, ops = await run_in_threadpool(
+            regroup_room_masks, masks_polygons_json_path, body.base_revision, body.changed_mask_ids,
+            body.base_analysis_id
+        )
+    except MaskEditConflict as e:
+        raise _revision_conflict(e)
+    except MaskEditError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"ok": True, "revision": revision, "ops": ops}
+
+@router.get("/{room_id}/masks/hit")
+async def hit_test_room_masks(room_id: str, x: float, y: float):
+    """
+    Masks containing the point (x, y) in image coordinates, smallest
+    (most specific) first.
+    """
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise HTTPException(status_code=400, detail="Coordinates must be finite.")
+
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+    return await run_in_threadpool(hit_test, masks_polygons_json_path, x, y)
+
+@router.get("/{room_id}/masks/viewport")
+async def get_room_masks_in_viewport(
+    room_id: str,
+    x0: float,
+    y0: float,
+    x1: float,
+    y1: float,
+    zoom: float = Query(1.0, gt=0),
+    min_screen_size: float = Query(2.0, ge=0)
+):
+    """
+    Masks whose bounds intersect the viewport rect (image coordinates).
+    Masks that would be smaller than `min_screen_size` screen pixels at
+    `zoom` are left out.
+    """
+    if not all(math.isfinite(v) for v in (x0, y0, x1, y1)):
+        raise HTTPException(status_code=400, detail="Viewport coordinates must be finite.")
+    if x1 < x0 or y1 < y0:
+        raise HTTPException(status_code=400, detail="Viewport must have x0 <= x1 and y0 <= y1.")
+
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+    return await run_in_threadpool(
+        query_viewport, masks_polygons_json_path, x0, y0, x1, y1, zoom, min_screen_size
+    )
+
+@router.post("/{room_id}/masks/{mask_id}/find-instances")
+async def find_mask_instances(room_id: str, mask_id: int, body: TemplateMatchRequest):
+    """
+    Use `mask_id` as a template and search the room image for further
+    instances (normalised cross-correlation at the requested scales and
+    right-angle rotations). Matches are added as new masks in the exemplar's
+    group, as one edit on top of `base_revision`.
+    """
+    if any(r % 90 for r in body.rotations):
+        raise HTTPException(status_code=400, detail="Rotations must be multiples of 90 degrees.")
+    if not body.scales or any(s <= 0 for s in body.scales):
+        raise HTTPException(status_code=400, detail="Scales must be positive.")
+
+    masks_polygons_json_path = await _masks_polygons_path(room_id)
+    image_path = os.path.join(os.path.dirname(masks_polygons_json_path), "preprocessed.png")
+
+    try:
+        revision, new_masks = await run_in_threadpool(
+            add_template_matches,
+            masks_polygons_json_path,
+            image_path,
+            body.base_revision,
+            mask_id,
+            body.threshold,
+            tuple(body.scales),
+            tuple(body.rotations),
+            body.max_matches,
+            body.base_analysis_id
+        )
+    except MaskEditConflict as e:
+        raise _revision_conflict(e)
+    except MaskEditError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"ok": True, "revision": revision, "masks": new_masks}
@@ -0,0 +1,132 @@
+"""
+analysis_events.py
+──────────────────
+In-process event channels for room analysis progress.
+
+The analysis pipeline runs in a worker thread and publishes events (status,
+polygon chunks, groups, done/error); SSE handlers on the event loop subscribe
+and receive live events.
+
+Polygon chunks are only delivered live, never kept: a channel would otherwise
+hold a whole room's polygons until it expires. A late subscriber is first
+sent the latest event of every other type (status, groups) and a
+`polygons_skipped` event with the number of masks it missed; it fetches
+those from masks_polygons.json once the analysis has completed.
+"""
+
+import asyncio
+import threading
+import time
+
+# How long a finished channel is kept around for late subscribers
+FINISHED_CHANNEL_TTL = 120
+# Streamed to live subscribers only, not replayed
+LIVE_ONLY_EVENTS = ("polygons",)
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+class AnalysisChannel:
+    def __init__(self):
+        # Latest event of each replayed type, in publication order
+        self.latest = {}
+        self.skipped_masks = 0
+        self.subscribers = set()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def publish(self, event: str, data):
+        with self._lock:
+            if self.finished_at is not None:
+                return
+            item = (event, data)
+            if event in LIVE_ONLY_EVENTS:
+                self.skipped_masks += len(data.get("masks", ())) if isinstance(data, dict) else 0
+            else:
+                self.latest.pop(event, None)
+                self.latest[event] = data
+            subscribers = list(self.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def finish(self):
+        with self._lock:
+            if self.finished_at is not None:
+                return
+            self.finished_at = time.monotonic()
+            subscribers = list(self.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def subscribe(self, keepalive: float = 15.0):
+        """
+        Async generator of (event, data); yields (None, None) as a keep-alive
+        tick when nothing happened for `keepalive` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        with self._lock:
+            backlog = list(self.latest.items())
+            if self.skipped_masks:
+                backlog.insert(0, ("polygons_skipped", {"count": self.skipped_masks}))
+            finished = self.finished_at is not None
+            if not finished:
+                self.subscribers.add((loop, queue))
+
+        try:
+            for item in backlog:
+                yield item
+            if finished:
+                return
+
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None, None
+                    continue
+                if item is None:
+                    return
+                yield item
+        finally:
+            with self._lock:
+                self.subscribers.discard((loop, queue))
+
+
+def _prune_finished():
+    now = time.monotonic()
+    for key, channel in list(_channels.items()):
+        if channel.finished_at is not None and now - channel.finished_at > FINISHED_CHANNEL_TTL:
+            del _channels[key]
+
+
+def open_channel(room_id: str) -> AnalysisChannel:
+    """Start a fresh channel for a new analysis of `room_id` (replacing any old one)."""
+    with _channels_lock:
+        _prune_finished()
+        old = _channels.get(room_id)
+        channel = AnalysisChannel()
+        _channels[room_id] = channel
+    if old is not None:
+        old.finish()
+    return channel
+
+
+def get_channel(room_id: str):
+    with _channels_lock:
+        _prune_finished()
+        return _channels.get(room_id)
+
+
+def publish(room_id: str, event: str, data):
+    """Publish to the room's channel if an analysis is streaming; no-op otherwise."""
+    channel = get_channel(room_id)
+    if channel is not None:
+        channel.publish(event, data)
+
+
+def finish(room_id: str):
+    channel = get_channel(room_id)
+    if channel is not None:
+        channel.finish()
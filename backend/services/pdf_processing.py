@@ -5,9 +5,8 @@ from models.sql_models import ProcessingJob
 from db.database import SessionLocal, BASE_DIR
 import fitz
 import cv2
-from pymongo import MongoClient
 from bson import ObjectId
-from config import MONGO_URI, MONGO_DB_NAME
+from db.mongo import get_sync_db
 
 LOCAL_FILE_DB = os.path.join(BASE_DIR, "local_file_db")
 os.makedirs(LOCAL_FILE_DB, exist_ok=True)
@@ -153,8 +152,7 @@ def _crop_regions(image_path: str, page_num: int, regions, out_dir: str):
 
 def _sync_update_mongodb_project(project_id: str, registry_url: str, page_paths: list, all_images: list):
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[MONGO_DB_NAME]
+        db = get_sync_db()
         projects_coll = db["projects"]
         project_sources_coll = db["project_sources"]
         pages_coll = db["pages"]
@@ -223,8 +221,6 @@ def _sync_update_mongodb_project(project_id: str, registry_url: str, page_paths:
                 {"_id": project_source_id},
                 {"$set": {"pages": page_ids}}
             )
-
-        client.close()
     except Exception as e:
         print(f"[MongoDB] ❌ sync update failed: {e}")
 
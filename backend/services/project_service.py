@@ -108,6 +108,8 @@ async def get_project_by_id(project_id: str) -> dict | None:
                     "analysis_message": r.get("analysis_message"),
                     "masks_polygons_url": r.get("masks_polygons_url"),
                     "masks_groups_url": r.get("masks_groups_url"),
+                    "masks_store_url": r.get("masks_store_url"),
+                    "masks_label_map_url": r.get("masks_label_map_url"),
                     "masks_pkl_url": r.get("masks_pkl_url")
                 })
 
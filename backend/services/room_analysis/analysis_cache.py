@@ -0,0 +1,184 @@
+"""
+Result cache for room analysis.
+
+Drawing sets repeat identical unit plans many times; a room whose image was
+already analysed with the same model and parameters gets the previous
+artifacts linked into its analysis folder instead of running SAM again.
+
+Entries live under ANALYSIS_CACHE_DIR/<params key>/<source hash>/ and are
+found either by the exact hash of the source image bytes or, for re-cropped
+or re-encoded copies, by a difference hash of the preprocessed image with
+the same dimensions (masks are in pixel coordinates, so sizes must match).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import cv2
+import numpy as np
+
+from config import ANALYSIS_CACHE_ROOT
+from services.room_analysis.mask_store import MASK_STORE_FILENAME
+from services.room_analysis.similarity_graph import SIMILARITY_GRAPH_FILENAME, DEFAULT_TOLERANCES
+from services.room_analysis.grouping_engine import MERGE_TREE_FILENAME
+from services.room_analysis.mask_drawer import LABEL_MAP_FILENAME
+from services.room_analysis.polygon_codec import lod_path, POLYGON_LOD_EPSILONS
+
+ANALYSIS_CACHE_DIR = os.path.join(ANALYSIS_CACHE_ROOT, "analysis")
+
+# Bump when grouping / polygon stages change their output for the same masks
+ANALYSIS_CACHE_VERSION = 1
+
+DHASH_SIZE = 32
+# Share of differing dHash bits still treated as the same drawing
+DHASH_MAX_DISTANCE = 0.02
+
+_POLYGON_FILES = ["masks_polygons.json"] + [
+    os.path.basename(lod_path("masks_polygons.json", level)) for level in range(1, len(POLYGON_LOD_EPSILONS) + 1)
+]
+
+CACHED_ARTIFACTS = (
+    "preprocessed.png",
+    MASK_STORE_FILENAME,
+    "groups.json",
+    *(name + suffix for name in _POLYGON_FILES for suffix in ("", ".gz", ".br", ".bin", ".bin.gz", ".bin.br")),
+    SIMILARITY_GRAPH_FILENAME,
+    MERGE_TREE_FILENAME,
+    LABEL_MAP_FILENAME,
+)
+
+_meta_cache = {}
+_meta_cache_lock = threading.Lock()
+
+
+def analysis_params_key(generator_params: dict, preprocess_key_params: dict = None) -> str:
+    params = {
+        "version": ANALYSIS_CACHE_VERSION,
+        "generator": generator_params,
+        "preprocess": preprocess_key_params or {},
+        "grouping": DEFAULT_TOLERANCES,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def image_dhash(image, hash_size=DHASH_SIZE) -> str:
+    """Difference hash (hash_size x hash_size bits) of an image, as hex."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return np.packbits(bits).tobytes().hex()
+
+
+def _dhash_distance(a: str, b: str) -> float:
+    x = np.frombuffer(bytes.fromhex(a), dtype=np.uint8)
+    y = np.frombuffer(bytes.fromhex(b), dtype=np.uint8)
+    if x.shape != y.shape:
+        return 1.0
+    return np.unpackbits(x ^ y).sum() / (len(x) * 8)
+
+
+def _entry_metas(params_dir):
+    """{entry_dir: meta} for every complete entry under params_dir (memoised per entry)."""
+    if not os.path.isdir(params_dir):
+        return {}
+    metas = {}
+    for name in os.listdir(params_dir):
+        entry_dir = os.path.join(params_dir, name)
+        with _meta_cache_lock:
+            meta = _meta_cache.get(entry_dir)
+        if meta is None:
+            meta_path = os.path.join(entry_dir, "meta.json")
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with _meta_cache_lock:
+                _meta_cache[entry_dir] = meta
+        metas[entry_dir] = meta
+    return metas
+
+
+def find_by_source_hash(params_key: str, source_hash: str):
+    entry_dir = os.path.join(ANALYSIS_CACHE_DIR, params_key, source_hash)
+    return entry_dir if os.path.exists(os.path.join(entry_dir, "meta.json")) else None
+
+
+def find_by_dhash(params_key: str, dhash: str, image_shape):
+    """Closest entry with the same image size within DHASH_MAX_DISTANCE, or None."""
+    best, best_distance = None, DHASH_MAX_DISTANCE
+    for entry_dir, meta in _entry_metas(os.path.join(ANALYSIS_CACHE_DIR, params_key)).items():
+        if list(meta.get("image_shape", [])) != list(image_shape[:2]):
+            continue
+        distance = _dhash_distance(meta["dhash"], dhash)
+        if distance <= best_distance:
+            best, best_distance = entry_dir, distance
+    return best
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard-link when possible. Safe because every writer of a cached artifact
+    (mask store, groups, polygons and siblings, graph, merge tree, label
+    map, preprocessed.png) writes a temporary file and os.replace()s it,
+    which gives the room its own inode instead of truncating the shared one.
+    """
+    tmp = f"{dst}.tmp-{uuid.uuid4().hex[:8]}"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def store_analysis_result(params_key: str, source_hash: str, dhash: str, image_shape, room_output_dir: str, replace=False):
+    """
+    Add a finished room's artifacts to the cache. An existing entry is kept
+    unless `replace` is set (a forced re-analysis refreshes it).
+    """
+    params_dir = os.path.join(ANALYSIS_CACHE_DIR, params_key)
+    entry_dir = os.path.join(params_dir, source_hash)
+    if os.path.exists(entry_dir):
+        if not replace:
+            return entry_dir
+        stale_dir = os.path.join(params_dir, f".stale-{uuid.uuid4().hex}")
+        os.rename(entry_dir, stale_dir)
+        with _meta_cache_lock:
+            _meta_cache.pop(entry_dir, None)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+    tmp_dir = os.path.join(params_dir, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp_dir)
+    try:
+        for name in CACHED_ARTIFACTS:
+            src = os.path.join(room_output_dir, name)
+            if os.path.exists(src):
+                _link_or_copy(src, os.path.join(tmp_dir, name))
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"source_hash": source_hash, "dhash": dhash, "image_shape": list(image_shape[:2])}, f)
+
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another worker stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return entry_dir
+
+
+def restore_analysis_result(entry_dir: str, room_output_dir: str):
+    """Link a cache entry's artifacts into a room's analysis folder; returns the entry meta."""
+    os.makedirs(room_output_dir, exist_ok=True)
+    for name in CACHED_ARTIFACTS:
+        src = os.path.join(entry_dir, name)
+        dst = os.path.join(room_output_dir, name)
+        if os.path.exists(src):
+            _link_or_copy(src, dst)
+        elif os.path.exists(dst):
+            # Leftover from a previous analysis of this room
+            os.remove(dst)
+
+    with open(os.path.join(entry_dir, "meta.json")) as f:
+        return json.load(f)
@@ -0,0 +1,260 @@
+"""
+Compact in-memory representation of a single mask.
+
+SAM hands back one full-frame boolean array per mask, so a few thousand masks
+on a large drawing cost gigabytes even though each one covers a small part of
+the frame. A CompactMask keeps only its tight bbox crop plus the offset of
+that crop in the frame. Area and moments are computed once and cached, and
+set operations (intersection, union, touch tests) only look at where the two
+bboxes overlap.
+
+Masks flow through merge, feature extraction, polygonization, the label map
+and the mask store in this form; to_dict() rebuilds the SAM-style dict for
+code that needs a full frame.
+"""
+
+from math import comb
+
+import cv2
+import numpy as np
+
+_GEOMETRY_KEYS = ("segmentation", "bbox", "area")
+# (p, q) of cv2's raw spatial moments m_pq; the central (mu) and normalised
+# (nu) moments do not depend on the origin
+_RAW_MOMENT_ORDERS = ((0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2), (3, 0), (2, 1), (1, 2), (0, 3))
+
+
+class CompactMask:
+    """A boolean mask stored as its tight bbox crop at (x0, y0) in a frame of `frame_shape`."""
+
+    __slots__ = ("crop", "x0", "y0", "frame_shape", "meta", "_area", "_moments")
+
+    def __init__(self, crop, x0, y0, frame_shape, meta=None, area=None):
+        self.crop = crop
+        self.x0 = int(x0)
+        self.y0 = int(y0)
+        self.frame_shape = (int(frame_shape[0]), int(frame_shape[1]))
+        # Scalar SAM metadata (predicted_iou, stability_score, ...)
+        self.meta = meta if meta is not None else {}
+        self._area = area
+        self._moments = None
+
+    # ----------------------------
+    # Construction
+    # ----------------------------
+    @classmethod
+    def from_array(cls, seg, x0=0, y0=0, frame_shape=None, meta=None):
+        """
+        Trim a boolean array (a full frame, or a window placed at x0, y0) to
+        its tight bbox. The crop is copied so the source can be released.
+        Returns None if the array is empty.
+        """
+        rows = np.flatnonzero(seg.any(axis=1))
+        if not len(rows):
+            return None
+        cols = np.flatnonzero(seg.any(axis=0))
+
+        crop = seg[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].astype(bool, copy=True)
+        return cls(crop, x0 + cols[0], y0 + rows[0], frame_shape or seg.shape[:2], meta)
+
+    @classmethod
+    def from_rle(cls, rle, bbox=None, meta=None):
+        """
+        Decode SAM's uncompressed RLE ({"size": [h, w], "counts": [...]},
+        column-major, starting with a run of zeros) straight into a crop.
+        Only the columns covered by `bbox` are ever materialised.
+        """
+        height, width = (int(v) for v in rle["size"])
+        counts = np.asarray(rle["counts"], dtype=np.int64)
+        ends = np.cumsum(counts)
+        run_starts, run_ends = (ends - counts)[1::2], ends[1::2]
+        if not len(run_starts):
+            return None
+
+        if bbox is not None:
+            col0, col1 = int(bbox[0]), min(int(bbox[0]) + int(bbox[2]) + 1, width)
+        else:
+            col0, col1 = int(run_starts.min()) // height, int(run_ends.max() - 1) // height + 1
+
+        lo, hi = col0 * height, col1 * height
+        run_starts, run_ends = np.clip(run_starts, lo, hi), np.clip(run_ends, lo, hi)
+        keep = run_ends > run_starts
+
+        edges = np.zeros(hi - lo + 1, dtype=np.int32)
+        np.add.at(edges, run_starts[keep] - lo, 1)
+        np.add.at(edges, run_ends[keep] - lo, -1)
+        strip = np.cumsum(edges[:-1]).astype(bool).reshape(col1 - col0, height).T
+
+        return cls.from_array(strip, col0, 0, (height, width), meta)
+
+    @classmethod
+    def from_sam(cls, mask):
+        """CompactMask from a SAM-style dict (binary or uncompressed-RLE segmentation)."""
+        seg = mask["segmentation"]
+        meta = {k: v for k, v in mask.items() if k not in _GEOMETRY_KEYS}
+        if isinstance(seg, dict):
+            return cls.from_rle(seg, mask.get("bbox"), meta)
+
+        bbox = mask.get("bbox")
+        if bbox is None:
+            return cls.from_array(seg, meta=meta)
+        x, y, w, h = (int(v) for v in bbox)
+        return cls.from_array(seg[y:y + h + 1, x:x + w + 1], x, y, seg.shape[:2], meta)
+
+    # ----------------------------
+    # Geometry
+    # ----------------------------
+    @property
+    def x1(self):
+        """Exclusive right edge"""
+        return self.x0 + self.crop.shape[1]
+
+    @property
+    def y1(self):
+        """Exclusive bottom edge"""
+        return self.y0 + self.crop.shape[0]
+
+    @property
+    def bbox(self):
+        """SAM-style [x, y, w, h] with w/h as max - min"""
+        return [self.x0, self.y0, self.crop.shape[1] - 1, self.crop.shape[0] - 1]
+
+    @property
+    def area(self):
+        if self._area is None:
+            self._area = int(np.count_nonzero(self.crop))
+        return self._area
+
+    @property
+    def moments(self):
+        """cv2.moments of the mask in frame coordinates"""
+        if self._moments is None:
+            m = cv2.moments(self.crop.view(np.uint8), binaryImage=True)
+            # Move every raw moment from crop to frame coordinates:
+            # sum (x + x0)^p (y + y0)^q expanded binomially
+            x0, y0 = float(self.x0), float(self.y0)
+            crop_m = dict(m)
+            for p, q in _RAW_MOMENT_ORDERS:
+                m[f"m{p}{q}"] = sum(
+                    comb(p, i) * comb(q, j) * x0 ** (p - i) * y0 ** (q - j) * crop_m[f"m{i}{j}"]
+                    for i in range(p + 1) for j in range(q + 1)
+                )
+            self._moments = m
+        return self._moments
+
+    @property
+    def centroid(self):
+        m = self.moments
+        return m["m10"] / m["m00"], m["m01"] / m["m00"]
+
+    @property
+    def nbytes(self):
+        return self.crop.nbytes
+
+    def padded_crop(self, pad):
+        """(crop, x0, y0) grown by `pad` zero pixels on each side, clamped to the frame."""
+        if not pad:
+            return self.crop, self.x0, self.y0
+        x0, y0 = max(self.x0 - pad, 0), max(self.y0 - pad, 0)
+        x1, y1 = min(self.x1 + pad, self.frame_shape[1]), min(self.y1 + pad, self.frame_shape[0])
+        return self.window(x0, y0, x1, y1), x0, y0
+
+    def window(self, x0, y0, x1, y1):
+        """
+        The mask inside frame rectangle [x0, x1) x [y0, y1); areas outside
+        the bbox (or the frame) read as False. A view when the rectangle lies
+        inside the bbox, so treat the result as read-only.
+        """
+        if x0 >= self.x0 and y0 >= self.y0 and x1 <= self.x1 and y1 <= self.y1:
+            return self.crop[y0 - self.y0:y1 - self.y0, x0 - self.x0:x1 - self.x0]
+
+        out = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        ix0, iy0 = max(x0, self.x0), max(y0, self.y0)
+        ix1, iy1 = min(x1, self.x1), min(y1, self.y1)
+        if ix0 < ix1 and iy0 < iy1:
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.crop[iy0 - self.y0:iy1 - self.y0, ix0 - self.x0:ix1 - self.x0]
+        return out
+
+    def _overlap(self, other, grow=0):
+        """Rectangle where this bbox (grown by `grow`) meets other's, or None."""
+        x0, y0 = max(self.x0 - grow, other.x0), max(self.y0 - grow, other.y0)
+        x1, y1 = min(self.x1 + grow, other.x1), min(self.y1 + grow, other.y1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    # ----------------------------
+    # Set operations (bbox overlaps only)
+    # ----------------------------
+    def intersects(self, other):
+        rect = self._overlap(other)
+        return rect is not None and bool(np.logical_and(self.window(*rect), other.window(*rect)).any())
+
+    def intersection_area(self, other):
+        rect = self._overlap(other)
+        if rect is None:
+            return 0
+        return int(np.count_nonzero(np.logical_and(self.window(*rect), other.window(*rect))))
+
+    def touches(self, other, distance=1):
+        """
+        True if some pixel of `other` lies within `distance` pixels
+        (Chebyshev) of this mask, i.e. overlaps its (2d+1)^2 dilation.
+        """
+        rect = self._overlap(other, distance)
+        if rect is None:
+            return False
+
+        x0, y0, x1, y1 = rect
+        d = distance
+        source = self.window(x0 - d, y0 - d, x1 + d, y1 + d).view(np.uint8)
+        dilated = cv2.dilate(source, np.ones((2 * d + 1, 2 * d + 1), np.uint8))[d:-d or None, d:-d or None]
+        return bool(np.logical_and(dilated.view(bool), other.window(*rect)).any())
+
+    def __and__(self, other):
+        """Intersection as a new CompactMask (None if the masks do not overlap)."""
+        rect = self._overlap(other)
+        if rect is None:
+            return None
+        x0, y0, x1, y1 = rect
+        return CompactMask.from_array(
+            np.logical_and(self.window(*rect), other.window(*rect)), x0, y0, self.frame_shape
+        )
+
+    def __or__(self, other):
+        """Union as a new CompactMask spanning both bboxes (metadata is not carried over)."""
+        x0, y0 = min(self.x0, other.x0), min(self.y0, other.y0)
+        x1, y1 = max(self.x1, other.x1), max(self.y1, other.y1)
+        crop = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        crop[self.y0 - y0:self.y1 - y0, self.x0 - x0:self.x1 - x0] = self.crop
+        crop[other.y0 - y0:other.y1 - y0, other.x0 - x0:other.x1 - x0] |= other.crop
+        return CompactMask(crop, x0, y0, self.frame_shape)
+
+    def clipped(self, rect, frame_mask=None):
+        """
+        The part of this mask inside frame rectangle (x, y, w, h) [and
+        inside `frame_mask`, a boolean array of that rectangle's size],
+        re-based so the rectangle becomes the new frame. None if nothing is left.
+        """
+        rx, ry, rw, rh = rect
+        inside = self.window(rx, ry, rx + rw, ry + rh)
+        if frame_mask is not None:
+            inside = inside & frame_mask
+        return CompactMask.from_array(inside, frame_shape=(rh, rw), meta=dict(self.meta))
+
+    # ----------------------------
+    # Conversion
+    # ----------------------------
+    def to_dense(self):
+        seg = np.zeros(self.frame_shape, dtype=bool)
+        seg[self.y0:self.y1, self.x0:self.x1] = self.crop
+        return seg
+
+    def to_dict(self):
+        """SAM-style dict with a full-frame segmentation"""
+        mask = dict(self.meta)
+        mask.update({"segmentation": self.to_dense(), "area": self.area, "bbox": self.bbox})
+        return mask
+
+    def __repr__(self):
+        return f"CompactMask(bbox={self.bbox}, area={self.area}, frame={self.frame_shape})"
@@ -0,0 +1,128 @@
+"""
+Cache of SAM image embeddings.
+
+The image encoder is the single most expensive step of an analysis and its
+output depends only on the model and the exact image SAM is given. Embeddings
+are kept in an in-memory LRU and as .npz files on disk, keyed by
+(model, image bytes), so an embedding computed speculatively (see
+services/sam_prewarm.py) or by an earlier analysis of the same image is
+picked up by CachedSamPredictor instead of running the encoder again.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+from config import ANALYSIS_CACHE_ROOT
+
+EMBEDDING_CACHE_DIR = os.path.join(ANALYSIS_CACHE_ROOT, "embeddings")
+EMBEDDING_MEMORY_CACHE_SIZE = 8
+# vit_h embeddings are 4 MB each
+EMBEDDING_DISK_CACHE_MAX_FILES = 256
+
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+
+def embedding_key(model_tag: str, image: np.ndarray, image_format: str = "RGB") -> str:
+    digest = hashlib.sha256(f"{model_tag}:{image_format}:{image.shape}:{image.dtype}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def _disk_path(key, cache_dir):
+    return os.path.join(cache_dir, f"{key}.npz")
+
+
+def has_embedding(key: str, cache_dir=EMBEDDING_CACHE_DIR) -> bool:
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            return True
+    return os.path.exists(_disk_path(key, cache_dir))
+
+
+def get_embedding(key: str, cache_dir=EMBEDDING_CACHE_DIR):
+    """(features ndarray, original_size, input_size) or None"""
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    path = _disk_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            entry = (data["features"], tuple(data["original_size"].tolist()), tuple(data["input_size"].tolist()))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    _remember(key, entry)
+    return entry
+
+
+def put_embedding(key: str, features: np.ndarray, original_size, input_size, cache_dir=EMBEDDING_CACHE_DIR):
+    entry = (features, tuple(int(v) for v in original_size), tuple(int(v) for v in input_size))
+    _remember(key, entry)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _disk_path(key, cache_dir)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, features=features, original_size=np.array(entry[1]), input_size=np.array(entry[2]))
+    os.replace(tmp_path, path)
+    _prune_disk(cache_dir)
+
+
+def _remember(key, entry):
+    with _memory_cache_lock:
+        _memory_cache[key] = entry
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > EMBEDDING_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _prune_disk(cache_dir):
+    files = [e for e in os.scandir(cache_dir) if e.name.endswith(".npz") and not e.name.endswith(".tmp.npz")]
+    if len(files) <= EMBEDDING_DISK_CACHE_MAX_FILES:
+        return
+    files.sort(key=lambda e: e.stat().st_mtime)
+    for entry in files[:len(files) - EMBEDDING_DISK_CACHE_MAX_FILES]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class CachedSamPredictor(SamPredictor):
+    """
+    SamPredictor whose set_image reuses a cached embedding of the same image
+    (and stores the ones it computes). SamAutomaticMaskGenerator only calls
+    set_image, so swapping its predictor for this one is enough.
+    """
+
+    def __init__(self, sam_model, model_tag: str):
+        super().__init__(sam_model)
+        self.model_tag = model_tag
+        self.last_cache_hit = False
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB") -> None:
+        key = embedding_key(self.model_tag, image, image_format)
+        cached = get_embedding(key)
+        if cached is not None:
+            features, original_size, input_size = cached
+            self.reset_image()
+            self.features = torch.from_numpy(features).to(self.device)
+            self.original_size = original_size
+            self.input_size = input_size
+            self.is_image_set = True
+            self.last_cache_hit = True
+            return
+
+        super().set_image(image, image_format)
+        self.last_cache_hit = False
+        put_embedding(key, self.features.detach().cpu().numpy(), self.original_size, self.input_size)
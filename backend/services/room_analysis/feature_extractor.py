@@ -0,0 +1,221 @@
+import os
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+from services.room_analysis.compact_mask import CompactMask
+
+
+# Below this many masks the process pool start-up costs more than it saves
+PARALLEL_MIN_MASKS = 200
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# ----------------------------
+# Shared worker pool
+# ----------------------------
+def default_workers():
+    return min(os.cpu_count() or 1, 8)
+
+
+def get_process_pool(workers=None):
+    """
+    Long-lived process pool shared by feature extraction and polygonization.
+    Workers are spawned, not forked: the server process has live threads
+    (artifact writer, pre-warm, database monitors) and a loaded SAM model,
+    and forking that can deadlock. Start-up is paid once per process.
+    """
+    workers = workers or default_workers()
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+            _pools[workers] = pool
+        return pool
+
+
+def discard_process_pool(pool):
+    """Drop a pool that broke (a worker died) so the next call starts a fresh one."""
+    with _pools_lock:
+        for workers, candidate in list(_pools.items()):
+            if candidate is pool:
+                del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ----------------------------
+# Cropping
+# ----------------------------
+def _segmentation_bbox(seg):
+    """Tight [x, y, w, h] bbox of a boolean mask (w/h as max - min, like SAM)."""
+    rows = np.flatnonzero(seg.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(seg.any(axis=0))
+    return [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0]), int(rows[-1] - rows[0])]
+
+
+def crop_segmentation(mask, pad=0):
+    """
+    Cut a mask down to its bbox (plus `pad` pixels, clamped to the frame).
+    Accepts a CompactMask, a SAM-style dict or a bare ndarray; reuses the
+    dict's bbox when present.
+
+    Returns (crop, x0, y0) where crop is a view into the segmentation,
+    or None if the mask is empty.
+    """
+    if isinstance(mask, CompactMask):
+        return mask.padded_crop(pad)
+
+    if isinstance(mask, dict):
+        seg = mask["segmentation"]
+        bbox = mask.get("bbox")
+    else:
+        seg = mask
+        bbox = None
+
+    if bbox is None:
+        bbox = _segmentation_bbox(seg)
+        if bbox is None:
+            return None
+
+    x, y, w, h = (int(v) for v in bbox)
+    frame_h, frame_w = seg.shape[:2]
+
+    x0, y0 = max(x - pad, 0), max(y - pad, 0)
+    x1, y1 = min(x + w + 1 + pad, frame_w), min(y + h + 1 + pad, frame_h)
+
+    return seg[y0:y1, x0:x1], x0, y0
+
+
+# ----------------------------
+# Feature Extraction
+# ----------------------------
+def extract_crop_features(crop, x0=0, y0=0, area=None, bbox=None):
+    """
+    Shape features for one mask given its bbox crop.
+    Matches grouping_engine.extract_mask_features, plus precomputed Hu moments
+    so the grouping engine never has to touch the contour again.
+    """
+    if area is None:
+        area = int(np.count_nonzero(crop))
+
+    if bbox is not None:
+        w, h = int(bbox[2]), int(bbox[3])
+    else:
+        tight = _segmentation_bbox(crop)
+        w, h = (tight[2], tight[3]) if tight else (0, 0)
+
+    # One pixel of zero padding so contours touching the crop edge stay closed
+    mask_uint8 = np.pad(crop.astype(np.uint8), 1) * 255
+    contours, _ = cv2.findContours(
+        mask_uint8,
+        cv2.RETR_EXTERNAL,
+        cv2.CHAIN_APPROX_SIMPLE
+    )
+
+    contour = max(contours, key=cv2.contourArea) if contours else None
+
+    vertex_count = 0
+    hu = None
+    if contour is not None:
+        epsilon = 0.02 * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        vertex_count = len(approx)
+        hu = cv2.HuMoments(cv2.moments(contour)).ravel()
+        contour = contour + np.array([x0 - 1, y0 - 1], dtype=contour.dtype)
+
+    return {
+        "area": area,
+        "height": h,
+        "width": w,
+        "vertex": vertex_count,
+        "contour": contour,
+        "hu": hu
+    }
+
+
+def _extract_job(job):
+    crop, x0, y0, area, bbox = job
+    return extract_crop_features(crop, x0, y0, area, bbox)
+
+
+def empty_features():
+    return {"area": 0, "height": 0, "width": 0, "vertex": 0, "contour": None, "hu": None}
+
+
+def extract_features(masks, workers=None, parallel_min=PARALLEL_MIN_MASKS):
+    """
+    Extract features for a list of masks, working on bbox crops only.
+    SAM's `area`/`bbox` are reused when present. Large mask sets are fanned
+    out across a process pool; only the small crops cross the process boundary.
+
+    The result lines up index-for-index with `masks` and can be passed
+    straight to grouping_engine.build_groups(masks, features).
+    """
+    jobs = []
+    empty = set()
+
+    for idx, mask in enumerate(masks):
+        cropped = crop_segmentation(mask)
+        if cropped is None:
+            empty.add(idx)
+            continue
+
+        crop, x0, y0 = cropped
+        area = bbox = None
+        if isinstance(mask, CompactMask):
+            area, bbox = mask.area, mask.bbox
+        elif isinstance(mask, dict):
+            area = mask.get("area")
+            bbox = mask.get("bbox")
+        jobs.append((crop, x0, y0, area, bbox))
+
+    results = extract_crop_jobs(jobs, workers, parallel_min)
+
+    features = []
+    it = iter(results)
+    for idx in range(len(masks)):
+        features.append(empty_features() if idx in empty else next(it))
+
+    return features
+
+
+def extract_crop_jobs(jobs, workers=None, parallel_min=PARALLEL_MIN_MASKS):
+    """
+    Features for (crop, x0, y0, area, bbox) jobs, in order; fanned out across
+    a process pool for large batches.
+    """
+    if len(jobs) >= parallel_min and (workers is None or workers > 1):
+        workers = workers or default_workers()
+        chunksize = max(1, len(jobs) // (workers * 4))
+        pool = get_process_pool(workers)
+        try:
+            return list(pool.map(_extract_job, jobs, chunksize=chunksize))
+        except BrokenProcessPool:
+            discard_process_pool(pool)
+            raise
+    return [_extract_job(job) for job in jobs]
+
+
+def features_from_polygons(polygons):
+    """
+    Features for a mask that only exists as editor polygons (e.g. a mask
+    drawn or redrawn by hand): rasterise into its bbox crop and extract.
+    """
+    pts = [np.asarray(p, dtype=np.int32).reshape(-1, 2) for p in polygons if len(p) >= 3]
+    if not pts:
+        return empty_features()
+
+    all_pts = np.concatenate(pts)
+    x0, y0 = all_pts.min(axis=0)
+    x1, y1 = all_pts.max(axis=0)
+
+    crop = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=np.uint8)
+    cv2.fillPoly(crop, [p - [x0, y0] for p in pts], 1)
+    return extract_crop_features(crop.astype(bool), int(x0), int(y0))
@@ -4,11 +4,17 @@ import random
 import string
 import json
 import os
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from services.room_analysis.feature_extractor import extract_features
 
 
 def save_groups_to_json(groups, filepath="groups.json"):
-    with open(filepath, "w") as f:
+    # Replace, never rewrite in place: the file may be hard-linked into the analysis cache
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, "w") as f:
         json.dump(groups, f, indent=4)
+    os.replace(tmp_path, filepath)
 
 
 def load_groups_from_json(filepath="groups.json"):
@@ -140,52 +146,327 @@ def is_similar(f1, f2,
 #                 assigned[j] = group_id
 
 #     return groups
-def build_similarity_graph(masks):
-    n = len(masks)
-    features = [extract_mask_features(m) for m in masks]
 
-    adjacency = {i: set() for i in range(n)}
 
-    for i in range(n):
-        for j in range(i + 1, n):
-            if is_similar(features[i], features[j]):
-                adjacency[i].add(j)
-                adjacency[j].add(i)
+# ----------------------------
+# Vectorized Similarity Graph
+# ----------------------------
+# Same threshold OpenCV applies inside matchShapes before a Hu term counts
+HU_EPS = 1e-5
+
+# Upper bound on candidate pairs checked per block (keeps temporaries small)
+PAIR_BLOCK_SIZE = 2_000_000
+
+
+def hu_match_terms(hu):
+    """
+    Convert raw Hu moments (n, 7) into the per-term values used by
+    cv2.CONTOURS_MATCH_I1: 1 / (sign(h) * log10|h|), plus a validity mask.
+    """
+    hu = np.asarray(hu, dtype=np.float64).reshape(-1, 7)
+    abs_hu = np.abs(hu)
+    valid = abs_hu > HU_EPS
+
+    terms = np.zeros_like(hu)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms[valid] = 1.0 / (np.sign(hu[valid]) * np.log10(abs_hu[valid]))
+
+    return terms, valid
+
+
+def build_feature_table(features):
+    """
+    Pack a list of per-mask feature dicts into column arrays.
+    Hu moments are taken from features["hu"] when present, otherwise
+    computed from the contour.
+    """
+    n = len(features)
+    hu = np.zeros((n, 7), dtype=np.float64)
+    has_contour = np.zeros(n, dtype=bool)
+
+    for i, feat in enumerate(features):
+        if feat.get("hu") is not None:
+            hu[i] = np.asarray(feat["hu"], dtype=np.float64).ravel()
+            has_contour[i] = True
+        elif feat.get("contour") is not None:
+            hu[i] = cv2.HuMoments(cv2.moments(feat["contour"])).ravel()
+            has_contour[i] = True
+
+    hu_terms, hu_valid = hu_match_terms(hu)
+
+    return {
+        "hu": hu,
+        "area": np.array([f["area"] for f in features], dtype=np.float64),
+        "height": np.array([f["height"] for f in features], dtype=np.float64),
+        "width": np.array([f["width"] for f in features], dtype=np.float64),
+        "vertex": np.array([f["vertex"] for f in features], dtype=np.int64),
+        "has_contour": has_contour,
+        "hu_terms": hu_terms,
+        "hu_valid": hu_valid,
+    }
 
-    return adjacency
 
-def get_connected_components(adjacency):
-    visited = set()
-    components = []
+def _candidate_pairs(sorted_area, area_tol):
+    """
+    Yield (i, j) blocks of positions into the area-sorted order such that
+    j > i and sorted_area[j] is inside the area window of sorted_area[i].
+    The window is a superset of what is_similar accepts in either direction.
+    """
+    n = len(sorted_area)
+    upper = (sorted_area + area_tol * np.maximum(sorted_area, 1)) / (1 - area_tol)
+    stop = np.searchsorted(sorted_area, upper, side="right")
+    counts = np.maximum(stop - np.arange(n) - 1, 0)
+
+    start = 0
+    while start < n:
+        # Grow the row block until it holds roughly PAIR_BLOCK_SIZE pairs
+        cum = np.cumsum(counts[start:])
+        end = start + max(1, int(np.searchsorted(cum, PAIR_BLOCK_SIZE, side="right")))
+        block_counts = counts[start:end]
+        total = int(block_counts.sum())
+
+        if total:
+            rows = np.repeat(np.arange(start, end), block_counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+            yield rows, rows + 1 + offsets
+
+        start = end
+
+
+def similar_pairs(table, lo, hi,
+                  area_tol=0.08,
+                  size_tol=0.20,
+                  shape_tol=0.04,
+                  vertex_tol=2):
+    """
+    Vectorized is_similar(features[lo], features[hi]) over index arrays.
+    Returns a boolean array, one entry per pair.
+    """
+    area = table["area"]
+    keep = np.abs(area[lo] - area[hi]) / np.maximum(area[lo], 1) <= area_tol
+
+    height, width = table["height"], table["width"]
+    keep &= np.abs(height[lo] - height[hi]) / np.maximum(height[lo], 1) <= size_tol
+    keep &= np.abs(width[lo] - width[hi]) / np.maximum(width[lo], 1) <= size_tol
+    keep &= np.abs(table["vertex"][lo] - table["vertex"][hi]) <= vertex_tol
+    keep &= table["has_contour"][lo] & table["has_contour"][hi]
+
+    # Hu-moment distance only for pairs that survived the cheap checks
+    candidates = np.flatnonzero(keep)
+    if len(candidates):
+        clo, chi = lo[candidates], hi[candidates]
+        both = table["hu_valid"][clo] & table["hu_valid"][chi]
+        diff = np.abs(table["hu_terms"][clo] - table["hu_terms"][chi])
+        shape_score = np.where(both, diff, 0.0).sum(axis=1)
+        keep[candidates] = shape_score <= shape_tol
+
+    return keep
+
+
+def pair_distances(table, lo, hi,
+                   area_tol=0.08,
+                   size_tol=0.20,
+                   shape_tol=0.04,
+                   vertex_tol=2,
+                   limit=np.inf):
+    """
+    Combined shape distance for index pairs: the largest of each is_similar
+    criterion divided by its tolerance. A pair is similar at tolerances
+    scaled by t exactly when its distance is <= t (so 1.0 = the defaults).
+    Pairs without contours, or already beyond `limit` on the cheap criteria,
+    get inf.
+    """
+    area = table["area"]
+    dist = np.abs(area[lo] - area[hi]) / np.maximum(area[lo], 1) / area_tol
+
+    height, width = table["height"], table["width"]
+    dist = np.maximum(dist, np.abs(height[lo] - height[hi]) / np.maximum(height[lo], 1) / size_tol)
+    dist = np.maximum(dist, np.abs(width[lo] - width[hi]) / np.maximum(width[lo], 1) / size_tol)
+
+    vertex_diff = np.abs(table["vertex"][lo] - table["vertex"][hi]).astype(np.float64)
+    if vertex_tol > 0:
+        dist = np.maximum(dist, vertex_diff / vertex_tol)
+    else:
+        dist = np.where(vertex_diff > 0, np.inf, dist)
+
+    dist = np.where(table["has_contour"][lo] & table["has_contour"][hi], dist, np.inf)
+
+    # Hu-moment distance only where the cheap criteria leave the pair within reach
+    candidates = np.flatnonzero(dist <= limit)
+    if len(candidates):
+        clo, chi = lo[candidates], hi[candidates]
+        both = table["hu_valid"][clo] & table["hu_valid"][chi]
+        diff = np.abs(table["hu_terms"][clo] - table["hu_terms"][chi])
+        shape_score = np.where(both, diff, 0.0).sum(axis=1)
+        dist[candidates] = np.maximum(dist[candidates], shape_score / shape_tol)
+    dist[dist > limit] = np.inf
+
+    return dist
+
+
+def build_similarity_matrix(table,
+                            area_tol=0.08,
+                            size_tol=0.20,
+                            shape_tol=0.04,
+                            vertex_tol=2):
+    """
+    Vectorized equivalent of calling is_similar on every pair.
+    Masks are sorted by area so each one is only compared with neighbours
+    inside the area tolerance; size, vertex and Hu-moment (matchShapes I1)
+    checks are then applied to whole blocks of candidate pairs at once.
+
+    Returns a symmetric scipy.sparse CSR adjacency matrix.
+    """
+    n = len(table["area"])
+    order = np.argsort(table["area"], kind="stable")
+    sorted_area = table["area"][order]
+
+    edge_i, edge_j = [], []
+
+    for pi, pj in _candidate_pairs(sorted_area, area_tol):
+        # is_similar is evaluated as is_similar(features[lo], features[hi])
+        a, b = order[pi], order[pj]
+        lo, hi = np.minimum(a, b), np.maximum(a, b)
+
+        keep = similar_pairs(table, lo, hi, area_tol, size_tol, shape_tol, vertex_tol)
+        edge_i.append(lo[keep])
+        edge_j.append(hi[keep])
+
+    if edge_i:
+        rows = np.concatenate(edge_i)
+        cols = np.concatenate(edge_j)
+    else:
+        rows = cols = np.zeros(0, dtype=np.int64)
+
+    data = np.ones(2 * len(rows), dtype=np.int8)
+    adjacency = coo_matrix(
+        (data, (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(n, n)
+    )
+    return adjacency.tocsr()
+
+
+# ----------------------------
+# Merge tree (single-linkage hierarchy)
+# ----------------------------
+MERGE_TREE_FILENAME = "merge_tree.npz"
+
+# Loosest strictness the tree covers (tolerances x 3)
+MERGE_TREE_MAX_THRESHOLD = 3.0
+
+
+def build_merge_tree(table, max_threshold=MERGE_TREE_MAX_THRESHOLD, **tolerances):
+    """
+    Single-linkage clustering over pair_distances, as the minimum spanning
+    tree of every pair within `max_threshold`. Cutting the tree at t gives
+    exactly the groups build_groups would produce with every tolerance
+    multiplied by t.
+
+    Returns (edges (m, 2) int64, weights (m,) float64), sorted by weight.
+    """
+    tolerances = {"area_tol": 0.08, "size_tol": 0.20, "shape_tol": 0.04, "vertex_tol": 2, **tolerances}
+    n = len(table["area"])
+    order = np.argsort(table["area"], kind="stable")
+    window = min(tolerances["area_tol"] * max_threshold, 0.95)
+
+    rows, cols, weights = [], [], []
+    for pi, pj in _candidate_pairs(table["area"][order], window):
+        a, b = order[pi], order[pj]
+        lo, hi = np.minimum(a, b), np.maximum(a, b)
+        dist = pair_distances(table, lo, hi, limit=max_threshold, **tolerances)
+        keep = np.isfinite(dist)
+        rows.append(lo[keep])
+        cols.append(hi[keep])
+        weights.append(dist[keep])
+
+    if not rows or not sum(len(r) for r in rows):
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+
+    # Sparse graphs treat 0 as "no edge"; identical shapes need a positive weight
+    offset = 1.0
+    mst = minimum_spanning_tree(coo_matrix((weights + offset, (rows, cols)), shape=(n, n))).tocoo()
+
+    order = np.argsort(mst.data, kind="stable")
+    edges = np.column_stack([mst.row[order], mst.col[order]]).astype(np.int64)
+    return edges, mst.data[order] - offset
+
+
+def cut_merge_tree(n, edges, weights, threshold, mask_ids=None):
+    """
+    Components (lists of mask indices, ordered by smallest member) at
+    strictness `threshold`. With `mask_ids`, indices that are not tree
+    nodes (masks left out of grouping) are not reported.
+    """
+    count = int(np.searchsorted(weights, threshold, side="right"))
+    adjacency = coo_matrix(
+        (np.ones(count, dtype=np.int8), (edges[:count, 0], edges[:count, 1])),
+        shape=(n, n)
+    )
+    components = components_from_matrix(adjacency.tocsr())
+    if mask_ids is not None:
+        # Left-out masks have no edges, so they only ever form singletons
+        nodes = set(np.asarray(mask_ids).tolist())
+        components = [c for c in components if c[0] in nodes]
+    return components
 
-    for node in adjacency:
-        if node in visited:
-            continue
 
-        stack = [node]
-        component = []
+def save_merge_tree(path, n, edges, weights, max_threshold=MERGE_TREE_MAX_THRESHOLD, mask_ids=None):
+    """
+    `edges` are in mask-index space (0..n-1); `mask_ids` lists the masks
+    that are tree nodes (all n when None).
+    """
+    mask_ids = np.arange(n, dtype=np.int64) if mask_ids is None else np.asarray(mask_ids, dtype=np.int64)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_path, n=n, edges=edges, weights=weights, max_threshold=max_threshold, mask_ids=mask_ids)
+    os.replace(tmp_path, path)
 
-        while stack:
-            current = stack.pop()
-            if current in visited:
-                continue
 
-            visited.add(current)
-            component.append(current)
+def load_merge_tree(path):
+    """(n, edges, weights, max_threshold, mask_ids) as saved by save_merge_tree."""
+    with np.load(path) as data:
+        n = int(data["n"])
+        # Trees saved before mask_ids was stored cover every mask
+        mask_ids = data["mask_ids"] if "mask_ids" in data.files else np.arange(n, dtype=np.int64)
+        return n, data["edges"], data["weights"], float(data["max_threshold"]), mask_ids
 
-            for neighbor in adjacency[current]:
-                if neighbor not in visited:
-                    stack.append(neighbor)
 
-        components.append(component)
+def components_from_matrix(adjacency):
+    """
+    Connected components of a sparse adjacency matrix, as lists of mask
+    indices ordered by their smallest member.
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return []
+
+    _, labels = connected_components(adjacency, directed=False)
+
+    order = np.argsort(labels, kind="stable")
+    splits = np.flatnonzero(np.diff(labels[order])) + 1
+    components = [c.tolist() for c in np.split(order, splits)]
+    components.sort(key=lambda c: c[0])
 
     return components
 
 
-def build_groups(masks):
+def build_similarity_graph(masks, features=None, **tolerances):
+    if features is None:
+        features = extract_features(masks)
+
+    table = build_feature_table(features)
+    return build_similarity_matrix(table, **tolerances)
+
+
+def build_groups(masks, features=None, **tolerances):
+
+    adjacency = build_similarity_graph(masks, features, **tolerances)
+    components = components_from_matrix(adjacency)
+    return groups_from_components(components)
+
 
-    adjacency = build_similarity_graph(masks)
-    components = get_connected_components(adjacency)
+def groups_from_components(components):
 
     groups = {}
 
@@ -1,6 +1,19 @@
 import cv2
 import numpy as np
 import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from config import ANALYSIS_CACHE_ROOT
+
+PREPROCESS_CACHE_DIR = os.path.join(ANALYSIS_CACHE_ROOT, "preprocess")
+PREPROCESS_MEMORY_CACHE_SIZE = 8
+# Least recently used PNGs beyond this are deleted
+PREPROCESS_DISK_CACHE_MAX_FILES = 512
+
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
 
 def preprocess_floorplan_for_sam(
     img_bgr,
@@ -85,6 +98,77 @@ def preprocess_floorplan_for_sam(
     return sam_ready
 
 
+def _prune_disk(cache_dir, max_files=PREPROCESS_DISK_CACHE_MAX_FILES):
+    files = [e for e in os.scandir(cache_dir) if e.name.endswith(".png") and not e.name.endswith(".tmp.png")]
+    if len(files) <= max_files:
+        return
+    files.sort(key=lambda e: e.stat().st_mtime)
+    for entry in files[:len(files) - max_files]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+# ----------------------------
+# Cached preprocessing
+# ----------------------------
+def image_content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def preprocess_cache_key(source_hash, bin_block_size=15, bin_c=2, dilate_kernel=3, close_kernel=7, fill_regions=True):
+    params = {
+        "bin_block_size": bin_block_size,
+        "bin_c": bin_c,
+        "dilate_kernel": dilate_kernel,
+        "close_kernel": close_kernel,
+        "fill_regions": bool(fill_regions),
+    }
+    return hashlib.sha256(f"{source_hash}:{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+
+def preprocess_floorplan_cached(img_bgr, source_hash, cache_dir=PREPROCESS_CACHE_DIR, **params):
+    """
+    preprocess_floorplan_for_sam behind a cache keyed by (source image hash,
+    parameters): an in-memory LRU first, then a PNG on disk. Returns the
+    same 3-channel image; callers must not modify it in place.
+    """
+    key = preprocess_cache_key(source_hash, **params)
+
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    disk_path = os.path.join(cache_dir, f"{key}.png")
+    gray = cv2.imread(disk_path, cv2.IMREAD_GRAYSCALE) if os.path.exists(disk_path) else None
+
+    if gray is not None:
+        sam_ready = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+        # mtime doubles as last use for pruning
+        try:
+            os.utime(disk_path)
+        except OSError:
+            pass
+    else:
+        sam_ready = preprocess_floorplan_for_sam(img_bgr, save_output=False, **params)
+        # All three channels are equal; one is enough on disk
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{disk_path}.tmp.png"
+        cv2.imwrite(tmp_path, sam_ready[:, :, 0])
+        os.replace(tmp_path, disk_path)
+        _prune_disk(cache_dir)
+
+    with _memory_cache_lock:
+        _memory_cache[key] = sam_ready
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > PREPROCESS_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+    return sam_ready
+
+
 
 # import cv2
 # import numpy as np
@@ -1,11 +1,33 @@
-import pickle
+import os
 import json
 import cv2
 import numpy as np
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from services.room_analysis.compact_mask import CompactMask
+from services.room_analysis.feature_extractor import (
+    crop_segmentation,
+    PARALLEL_MIN_MASKS,
+    default_workers,
+    get_process_pool,
+    discard_process_pool,
+)
+from services.room_analysis.mask_store import load_masks, MaskStore
+from services.room_analysis.polygon_codec import (
+    PolygonBinaryEncoder,
+    BINARY_SUFFIX,
+    POLYGON_LOD_EPSILONS,
+    write_compressed_siblings,
+    lod_path,
+    lod_entry,
+)
 
+# Masks handed to a worker process in one go
+POLYGON_CHUNK_SIZE = 64
 
-def mask_to_polygons(mask, epsilon_ratio=0.005, max_points=500, min_area=50):
+
+def mask_to_polygons(mask, epsilon_ratio=0.005, max_points=500, min_area=50, offset=(0, 0)):
     mask = mask.astype(np.uint8)
 
     # 🔹 Smooth small jagged edges
@@ -35,87 +57,343 @@ def mask_to_polygons(mask, epsilon_ratio=0.005, max_points=500, min_area=50):
         if len(approx) < 3:
             continue
 
-        polygon = approx.reshape(-1, 2).tolist()
+        polygon = (approx.reshape(-1, 2) + offset).tolist()
         polygons.append(polygon)
 
     return polygons
 
 
-def combine_masks_and_groups(
-    pkl_path: str, 
-    groups_path: str, 
-    image_path: str, 
-    output_json_path: str,
-    epsilon_ratio: float = 0.0001,
-    min_area: int = 50
-):
-    print("Loading masks pickle...")
-    with open(pkl_path, "rb") as f:
-        data = pickle.load(f)
+# ----------------------------
+# Bbox-cropped, chunked polygonization
+# ----------------------------
+def _polygonize_chunk(jobs, epsilon_ratio, min_area):
+    results = []
+    for idx, crop, x0, y0 in jobs:
+        polygons = mask_to_polygons(
+            crop,
+            epsilon_ratio=epsilon_ratio,
+            min_area=min_area,
+            offset=(x0, y0)
+        )
+        results.append((idx, polygons))
+    return results
 
-    print("Loading groups.json...")
-    with open(groups_path, "r") as f:
-        groups_data = json.load(f)
 
-    print("Reading image for dimensions...")
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Image not found at {image_path}")
+def _crop_jobs(masks, chunk_size):
+    """
+    Yield chunks of (idx, crop, x0, y0). Crops carry a one-pixel border so
+    medianBlur and findContours see exactly what they would on the full frame.
+    """
+    if isinstance(masks, MaskStore):
+        yield from _store_crop_jobs(masks, chunk_size)
+        return
 
-    image_height, image_width = image.shape[:2]
+    chunk = []
+    for idx, item in enumerate(masks):
+        if isinstance(item, CompactMask):
+            pass
+        elif isinstance(item, dict) and "segmentation" in item:
+            if not isinstance(item["segmentation"], np.ndarray):
+                continue
+        elif not isinstance(item, np.ndarray):
+            continue
 
-    # -----------------------------------
-    # Build mask_index → group_id lookup
-    # -----------------------------------
-    mask_to_group = {}
+        cropped = crop_segmentation(item, pad=1)
+        if cropped is None:
+            continue
 
-    for group_id, group_info in groups_data.items():
-        for mask_idx in group_info["mask_indices"]:
-            mask_to_group[mask_idx] = group_id
+        crop, x0, y0 = cropped
+        chunk.append((idx, crop, x0, y0))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
 
-    # -----------------------------------
-    # Convert masks
-    # -----------------------------------
-    print("Converting masks to polygons...")
+    if chunk:
+        yield chunk
+
+
+def _store_crop_jobs(store, chunk_size):
+    """_crop_jobs for a MaskStore: pad the stored crops instead of building full frames."""
+    frame_h, frame_w = store.image_shape
+    chunk = []
+    for idx in range(len(store)):
+        crop, x0, y0 = store.get_crop(idx)
+        if not crop.size:
+            continue
+
+        # Same one-pixel border crop_segmentation(pad=1) gives, clamped to the frame
+        top, left = min(y0, 1), min(x0, 1)
+        bottom = min(frame_h - (y0 + crop.shape[0]), 1)
+        right = min(frame_w - (x0 + crop.shape[1]), 1)
+        chunk.append((idx, np.pad(crop, ((top, bottom), (left, right))), x0 - left, y0 - top))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def iter_mask_polygons(masks, epsilon_ratio=0.0001, min_area=50, workers=None, chunk_size=POLYGON_CHUNK_SIZE):
+    """
+    Yield (mask_index, polygons) in mask order, polygonizing bbox crops.
+    Large mask sets are processed in chunks on the shared process pool with
+    a bounded number of chunks in flight, so results can be streamed as they arrive.
+    """
+    chunks = _crop_jobs(masks, chunk_size)
+
+    if len(masks) < PARALLEL_MIN_MASKS or workers == 1:
+        for chunk in chunks:
+            yield from _polygonize_chunk(chunk, epsilon_ratio, min_area)
+        return
 
-    masks_output = []
+    workers = workers or default_workers()
+    pool = get_process_pool(workers)
+    in_flight = deque()
+    try:
+        for chunk in chunks:
+            in_flight.append(pool.submit(_polygonize_chunk, chunk, epsilon_ratio, min_area))
+            if len(in_flight) >= workers * 2:
+                yield from in_flight.popleft().result()
 
-    for idx, item in enumerate(data):
-        print("Processing mask:", idx)
+        while in_flight:
+            yield from in_flight.popleft().result()
+    except BrokenProcessPool:
+        discard_process_pool(pool)
+        raise
+    finally:
+        # A consumer that stops early must not leave chunks queued on the shared pool
+        for future in in_flight:
+            future.cancel()
 
-        if isinstance(item, dict) and "segmentation" in item:
-            mask = item["segmentation"]
+
+class MasksPolygonsWriter:
+    """
+    Streams a masks_polygons.json payload to disk one mask at a time.
+    The file layout is identical to json.dump of the full dict.
+    With `siblings`, the compact binary variant and .gz/.br copies are
+    written next to it on close. With `lod_levels`, the coarser levels of
+    detail (masks_polygons.lod<N>.json) are streamed alongside.
+    `analysis_id` is stamped into the header for the edit log's conflict checks.
+    """
+
+    def __init__(self, path, groups_data, image_width, image_height, siblings=True, lod_levels=True, lod_epsilon=None,
+                 analysis_id=None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.count = 0
+        self.lod_epsilon = lod_epsilon
+        self._lod_writers = [
+            MasksPolygonsWriter(lod_path(path, level), groups_data, image_width, image_height, siblings, False, epsilon, analysis_id)
+            for level, epsilon in enumerate(POLYGON_LOD_EPSILONS, start=1)
+        ] if lod_levels else []
+        self._encoder = PolygonBinaryEncoder(groups_data, image_width, image_height) if siblings else None
+        header = {"image_width": image_width, "image_height": image_height}
+        if analysis_id is not None:
+            header["analysis_id"] = analysis_id
+        header["groups"] = groups_data
+        self._file = open(self.tmp_path, "w")
+        self._file.write(json.dumps(header)[:-1] + ', "masks": [')
+
+    def write_mask(self, entry):
+        for writer in self._lod_writers:
+            writer.write_mask(entry)
+        if self.lod_epsilon is not None:
+            entry = lod_entry(entry, self.lod_epsilon)
+
+        if self.count:
+            self._file.write(", ")
+        self._file.write(json.dumps(entry))
+        if self._encoder is not None:
+            self._encoder.add_mask(entry)
+        self.count += 1
+
+    def close(self):
+        self._file.write("]}")
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+        if self._encoder is not None:
+            binary_path = self.path + BINARY_SUFFIX
+            self._encoder.write(binary_path)
+            self._encoder = None
+            write_compressed_siblings(self.path)
+            write_compressed_siblings(binary_path)
+
+        # After the full-detail file, so no level is ever older than it
+        for writer in self._lod_writers:
+            writer.close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.tmp_path)
+        for writer in self._lod_writers:
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
         else:
-            mask = item
+            self.abort()
 
-        if not isinstance(mask, np.ndarray):
-            continue
 
-        polygons = mask_to_polygons(mask, epsilon_ratio=epsilon_ratio, min_area=min_area)
+def _mask_to_group_lookup(groups_data):
+    mask_to_group = {}
+    for group_id, group_info in groups_data.items():
+        for mask_idx in group_info["mask_indices"]:
+            mask_to_group[mask_idx] = group_id
+    return mask_to_group
+
 
+def collect_mask_polygons(masks, epsilon_ratio=0.0001, min_area=50, workers=None, on_chunk=None,
+                          chunk_size=POLYGON_CHUNK_SIZE):
+    """
+    {mask_index: polygons} for the masks that yield at least one polygon,
+    i.e. exactly the masks masks_polygons.json will contain. Masks that are
+    too small or have no usable contour are left out, so grouping can be
+    run on the same set. `on_chunk([(mask_index, polygons), ...])` is
+    called as batches come in.
+    """
+    mask_polygons = {}
+    chunk = []
+    for idx, polygons in iter_mask_polygons(masks, epsilon_ratio, min_area, workers, chunk_size):
         if not polygons:
             continue
+        mask_polygons[idx] = polygons
+        if on_chunk is not None:
+            chunk.append((idx, polygons))
+            if len(chunk) >= chunk_size:
+                on_chunk(chunk)
+                chunk = []
+
+    if chunk:
+        on_chunk(chunk)
+    return mask_polygons
 
-        masks_output.append({
+
+def _mask_entries(mask_polygons, groups_data):
+    mask_to_group = _mask_to_group_lookup(groups_data)
+
+    for idx, polygons in mask_polygons:
+        if not polygons:
+            continue
+        yield {
             "id": idx,
             "polygons": polygons,
             "group_id": mask_to_group.get(idx, None)
-        })
+        }
+
 
+def iter_mask_entries(masks, groups_data, epsilon_ratio=0.0001, min_area=50, workers=None, mask_polygons=None):
+    """
+    Yield masks_polygons.json mask entries ({id, polygons, group_id}) in order.
+    `mask_polygons` (from collect_mask_polygons) skips polygonizing `masks` again.
+    """
+    if mask_polygons is not None:
+        yield from _mask_entries(sorted(mask_polygons.items()), groups_data)
+    else:
+        yield from _mask_entries(iter_mask_polygons(masks, epsilon_ratio, min_area, workers), groups_data)
+
+
+def write_masks_polygons(
+    masks,
+    groups_data: dict,
+    image_width: int,
+    image_height: int,
+    output_json_path: str,
+    epsilon_ratio: float = 0.0001,
+    min_area: int = 50,
+    workers=None,
+    on_chunk=None,
+    chunk_size: int = POLYGON_CHUNK_SIZE,
+    analysis_id=None,
+    mask_polygons=None
+):
+    """
+    Polygonize masks and stream the result straight into masks_polygons.json
+    without holding the full output list in memory. Returns the mask count.
+    `on_chunk(entries)` is called with each batch of written entries, e.g. to
+    push them to clients while the rest is still being produced. With
+    `mask_polygons` (from collect_mask_polygons) those polygons are written
+    as they are.
+    """
+    chunk = []
+    with MasksPolygonsWriter(output_json_path, groups_data, image_width, image_height, analysis_id=analysis_id) as writer:
+        for entry in iter_mask_entries(masks, groups_data, epsilon_ratio, min_area, workers, mask_polygons):
+            writer.write_mask(entry)
+            if on_chunk is not None:
+                chunk.append(entry)
+                if len(chunk) >= chunk_size:
+                    on_chunk(chunk)
+                    chunk = []
+
+    if chunk:
+        on_chunk(chunk)
+
+    print(f"Converted {writer.count} masks")
+    return writer.count
+
+
+def build_masks_polygons(
+    masks,
+    groups_data: dict,
+    image_width: int,
+    image_height: int,
+    epsilon_ratio: float = 0.0001,
+    min_area: int = 50,
+    mask_polygons=None
+):
+    """
+    In-memory variant of write_masks_polygons: converts masks to polygons,
+    attaches each mask's group id and returns the masks_polygons.json payload.
+    """
+    masks_output = list(iter_mask_entries(masks, groups_data, epsilon_ratio, min_area, mask_polygons=mask_polygons))
     print(f"Converted {len(masks_output)} masks")
 
     # -----------------------------------
     # Final Output Structure
     # -----------------------------------
-    output = {
+    return {
         "image_width": image_width,
         "image_height": image_height,
         "groups": groups_data,
         "masks": masks_output
     }
 
-    with open(output_json_path, "w") as f:
-        json.dump(output, f)
 
-    print(f"Saved to {output_json_path}")
+def combine_masks_and_groups(
+    masks_path: str, 
+    groups_path: str, 
+    image_path: str, 
+    output_json_path: str,
+    epsilon_ratio: float = 0.0001,
+    min_area: int = 50
+):
+    print("Loading masks...")
+    data = load_masks(masks_path)
+
+    print("Loading groups.json...")
+    with open(groups_path, "r") as f:
+        groups_data = json.load(f)
+
+    print("Reading image for dimensions...")
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Image not found at {image_path}")
 
+    image_height, image_width = image.shape[:2]
+
+    write_masks_polygons(
+        data,
+        groups_data,
+        image_width,
+        image_height,
+        output_json_path,
+        epsilon_ratio=epsilon_ratio,
+        min_area=min_area
+    )
+
+    print(f"Saved to {output_json_path}")
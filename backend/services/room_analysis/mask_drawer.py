@@ -1,11 +1,12 @@
 import cv2
 import numpy as np
-import pickle
 import os
+from services.room_analysis.feature_extractor import crop_segmentation
+from services.room_analysis.mask_store import MaskStore, load_masks
 
-def draw_masks_on_image(image_path: str, pkl_path: str, output_path: str):
+def draw_masks_on_image(image_path: str, masks_path: str, output_path: str):
     """
-    Reads the original (or preprocessed) image and the generated SAM masks (pkl),
+    Reads the original (or preprocessed) image and the generated SAM masks (mask store or legacy pkl),
     overlays the masks as random, semi-transparent colored polygons,
     and saves the resulting overlaid image.
     This is primarily used for debugging/visualization.
@@ -13,8 +14,8 @@ def draw_masks_on_image(image_path: str, pkl_path: str, output_path: str):
     if not os.path.exists(image_path):
         print(f"[Debug] Could not find image at {image_path}")
         return
-    if not os.path.exists(pkl_path):
-        print(f"[Debug] Could not find mask pkl at {pkl_path}")
+    if not os.path.exists(masks_path):
+        print(f"[Debug] Could not find masks at {masks_path}")
         return
 
     # Load image
@@ -23,20 +24,133 @@ def draw_masks_on_image(image_path: str, pkl_path: str, output_path: str):
         print(f"[Debug] Failed to read image with cv2: {image_path}")
         return
 
-    # Load masks
-    with open(pkl_path, "rb") as f:
-        masks_data = pickle.load(f)
-
-    # Overlay masks
-    for mask_obj in masks_data:
-        # mask shape from SAM is typically under 'segmentation' and is a boolean ndarray
-        segmentation = mask_obj.get("segmentation")
-        if segmentation is not None:
-            # Generate random color
-            color = np.random.randint(0, 255, (3,), dtype=np.uint8).tolist()
-            # Apply color overlay with 50% opacity onto the True pixels of the mask
-            img[segmentation] = img[segmentation] * 0.5 + np.array(color) * 0.5
+    # Load masks (a mask store is read crop by crop, never as full frames)
+    if masks_path.endswith(".pkl"):
+        masks_data = load_masks(masks_path)
+        img = draw_masks_overlay(img, masks_data)
+    else:
+        with MaskStore(masks_path) as store:
+            img = draw_masks_overlay(img, store)
 
     # Save output
     cv2.imwrite(output_path, img)
     print(f"[Debug] Saved mask overlay image to {output_path}")
+
+
+def _iter_crops(masks):
+    if hasattr(masks, "iter_crops"):
+        yield from masks.iter_crops()
+        return
+    for mask_obj in masks:
+        if isinstance(mask_obj, dict) and mask_obj.get("segmentation") is None:
+            yield None
+            continue
+        yield crop_segmentation(mask_obj)
+
+
+def build_label_map(masks, shape, smallest_on_top=False, mask_ids=None):
+    """
+    Paint masks into a single int32 label map (0 = background, i + 1 = mask i).
+    Later masks win where masks overlap, or, with `smallest_on_top`, smaller
+    masks win (the most specific mask for picking). Only each mask's bbox
+    crop is touched. Accepts CompactMasks, SAM-style dicts, bare arrays or
+    a MaskStore. With `mask_ids`, only those indices are painted.
+    """
+    label_map = np.zeros(shape[:2], dtype=np.int32)
+
+    crops = enumerate(_iter_crops(masks))
+    if mask_ids is not None:
+        mask_ids = set(mask_ids)
+        crops = ((idx, c) for idx, c in crops if idx in mask_ids)
+    if smallest_on_top:
+        crops = [(idx, c) for idx, c in crops if c is not None]
+        crops.sort(key=lambda item: np.count_nonzero(item[1][0]), reverse=True)
+
+    for idx, cropped in crops:
+        if cropped is None:
+            continue
+        crop, x0, y0 = cropped
+        window = label_map[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]]
+        window[crop] = idx + 1
+
+    return label_map
+
+
+def label_map_from_polygons(mask_entries, shape):
+    """
+    Label map (0 = background, id + 1 = mask id) rasterised from
+    masks_polygons.json entries, smallest masks on top.
+    """
+    label_map = np.zeros(shape[:2], dtype=np.int32)
+    filled = []
+    for entry in mask_entries:
+        polys = [np.asarray(p, dtype=np.int32).reshape(-1, 2) for p in entry.get("polygons") or [] if len(p) >= 3]
+        if polys:
+            filled.append((sum(abs(cv2.contourArea(p)) for p in polys), entry["id"], polys))
+
+    for _, mask_id, polys in sorted(filled, key=lambda item: item[0], reverse=True):
+        cv2.fillPoly(label_map, polys, int(mask_id) + 1)
+
+    return label_map
+
+
+# ----------------------------
+# Label map export (picking texture for the editor)
+# ----------------------------
+LABEL_MAP_FILENAME = "masks_label_map.png"
+
+
+def encode_label_map(label_map):
+    """
+    Pack labels into an 8-bit RGB image (label = R + G * 256 + B * 65536),
+    which browsers decode losslessly into a canvas / texture. Returned in
+    OpenCV's BGR channel order.
+    """
+    labels = label_map.astype(np.uint32)
+    rgb = np.empty(label_map.shape[:2] + (3,), dtype=np.uint8)
+    rgb[..., 2] = labels & 0xFF
+    rgb[..., 1] = (labels >> 8) & 0xFF
+    rgb[..., 0] = (labels >> 16) & 0xFF
+    return rgb
+
+
+def decode_label_map(bgr):
+    """Inverse of encode_label_map"""
+    bgr = bgr.astype(np.int32)
+    return bgr[..., 2] | (bgr[..., 1] << 8) | (bgr[..., 0] << 16)
+
+
+def write_label_map(path, label_map):
+    tmp_path = f"{path}.tmp.png"
+    cv2.imwrite(tmp_path, encode_label_map(label_map), [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    os.replace(tmp_path, path)
+    return path
+
+
+def random_color_lut(count, seed=None):
+    """(count + 1, 3) uint8 colour table; row 0 is the background and unused"""
+    rng = np.random.default_rng(seed)
+    lut = rng.integers(0, 255, size=(count + 1, 3), dtype=np.uint8)
+    lut[0] = 0
+    return lut
+
+
+def overlay_label_map(img, label_map, lut, alpha=0.5):
+    """
+    Blend `lut[label]` over every labelled pixel of a BGR image in one pass
+    (modified in place) and return it.
+    """
+    colors = lut[label_map]
+    blended = cv2.addWeighted(img, 1.0 - alpha, colors, alpha, 0.0)
+    np.copyto(img, blended, where=(label_map > 0)[..., None])
+    return img
+
+
+def draw_masks_overlay(img, masks_data, seed=None):
+    """
+    In-memory variant of draw_masks_on_image: overlays SAM masks on a BGR image
+    (modified in place) with a random 50% colour per mask and returns it.
+    """
+    label_map = build_label_map(masks_data, img.shape)
+    lut = random_color_lut(int(label_map.max()), seed=seed)
+    return overlay_label_map(img, label_map, lut)
@@ -0,0 +1,342 @@
+"""
+Incremental edits for a room's masks_polygons.json.
+
+Edits are validated against a revision number, appended to an edit log
+(masks_edits.jsonl) next to the snapshot, and folded into the snapshot every
+COMPACT_EVERY revisions. The current state is the snapshot plus any log entries
+newer than the snapshot's revision; the most recently used states are cached
+in memory.
+
+Revisions restart with every analysis, so each snapshot also carries the
+`analysis_id` of the analysis that produced it. Clients that send it back as
+`base_analysis_id` get a conflict instead of editing a newer analysis that
+happens to be at the same revision.
+
+Supported operations (one dict each, applied in order):
+    {"op": "add_mask",     "mask": {"id"?, "polygons", "group_id"?}}
+    {"op": "delete_mask",  "id"}
+    {"op": "update_mask",  "id", "polygons"?, "group_id"?}
+    {"op": "regroup",      "mask_ids": [...], "group_id": str | None}
+    {"op": "create_group", "group": {"id", "name"?, "code"?, "color"?}}
+    {"op": "rename_group", "group_id", "name"?, "code"?, "color"?}
+    {"op": "delete_group", "group_id"}
+"""
+
+import copy
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from services.room_analysis.polygon_codec import write_polygon_artifacts
+
+EDIT_LOG_FILENAME = "masks_edits.jsonl"
+COMPACT_EVERY = 50
+# Rooms whose current state stays in memory (each holds a full polygon payload)
+STATE_CACHE_SIZE = 16
+# Per-file locks are striped so their number stays fixed
+LOCK_STRIPES = 64
+
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+_state_cache = OrderedDict()
+_state_cache_lock = threading.Lock()
+
+
+class MaskEditError(ValueError):
+    """An operation that cannot be applied to the current masks."""
+
+
+class MaskEditConflict(Exception):
+    """The client's base revision is not the current revision."""
+
+    def __init__(self, current_revision, current_analysis_id=None):
+        super().__init__(f"Revision conflict: current revision is {current_revision}")
+        self.current_revision = current_revision
+        self.current_analysis_id = current_analysis_id
+
+
+def check_base_revision(payload, base_revision, base_analysis_id=None):
+    """Raise MaskEditConflict unless (base_analysis_id, base_revision) names `payload`'s state."""
+    analysis_id = payload.get("analysis_id")
+    if base_revision != payload.get("revision", 0) or (
+        base_analysis_id is not None and base_analysis_id != analysis_id
+    ):
+        raise MaskEditConflict(payload.get("revision", 0), analysis_id)
+
+
+def _lock_for(json_path):
+    return _locks[zlib.crc32(json_path.encode()) % LOCK_STRIPES]
+
+
+def _cached_state(json_path):
+    with _state_cache_lock:
+        state = _state_cache.get(json_path)
+        if state is not None:
+            _state_cache.move_to_end(json_path)
+        return state
+
+
+def _cache_state(json_path, state):
+    with _state_cache_lock:
+        _state_cache[json_path] = state
+        _state_cache.move_to_end(json_path)
+        while len(_state_cache) > STATE_CACHE_SIZE:
+            _state_cache.popitem(last=False)
+
+
+def _forget_state(json_path):
+    with _state_cache_lock:
+        _state_cache.pop(json_path, None)
+
+
+def _log_path(json_path):
+    return os.path.join(os.path.dirname(json_path), EDIT_LOG_FILENAME)
+
+
+# ----------------------------
+# Operations
+# ----------------------------
+def _mask_index(payload):
+    return {m["id"]: i for i, m in enumerate(payload["masks"])}
+
+
+def _set_mask_group(payload, mask, group_id):
+    groups = payload["groups"]
+    if group_id is not None and group_id not in groups:
+        raise MaskEditError(f"Unknown group {group_id}")
+
+    old = mask.get("group_id")
+    if old in groups and mask["id"] in groups[old].get("mask_indices", []):
+        groups[old]["mask_indices"].remove(mask["id"])
+    if group_id is not None and mask["id"] not in groups[group_id].setdefault("mask_indices", []):
+        groups[group_id]["mask_indices"].append(mask["id"])
+    mask["group_id"] = group_id
+
+
+def apply_ops(payload, ops):
+    """Apply edit operations to a masks_polygons payload in place."""
+    payload.setdefault("groups", {})
+    payload.setdefault("masks", [])
+    groups = payload["groups"]
+
+    for op in ops:
+        kind = op.get("op")
+        index = _mask_index(payload)
+
+        if kind == "add_mask":
+            mask = dict(op.get("mask") or {})
+            if "id" not in mask or mask["id"] is None:
+                mask["id"] = max(index, default=-1) + 1
+            if mask["id"] in index:
+                raise MaskEditError(f"Mask {mask['id']} already exists")
+            if not mask.get("polygons"):
+                raise MaskEditError("add_mask requires polygons")
+            group_id = mask.pop("group_id", None)
+            mask["group_id"] = None
+            payload["masks"].append(mask)
+            _set_mask_group(payload, mask, group_id)
+
+        elif kind == "delete_mask":
+            if op.get("id") not in index:
+                raise MaskEditError(f"Unknown mask {op.get('id')}")
+            mask = payload["masks"].pop(index[op["id"]])
+            _set_mask_group(payload, mask, None)
+
+        elif kind == "update_mask":
+            if op.get("id") not in index:
+                raise MaskEditError(f"Unknown mask {op.get('id')}")
+            mask = payload["masks"][index[op["id"]]]
+            if "polygons" in op:
+                mask["polygons"] = op["polygons"]
+            if "group_id" in op:
+                _set_mask_group(payload, mask, op["group_id"])
+
+        elif kind == "regroup":
+            group_id = op.get("group_id")
+            for mask_id in op.get("mask_ids", []):
+                if mask_id not in index:
+                    raise MaskEditError(f"Unknown mask {mask_id}")
+                _set_mask_group(payload, payload["masks"][index[mask_id]], group_id)
+
+        elif kind == "create_group":
+            group = dict(op.get("group") or {})
+            if not group.get("id") or group["id"] in groups:
+                raise MaskEditError(f"Invalid or duplicate group id {group.get('id')}")
+            group.setdefault("name", group["id"])
+            group.setdefault("code", "")
+            group["mask_indices"] = []
+            groups[group["id"]] = group
+
+        elif kind == "rename_group":
+            group = groups.get(op.get("group_id"))
+            if group is None:
+                raise MaskEditError(f"Unknown group {op.get('group_id')}")
+            for field in ("name", "code", "color"):
+                if field in op:
+                    group[field] = op[field]
+
+        elif kind == "delete_group":
+            group_id = op.get("group_id")
+            if group_id not in groups:
+                raise MaskEditError(f"Unknown group {group_id}")
+            for mask in payload["masks"]:
+                if mask.get("group_id") == group_id:
+                    mask["group_id"] = None
+            del groups[group_id]
+
+        else:
+            raise MaskEditError(f"Unsupported operation {kind!r}")
+
+    return payload
+
+
+# ----------------------------
+# Snapshot + log
+# ----------------------------
+def _snapshot_key(json_path):
+    if not os.path.exists(json_path):
+        return None
+    st = os.stat(json_path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _load_state(json_path):
+    """Snapshot plus pending log entries, cached until the snapshot changes."""
+    snapshot_key = _snapshot_key(json_path)
+    cached = _cached_state(json_path)
+    if cached and cached["snapshot_key"] == snapshot_key:
+        return cached
+
+    payload = {"groups": {}, "masks": []}
+    if snapshot_key is not None:
+        with open(json_path) as f:
+            payload = json.load(f)
+    revision = payload.get("revision", 0)
+
+    pending = 0
+    log_path = _log_path(json_path)
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["revision"] <= revision:
+                    continue
+                apply_ops(payload, entry["ops"])
+                revision = entry["revision"]
+                pending += 1
+
+    payload["revision"] = revision
+    state = {"payload": payload, "revision": revision, "pending": pending, "snapshot_key": snapshot_key}
+    _cache_state(json_path, state)
+    return state
+
+
+def _write_snapshot(json_path, state):
+    write_polygon_artifacts(json_path, state["payload"])
+    log_path = _log_path(json_path)
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    state["pending"] = 0
+    state["snapshot_key"] = _snapshot_key(json_path)
+
+
+def get_room_masks(json_path):
+    """Current masks/groups (snapshot + pending edits) and their revision."""
+    with _lock_for(json_path):
+        # Copy so later edits cannot mutate a payload that is still being serialised
+        return copy.deepcopy(_load_state(json_path)["payload"])
+
+
+def get_room_masks_revision(json_path):
+    """Current revision without copying the payload (cheap once cached)."""
+    with _lock_for(json_path):
+        return _load_state(json_path)["revision"]
+
+
+def get_room_mask_ids(json_path):
+    """Ids of the current masks (snapshot + pending edits), without copying the payload."""
+    with _lock_for(json_path):
+        return {m["id"] for m in _load_state(json_path)["payload"]["masks"]}
+
+
+def get_room_masks_version(json_path):
+    """
+    Token naming the current masks: changes with every edit and with every
+    new analysis (whose revisions start over), e.g. for cache-busting URLs.
+    """
+    with _lock_for(json_path):
+        state = _load_state(json_path)
+        analysis_id = state["payload"].get("analysis_id")
+        return f"{analysis_id}-{state['revision']}" if analysis_id else str(state["revision"])
+
+
+def apply_room_mask_edits(json_path, base_revision, ops, compact_every=COMPACT_EVERY, base_analysis_id=None):
+    """
+    Apply `ops` if `base_revision` (of `base_analysis_id`, when given) is
+    current, log them and return the new revision. Raises MaskEditConflict
+    or MaskEditError.
+    """
+    with _lock_for(json_path):
+        state = _load_state(json_path)
+        check_base_revision(state["payload"], base_revision, base_analysis_id)
+
+        try:
+            apply_ops(state["payload"], ops)
+        except Exception:
+            # The cached payload may be half-edited; rebuild it from disk next time
+            _forget_state(json_path)
+            raise
+
+        state["revision"] += 1
+        state["payload"]["revision"] = state["revision"]
+        with open(_log_path(json_path), "a") as f:
+            f.write(json.dumps({
+                "revision": state["revision"],
+                "ops": ops,
+                "at": datetime.now(timezone.utc).isoformat()
+            }) + "\n")
+        state["pending"] += 1
+
+        if state["pending"] >= compact_every:
+            _write_snapshot(json_path, state)
+
+        return state["revision"]
+
+
+def compact_room_masks(json_path):
+    """Fold pending log entries into the snapshot (no-op if there are none)."""
+    with _lock_for(json_path):
+        if not os.path.exists(json_path) and not os.path.exists(_log_path(json_path)):
+            return
+        state = _load_state(json_path)
+        if state["pending"]:
+            _write_snapshot(json_path, state)
+
+
+def replace_room_masks(json_path, groups, masks):
+    """Full rewrite (PUT): new snapshot at the next revision, log cleared."""
+    with _lock_for(json_path):
+        state = _load_state(json_path)
+        payload = {
+            key: state["payload"][key]
+            for key in ("image_width", "image_height", "analysis_id")
+            if key in state["payload"]
+        }
+        payload.update({"groups": groups, "masks": masks, "revision": state["revision"] + 1})
+        state = {"payload": payload, "revision": payload["revision"], "pending": 0, "snapshot_key": None}
+        _write_snapshot(json_path, state)
+        _cache_state(json_path, state)
+        return state["revision"]
+
+
+def reset_room_mask_edits(json_path):
+    """Drop the edit log and cached state, e.g. before a fresh analysis overwrites the snapshot."""
+    with _lock_for(json_path):
+        log_path = _log_path(json_path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        _forget_state(json_path)
@@ -1,16 +1,28 @@
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
 import cv2
 import numpy as np
-import pickle
 import os
 from db.database import BASE_DIR
+from services.room_analysis.compact_mask import CompactMask
+from services.room_analysis.embedding_cache import CachedSamPredictor, embedding_key, has_embedding
+from services.room_analysis.mask_store import write_mask_store
+from services.room_analysis.prompt_sampler import adaptive_point_grid, ink_mask
+from services.room_analysis.mask_upsampler import downscale_for_sam, upsample_mask
 
 class MaskGenerator:
-    def __init__(self, checkpoint_path=None, model_type="vit_h"):
+    def __init__(self, checkpoint_path=None, model_type="vit_h", adaptive_points=True, max_side=None):
         if checkpoint_path is None:
             checkpoint_path = os.path.join(BASE_DIR, "services", "room_analysis", "sam_vit_h_4b8939.pth")
         self.checkpoint_path = checkpoint_path
         self.model_type = model_type
+        # Extra SamAutomaticMaskGenerator arguments (SAM defaults when empty)
+        self.generator_params = {}
+        # RLE output lets masks go straight into bbox crops, never full frames
+        self.output_mode = "uncompressed_rle"
+        # Prompt SAM at ink components / enclosed regions instead of a uniform grid
+        self.adaptive_points = adaptive_points
+        # Run SAM on a copy whose long side is at most this (None = native resolution)
+        self.max_side = max_side
         self.sam = None
         self.mask_generator = None
 
@@ -21,9 +33,47 @@ class MaskGenerator:
             
         print(f"Loading SAM model ({self.model_type})...")
         self.sam = sam_model_registry[self.model_type](checkpoint=self.checkpoint_path)
-        self.mask_generator = SamAutomaticMaskGenerator(self.sam)
+        params = dict(self.generator_params, output_mode=self.output_mode)
+        self.mask_generator = self._with_cached_predictor(SamAutomaticMaskGenerator(self.sam, **params))
         print("Model loaded successfully!")
 
+    @property
+    def model_tag(self):
+        """Identifies the image encoder's weights in the embedding cache"""
+        return f"{self.model_type}:{os.path.basename(self.checkpoint_path)}"
+
+    def _with_cached_predictor(self, generator):
+        generator.predictor = CachedSamPredictor(self.sam, self.model_tag)
+        return generator
+
+    def sam_input(self, image_rgb):
+        """The image SAM's encoder actually sees for `image_rgb`"""
+        if self.max_side and max(image_rgb.shape[:2]) > self.max_side:
+            return downscale_for_sam(image_rgb, self.max_side)
+        return image_rgb
+
+    def prewarm_embedding(self, image_rgb):
+        """
+        Compute and cache the image embedding generate_masks will need for
+        `image_rgb`. Returns False if it was already cached.
+        """
+        image = self.sam_input(image_rgb)
+        if has_embedding(embedding_key(self.model_tag, image)):
+            return False
+        CachedSamPredictor(self.sam, self.model_tag).set_image(image)
+        return True
+
+    def cache_params(self, do_merge=True):
+        """Everything that changes the masks produced for a given image (for result caching)"""
+        return {
+            "model_type": self.model_type,
+            "checkpoint": os.path.basename(self.checkpoint_path),
+            "generator_params": self.generator_params,
+            "do_merge": bool(do_merge),
+            "adaptive_points": bool(self.adaptive_points),
+            "max_side": self.max_side,
+        }
+
     def boxes_are_close(self, bbox1, bbox2, distance_threshold=25):
         """
         bbox = [x, y, w, h]
@@ -52,59 +102,111 @@ class MaskGenerator:
 
     def merge_adjacent_masks(self, masks, distance_threshold=25, min_area=100):
         """
-        Merge masks that belong to the same symbolic object
+        Merge masks that belong to the same symbolic object.
+        Works on CompactMasks (SAM dicts are converted); every pixel test
+        only looks at the overlap of the two masks' bboxes.
         """
+        masks = [m if isinstance(m, CompactMask) else CompactMask.from_sam(m) for m in masks]
+        masks = [m for m in masks if m is not None]
+
         merged = []
         used = set()
 
         # Sort masks by area to process larger ones first
-        masks = sorted(masks, key=lambda x: x['area'], reverse=True)
+        masks = sorted(masks, key=lambda x: x.area, reverse=True)
 
         for i, mask1 in enumerate(masks):
             if i in used:
                 continue
 
-            base_mask = mask1['segmentation'].copy()
-            base_bbox = mask1['bbox']
+            base_mask = mask1
+            base_bbox = mask1.bbox
             used.add(i)
 
             for j, mask2 in enumerate(masks[i + 1:], i + 1):
-                if j in used or mask2['area'] < min_area:
+                if j in used or mask2.area < min_area:
                     continue
 
-                if not self.boxes_are_close(base_bbox, mask2['bbox'], distance_threshold):
+                if not self.boxes_are_close(base_bbox, mask2.bbox, distance_threshold):
                     continue
 
-                # Pixel-level touch / near-touch check
-                overlap_pixels = np.logical_and(base_mask, mask2['segmentation']).sum()
-                if overlap_pixels > 0:
-                    base_mask |= mask2['segmentation']
-                    used.add(j)
-                    continue
-
-                # Check for tiny gaps (dilation)
-                dilated = cv2.dilate(base_mask.astype(np.uint8), np.ones((3,3), np.uint8), iterations=1)
-                if np.logical_and(dilated.astype(bool), mask2['segmentation']).any():
-                    base_mask |= mask2['segmentation']
+                # Pixel-level touch / near-touch check (3x3 dilation covers overlap and tiny gaps)
+                if base_mask.touches(mask2, distance=1):
+                    base_mask = base_mask | mask2
                     used.add(j)
 
-            # Recalculate bbox for merged mask
-            y_indices, x_indices = np.where(base_mask)
-            if len(x_indices) > 0:
-                x_min, x_max = x_indices.min(), x_indices.max()
-                y_min, y_max = y_indices.min(), y_indices.max()
-                new_bbox = [int(x_min), int(y_min), int(x_max - x_min), int(y_max - y_min)]
-                
-                merged.append({
-                    'segmentation': base_mask,
-                    'area': int(base_mask.sum()),
-                    'bbox': new_bbox
-                })
+            # Merge output carries geometry only (SAM's scores no longer apply)
+            merged.append(CompactMask(base_mask.crop, base_mask.x0, base_mask.y0, base_mask.frame_shape))
 
         return merged
 
-    def process_image(self, image_path, output_pkl_path, do_merge=True):
-        """Main pipeline: Load image -> Generate Masks -> [Merge] -> Save PKL"""
+    def _sam_masks(self, image_rgb):
+        """Run SAM and decode its RLE output straight into CompactMasks"""
+        masks = (CompactMask.from_sam(m) for m in self._generator_for(image_rgb).generate(image_rgb))
+        return [m for m in masks if m is not None]
+
+    def _generator_for(self, image_rgb):
+        """The shared generator, or a per-image one prompted with adaptive points"""
+        if not self.adaptive_points:
+            # Own predictor per call: one loaded model may serve several threads
+            params = dict(self.generator_params, output_mode=self.output_mode)
+            return self._with_cached_predictor(SamAutomaticMaskGenerator(self.sam, **params))
+
+        points = adaptive_point_grid(image_rgb)
+        print(f"Prompting SAM with {len(points)} adaptive points")
+        params = {k: v for k, v in self.generator_params.items() if k not in ("points_per_side", "point_grids", "crop_n_layers", "output_mode")}
+        # Cheap: the generator only wraps the already loaded model
+        return self._with_cached_predictor(SamAutomaticMaskGenerator(
+            self.sam, points_per_side=None, point_grids=[points], output_mode=self.output_mode, **params
+        ))
+
+    def generate_masks(self, image_rgb, do_merge=True):
+        """Generate [and merge] masks for an in-memory RGB image, as CompactMasks"""
+        if self.max_side and max(image_rgb.shape[:2]) > self.max_side:
+            return self.generate_masks_downscaled(image_rgb, do_merge=do_merge)
+
+        masks = self._sam_masks(image_rgb)
+
+        if do_merge:
+            print(f"Merging adjacent masks (initial count: {len(masks)})...")
+            masks = self.merge_adjacent_masks(masks)
+            print(f"Final mask count: {len(masks)}")
+
+        return masks
+
+    def generate_masks_downscaled(self, image_rgb, do_merge=True):
+        """
+        Run SAM (and the merge) on a copy scaled down to `max_side`, then
+        upsample each mask inside its bbox with its boundary snapped to the
+        full-resolution ink. SAM's own output stays at the reduced size.
+        """
+        small = self.sam_input(image_rgb)
+        scale = small.shape[1] / image_rgb.shape[1]
+        print(f"Generating masks at {small.shape[1]}x{small.shape[0]} (scale {scale:.2f})...")
+
+        masks = self._sam_masks(small)
+        if do_merge:
+            print(f"Merging adjacent masks (initial count: {len(masks)})...")
+            masks = self.merge_adjacent_masks(
+                masks,
+                distance_threshold=max(25 * scale, 1),
+                min_area=max(int(100 * scale * scale), 1)
+            )
+
+        ink = ink_mask(image_rgb)
+        masks.reverse()
+        upsampled = []
+        while masks:
+            # Drop each low-resolution mask as soon as it has been upsampled
+            full = upsample_mask(masks.pop(), image_rgb.shape, ink)
+            if full is not None:
+                upsampled.append(full)
+
+        print(f"Final mask count: {len(upsampled)}")
+        return upsampled
+
+    def process_image(self, image_path, output_store_path, do_merge=True):
+        """Main pipeline: Load image -> Generate Masks -> [Merge] -> Save mask store"""
         # Load image
         image = cv2.imread(image_path)
         if image is None:
@@ -112,20 +214,11 @@ class MaskGenerator:
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
         print(f"Generating masks for {image_path}...")
-        masks = self.mask_generator.generate(image)
-        
-        if do_merge:
-            print(f"Merging adjacent masks (initial count: {len(masks)})...")
-            masks = self.merge_adjacent_masks(masks)
-            print(f"Final mask count: {len(masks)}")
+        masks = self.generate_masks(image, do_merge=do_merge)
 
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(output_pkl_path), exist_ok=True)
-        
-        # Save to PKL
-        with open(output_pkl_path, 'wb') as f:
-            pickle.dump(masks, f)
-        print(f"Successfully saved masks to {output_pkl_path}")
+        # Save to compact mask store (creates the directory if needed)
+        write_mask_store(output_store_path, masks, image_shape=image.shape[:2])
+        print(f"Successfully saved masks to {output_store_path}")
 
 if __name__ == "__main__":
     # Example usage
@@ -134,9 +227,9 @@ if __name__ == "__main__":
     
     # Customize these paths as needed
     INPUT_IMAGE = "demo_preprocessed.png"
-    OUTPUT_PKL = "generated_masks/masksnew.pkl"
+    OUTPUT_STORE = "generated_masks/masksnew.mstore"
     
     if os.path.exists(INPUT_IMAGE):
-        generator.process_image(INPUT_IMAGE, OUTPUT_PKL)
+        generator.process_image(INPUT_IMAGE, OUTPUT_STORE)
     else:
         print(f"Please ensure {INPUT_IMAGE} exists to run the example.")
@@ -0,0 +1,246 @@
+"""
+Compact on-disk storage for SAM masks.
+
+Each mask is stored as its bbox crop, bit-packed and zlib-compressed, in a single
+file with a JSON index at the end:
+
+    [MAGIC][record 0][record 1]...[index JSON][index offset u64][index length u64][INDEX_MAGIC]
+
+The index holds the frame size and, per mask, the record offset/length, bbox,
+crop shape, area and any scalar SAM metadata (predicted_iou, stability_score...).
+Individual masks can be read without loading the rest of the file.
+"""
+
+import json
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from services.room_analysis.compact_mask import CompactMask
+from services.room_analysis.feature_extractor import crop_segmentation, extract_crop_jobs, empty_features
+
+MAGIC = b"MSTORE1\0"
+INDEX_MAGIC = b"MSTOREIX"
+FOOTER = struct.Struct("<QQ8s")
+
+MASK_STORE_FILENAME = "masks.mstore"
+
+
+def _scalar_meta(mask):
+    meta = {}
+    for key, value in mask.items():
+        if key in ("segmentation", "bbox", "area"):
+            continue
+        if isinstance(value, (bool, int, float, str)) or value is None:
+            meta[key] = value
+        elif isinstance(value, np.generic):
+            meta[key] = value.item()
+        elif isinstance(value, (list, tuple)) and len(value) <= 16:
+            meta[key] = [v.item() if isinstance(v, np.generic) else v for v in value]
+    return meta
+
+
+def write_mask_store(path, masks, image_shape=None, compress_level=1):
+    """
+    Write masks (CompactMasks, SAM-style dicts or bare boolean arrays) to a mask store.
+    The file is written to a temporary sibling and moved into place.
+    """
+    entries = []
+    tmp_path = f"{path}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+
+        for mask in masks:
+            if image_shape is None:
+                if isinstance(mask, CompactMask):
+                    image_shape = mask.frame_shape
+                else:
+                    seg = mask["segmentation"] if isinstance(mask, dict) else mask
+                    image_shape = seg.shape[:2]
+
+            cropped = crop_segmentation(mask)
+            if cropped is None:
+                crop, x0, y0 = np.zeros((0, 0), dtype=bool), 0, 0
+            else:
+                crop, x0, y0 = cropped
+
+            payload = zlib.compress(np.packbits(crop, axis=None).tobytes(), compress_level)
+            offset = f.tell()
+            f.write(payload)
+
+            crop_h, crop_w = crop.shape
+            if isinstance(mask, CompactMask):
+                area, meta = mask.area, _scalar_meta(mask.meta)
+            elif isinstance(mask, dict):
+                area, meta = mask.get("area"), _scalar_meta(mask)
+            else:
+                area, meta = None, {}
+            entries.append({
+                "offset": offset,
+                "length": len(payload),
+                "bbox": [int(x0), int(y0), max(crop_w - 1, 0), max(crop_h - 1, 0)],
+                "shape": [int(crop_h), int(crop_w)],
+                "area": int(area) if area is not None else int(np.count_nonzero(crop)),
+                "meta": meta,
+            })
+
+        height, width = image_shape if image_shape is not None else (0, 0)
+        index = json.dumps({
+            "version": 1,
+            "image_width": int(width),
+            "image_height": int(height),
+            "masks": entries,
+        }).encode("utf-8")
+
+        index_offset = f.tell()
+        f.write(index)
+        f.write(FOOTER.pack(index_offset, len(index), INDEX_MAGIC))
+
+    os.replace(tmp_path, path)
+    return path
+
+
+class MaskStore:
+    """Random-access reader for a mask store file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "rb")
+
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError(f"Not a mask store: {path}")
+
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != INDEX_MAGIC:
+            self._file.close()
+            raise ValueError(f"Mask store index missing or truncated: {path}")
+
+        self._file.seek(index_offset)
+        index = json.loads(self._file.read(index_length))
+        self.entries = index["masks"]
+        self.image_width = index["image_width"]
+        self.image_height = index["image_height"]
+
+    @property
+    def image_shape(self):
+        return self.image_height, self.image_width
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def get_crop(self, idx):
+        """Return (crop, x0, y0) for mask `idx` without building the full frame."""
+        entry = self.entries[idx]
+        with self._lock:
+            self._file.seek(entry["offset"])
+            payload = self._file.read(entry["length"])
+
+        crop_h, crop_w = entry["shape"]
+        bits = np.unpackbits(np.frombuffer(zlib.decompress(payload), dtype=np.uint8), count=crop_h * crop_w)
+        crop = bits.reshape(crop_h, crop_w).astype(bool)
+        return crop, entry["bbox"][0], entry["bbox"][1]
+
+    def get_compact(self, idx):
+        """Return mask `idx` as a CompactMask (None if it is empty)."""
+        entry = self.entries[idx]
+        if not entry["area"]:
+            return None
+        crop, x0, y0 = self.get_crop(idx)
+        return CompactMask(crop, x0, y0, self.image_shape, dict(entry["meta"]), entry["area"])
+
+    def get_mask(self, idx):
+        """Return mask `idx` as a SAM-style dict with a full-frame segmentation."""
+        entry = self.entries[idx]
+        crop, x0, y0 = self.get_crop(idx)
+
+        seg = np.zeros(self.image_shape, dtype=bool)
+        seg[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+
+        mask = dict(entry["meta"])
+        mask.update({"segmentation": seg, "area": entry["area"], "bbox": list(entry["bbox"])})
+        return mask
+
+    def __getitem__(self, idx):
+        return self.get_mask(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.get_mask(idx)
+
+    def iter_crops(self):
+        for idx in range(len(self)):
+            yield self.get_crop(idx)
+
+    def extract_features(self, workers=None):
+        """
+        Per-mask features (see feature_extractor.extract_features) computed
+        from the stored crops, without building full-frame masks.
+        """
+        jobs, empty = [], set()
+        for idx, entry in enumerate(self.entries):
+            if not entry["area"]:
+                empty.add(idx)
+                continue
+            crop, x0, y0 = self.get_crop(idx)
+            jobs.append((crop, x0, y0, entry["area"], entry["bbox"]))
+
+        results = iter(extract_crop_jobs(jobs, workers))
+        return [empty_features() if idx in empty else next(results) for idx in range(len(self))]
+
+
+def load_masks(path):
+    """
+    Load every mask from either a mask store or a legacy masks.pkl.
+    Returns a list of SAM-style dicts.
+    """
+    if path.endswith(".pkl"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    with MaskStore(path) as store:
+        return list(store)
+
+
+def convert_pkl_to_store(pkl_path, store_path=None):
+    """Convert a legacy masks.pkl into a mask store next to it (or at store_path)."""
+    if store_path is None:
+        store_path = os.path.join(os.path.dirname(pkl_path), MASK_STORE_FILENAME)
+
+    with open(pkl_path, "rb") as f:
+        masks = pickle.load(f)
+
+    write_mask_store(store_path, masks)
+    return store_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert masks.pkl files into compact mask stores.")
+    parser.add_argument("pkl_paths", nargs="+", help="masks.pkl files to convert")
+    parser.add_argument("--delete", action="store_true", help="Remove each .pkl after a successful conversion")
+    args = parser.parse_args()
+
+    for pkl in args.pkl_paths:
+        out = convert_pkl_to_store(pkl)
+        print(f"[MaskStore] {pkl} ({os.path.getsize(pkl)} bytes) -> {out} ({os.path.getsize(out)} bytes)")
+        if args.delete:
+            os.remove(pkl)
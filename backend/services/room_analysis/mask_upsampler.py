@@ -0,0 +1,67 @@
+"""
+Bring masks generated on a downscaled image back to native resolution.
+
+Each mask is resized inside its own (slightly padded) bbox only. Bilinear
+upsampling leaves a soft transition band about one low-resolution pixel
+wide along the boundary; inside that band every pixel is snapped to the
+original image's ink: a mask that is mostly ink (a symbol's strokes) keeps
+the ink pixels, a mask that is mostly blank (a room, a fixture's inside)
+keeps the blank ones. Boundaries therefore land on the real ink edges.
+"""
+
+import cv2
+import numpy as np
+
+from services.room_analysis.compact_mask import CompactMask
+
+# Low-resolution pixels of context around each mask's bbox
+UPSAMPLE_MARGIN = 2
+
+_RESCALED_KEYS = ("point_coords", "crop_box")
+
+
+def downscale_for_sam(image, max_side):
+    """Copy of `image` whose long side is at most `max_side` (returned as is if already small)."""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def upsample_mask(mask, full_shape, ink=None, margin=UPSAMPLE_MARGIN):
+    """
+    CompactMask at low resolution -> the same mask in a frame of
+    `full_shape`, boundary-snapped to `ink` (a full-resolution boolean
+    foreground map) when given. Returns None if the mask vanishes.
+    """
+    small_h, small_w = mask.frame_shape
+    full_h, full_w = full_shape[:2]
+    fx, fy = full_w / small_w, full_h / small_h
+
+    sx0, sy0 = max(mask.x0 - margin, 0), max(mask.y0 - margin, 0)
+    sx1, sy1 = min(mask.x1 + margin, small_w), min(mask.y1 + margin, small_h)
+
+    x0, y0 = int(round(sx0 * fx)), int(round(sy0 * fy))
+    x1, y1 = min(int(round(sx1 * fx)), full_w), min(int(round(sy1 * fy)), full_h)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    window = mask.window(sx0, sy0, sx1, sy1).astype(np.float32)
+    soft = cv2.resize(window, (x1 - x0, y1 - y0), interpolation=cv2.INTER_LINEAR)
+    crop = soft >= 0.5
+
+    if ink is not None:
+        ink_crop = ink[y0:y1, x0:x1]
+        core = soft >= 0.98
+        reference = core if core.any() else crop
+        if reference.any():
+            mask_is_ink = np.count_nonzero(ink_crop[reference]) * 2 >= np.count_nonzero(reference)
+            band = (soft > 0.02) & ~core
+            crop[band] = ink_crop[band] == mask_is_ink
+
+    meta = {k: v for k, v in mask.meta.items() if k not in _RESCALED_KEYS}
+    if "point_coords" in mask.meta:
+        meta["point_coords"] = [[px * fx, py * fy] for px, py in mask.meta["point_coords"]]
+    return CompactMask.from_array(crop, x0, y0, (full_h, full_w), meta)
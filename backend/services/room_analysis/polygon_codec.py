@@ -0,0 +1,331 @@
+"""
+Compact binary encoding and pre-compressed siblings for masks_polygons.json.
+
+Binary layout (little-endian, every section starts on a 4-byte boundary so the
+browser can wrap it in typed arrays without copying):
+
+    header   : magic "MPLY", u16 version, u16 flags, u32 image_width, u32 image_height,
+               u32 mask_count, u32 polygon_count, u32 point_count, u32 meta_length
+    meta     : JSON {"groups": {...}, "group_ids": [...]}, padded to 4 bytes
+    int32    mask_ids[mask_count]
+    int32    mask_groups[mask_count]            index into group_ids, -1 = ungrouped
+    uint32   polygon_counts[mask_count]         polygons per mask
+    uint32   point_counts[polygon_count]        points per polygon
+    int16/32 coords[point_count * 2]            x, y interleaved; the first point of
+                                                each polygon is absolute, the rest are
+                                                deltas from the previous point
+
+flags bit 0 set means coords are int32 (some value did not fit in int16).
+"""
+
+import gzip
+import json
+import os
+import shutil
+import struct
+import threading
+from array import array
+
+import cv2
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip siblings are written without it
+    brotli = None
+
+MAGIC = b"MPLY"
+VERSION = 1
+FLAG_INT32_COORDS = 1
+HEADER = struct.Struct("<4sHHIIIIII")
+
+BINARY_SUFFIX = ".bin"
+MEDIA_TYPE_BINARY = "application/x-masks-polygons"
+
+# Simplification tolerance (image pixels) of each coarser level of detail;
+# level 0 is masks_polygons.json itself
+POLYGON_LOD_EPSILONS = (1.5, 4.0)
+# Largest on-screen deviation (screen pixels) a level may introduce
+POLYGON_LOD_MAX_SCREEN_ERROR = 1.0
+
+_lod_lock = threading.Lock()
+
+
+def _pad4(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+class PolygonBinaryEncoder:
+    """
+    Accumulates mask entries ({id, polygons, group_id}) into compact typed
+    buffers; used alongside the streaming JSON writer.
+    """
+
+    def __init__(self, groups_data, image_width, image_height):
+        self.groups_data = groups_data
+        self.group_ids = list(groups_data.keys())
+        self._group_index = {gid: i for i, gid in enumerate(self.group_ids)}
+        self.image_width = image_width
+        self.image_height = image_height
+
+        self.mask_ids = array("i")
+        self.mask_groups = array("i")
+        self.polygon_counts = array("I")
+        self.point_counts = array("I")
+        self.coords = array("q")
+
+    def add_mask(self, entry):
+        polygons = entry.get("polygons") or []
+        self.mask_ids.append(int(entry["id"]))
+        self.mask_groups.append(self._group_index.get(entry.get("group_id"), -1))
+        self.polygon_counts.append(len(polygons))
+
+        for polygon in polygons:
+            pts = np.asarray(polygon, dtype=np.int64).reshape(-1, 2)
+            deltas = pts.copy()
+            deltas[1:] -= pts[:-1]
+            self.point_counts.append(len(pts))
+            self.coords.frombytes(deltas.tobytes())
+
+    def to_bytes(self) -> bytes:
+        coords = np.frombuffer(self.coords, dtype=np.int64) if len(self.coords) else np.zeros(0, dtype=np.int64)
+        flags = 0
+        if len(coords) and (coords.min() < -32768 or coords.max() > 32767):
+            flags |= FLAG_INT32_COORDS
+            coords = coords.astype("<i4")
+        else:
+            coords = coords.astype("<i2")
+
+        meta = _pad4(json.dumps({"groups": self.groups_data, "group_ids": self.group_ids}).encode("utf-8"))
+        header = HEADER.pack(
+            MAGIC, VERSION, flags,
+            int(self.image_width), int(self.image_height),
+            len(self.mask_ids), len(self.point_counts), len(coords) // 2, len(meta)
+        )
+
+        return b"".join([
+            header,
+            meta,
+            np.asarray(self.mask_ids, dtype="<i4").tobytes(),
+            np.asarray(self.mask_groups, dtype="<i4").tobytes(),
+            np.asarray(self.polygon_counts, dtype="<u4").tobytes(),
+            np.asarray(self.point_counts, dtype="<u4").tobytes(),
+            _pad4(coords.tobytes()),
+        ])
+
+    def write(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+
+def encode_polygons_binary(payload: dict) -> bytes:
+    """Encode a full masks_polygons.json payload to the binary layout."""
+    encoder = PolygonBinaryEncoder(payload.get("groups") or {}, payload.get("image_width", 0), payload.get("image_height", 0))
+    for entry in payload.get("masks", []):
+        encoder.add_mask(entry)
+    return encoder.to_bytes()
+
+
+def decode_polygons_binary(data: bytes) -> dict:
+    """Decode the binary layout back into the masks_polygons.json structure."""
+    magic, version, flags, width, height, mask_count, polygon_count, point_count, meta_len = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary masks_polygons payload")
+
+    offset = HEADER.size
+    meta = json.loads(data[offset:offset + meta_len].rstrip(b"\0"))
+    offset += meta_len
+
+    def take(dtype, count):
+        nonlocal offset
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += arr.nbytes
+        return arr
+
+    mask_ids = take("<i4", mask_count)
+    mask_groups = take("<i4", mask_count)
+    polygon_counts = take("<u4", mask_count)
+    point_counts = take("<u4", polygon_count)
+    coords = take("<i4" if flags & FLAG_INT32_COORDS else "<i2", point_count * 2).astype(np.int64).reshape(-1, 2)
+
+    group_ids = meta["group_ids"]
+    masks = []
+    poly_idx = 0
+    point_idx = 0
+    for mask_id, group_idx, n_polys in zip(mask_ids, mask_groups, polygon_counts):
+        polygons = []
+        for n_pts in point_counts[poly_idx:poly_idx + n_polys]:
+            pts = np.cumsum(coords[point_idx:point_idx + n_pts], axis=0)
+            polygons.append(pts.tolist())
+            point_idx += int(n_pts)
+        poly_idx += int(n_polys)
+        masks.append({
+            "id": int(mask_id),
+            "polygons": polygons,
+            "group_id": group_ids[group_idx] if group_idx >= 0 else None
+        })
+
+    return {
+        "image_width": width,
+        "image_height": height,
+        "groups": meta["groups"],
+        "masks": masks
+    }
+
+
+# ----------------------------
+# Pre-compressed siblings
+# ----------------------------
+def write_compressed_siblings(path):
+    """
+    Write path.gz (and path.br when brotli is installed) next to `path`,
+    streaming from disk so large payloads are never held in memory.
+    """
+    with open(path, "rb") as src, gzip.open(f"{path}.gz.tmp", "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(f"{path}.gz.tmp", f"{path}.gz")
+
+    if brotli is not None:
+        compressor = brotli.Compressor(quality=5)
+        with open(path, "rb") as src, open(f"{path}.br.tmp", "wb") as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+        os.replace(f"{path}.br.tmp", f"{path}.br")
+
+
+# ----------------------------
+# Levels of detail
+# ----------------------------
+def lod_path(json_path, level: int):
+    """masks_polygons.json for level 0, masks_polygons.lod<level>.json otherwise."""
+    if not level:
+        return json_path
+    base, ext = os.path.splitext(json_path)
+    return f"{base}.lod{level}{ext}"
+
+
+def simplify_polygons(polygons, epsilon):
+    """
+    Douglas-Peucker simplification of each polygon by `epsilon` pixels.
+    A polygon that would collapse below a triangle is kept as it was.
+    """
+    simplified = []
+    for polygon in polygons:
+        pts = np.asarray(polygon, dtype=np.int32).reshape(-1, 1, 2)
+        approx = cv2.approxPolyDP(pts, epsilon, True)
+        simplified.append(approx.reshape(-1, 2).tolist() if len(approx) >= 3 else polygon)
+    return simplified
+
+
+def lod_entry(entry, epsilon):
+    """A mask entry with its polygons simplified for a coarser level."""
+    return dict(entry, polygons=simplify_polygons(entry.get("polygons") or [], epsilon))
+
+
+def pick_lod_level(scale: float) -> int:
+    """
+    Coarsest level whose simplification stays under a screen pixel when the
+    image is drawn at `scale` screen pixels per image pixel.
+    """
+    level = 0
+    for idx, epsilon in enumerate(POLYGON_LOD_EPSILONS, start=1):
+        if epsilon * scale <= POLYGON_LOD_MAX_SCREEN_ERROR:
+            level = idx
+    return level
+
+
+def ensure_polygon_lod(json_path, level: int):
+    """
+    Path of the requested level, (re)building it from masks_polygons.json if
+    it is missing or older. Returns None if there is no snapshot.
+    """
+    if not os.path.exists(json_path):
+        return None
+    path = lod_path(json_path, level)
+    if not level:
+        return path
+
+    with _lod_lock:
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(json_path):
+            with open(json_path) as f:
+                payload = json.load(f)
+            epsilon = POLYGON_LOD_EPSILONS[level - 1]
+            _write_artifacts(path, dict(payload, masks=[lod_entry(m, epsilon) for m in payload.get("masks", [])]))
+    return path
+
+
+def write_polygon_artifacts(json_path, payload: dict):
+    """
+    Write a complete masks_polygons.json payload plus its binary and
+    pre-compressed siblings (used when the payload is already in memory),
+    then every coarser level of detail.
+    """
+    _write_artifacts(json_path, payload)
+    for level, epsilon in enumerate(POLYGON_LOD_EPSILONS, start=1):
+        lod_payload = dict(payload, masks=[lod_entry(m, epsilon) for m in payload.get("masks", [])])
+        _write_artifacts(lod_path(json_path, level), lod_payload)
+
+
+def _write_artifacts(json_path, payload: dict):
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, json_path)
+
+    binary_path = json_path + BINARY_SUFFIX
+    with open(f"{binary_path}.tmp", "wb") as f:
+        f.write(encode_polygons_binary(payload))
+    os.replace(f"{binary_path}.tmp", binary_path)
+
+    write_compressed_siblings(json_path)
+    write_compressed_siblings(binary_path)
+
+
+def _accepted(header: str):
+    """Tokens of an Accept / Accept-Encoding header with a non-zero q-value."""
+    tokens = set()
+    for item in header.lower().split(","):
+        token, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if token and q > 0:
+            tokens.add(token)
+    return tokens
+
+
+def pick_polygon_variant(json_path, accept: str = "", accept_encoding: str = ""):
+    """
+    Content negotiation over the files written next to masks_polygons.json.
+    Returns (path, media_type, content_encoding or None), or None if missing.
+    Siblings older than the JSON (e.g. after a manual edit) are ignored.
+    """
+    if not os.path.exists(json_path):
+        return None
+
+    json_mtime = os.path.getmtime(json_path)
+
+    def fresh(path):
+        return os.path.exists(path) and os.path.getmtime(path) >= json_mtime
+
+    base, media_type = json_path, "application/json"
+    media_types = _accepted(accept)
+    if MEDIA_TYPE_BINARY in media_types or "application/octet-stream" in media_types:
+        if fresh(json_path + BINARY_SUFFIX):
+            base, media_type = json_path + BINARY_SUFFIX, MEDIA_TYPE_BINARY
+
+    # "br;q=0" is an explicit refusal, not a preference
+    encodings = _accepted(accept_encoding)
+    if "br" in encodings and fresh(base + ".br"):
+        return base + ".br", media_type, "br"
+    if "gzip" in encodings and fresh(base + ".gz"):
+        return base + ".gz", media_type, "gzip"
+    return base, media_type, None
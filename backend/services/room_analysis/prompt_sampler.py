@@ -0,0 +1,134 @@
+"""
+Ink-aware prompt points for SamAutomaticMaskGenerator.
+
+SAM's default 32x32 grid spends most of its decoder passes on empty paper.
+Here prompts are placed where there is something to segment: one point
+inside every ink component (a symbol, a wall run) and one inside every
+enclosed blank region (a room, the inside of a fixture), plus a sparse
+uniform grid so nothing is missed entirely. Points are returned in SAM's
+normalised point_grids format.
+"""
+
+import cv2
+import numpy as np
+
+# Components smaller than this many pixels are specks, not symbols
+MIN_COMPONENT_AREA = 12
+# Sparse coverage grid (points per side) added on top of the adaptive points
+COVERAGE_POINTS_PER_SIDE = 8
+# Same budget as SAM's default 32 x 32 grid
+MAX_PROMPT_POINTS = 1024
+# Points closer than this (pixels) are merged
+MIN_POINT_SPACING = 4
+# Share of the budget (after the coverage grid) kept for enclosed regions
+REGION_BUDGET_SHARE = 0.25
+
+
+def ink_mask(image):
+    """Foreground of a (preprocessed) plan: whichever of dark / light is the minority."""
+    gray = image if image.ndim == 2 else image[..., 0]
+    dark = gray < 128
+    return dark if np.count_nonzero(dark) <= dark.size // 2 else ~dark
+
+
+def _interior_points(binary, min_area):
+    """
+    One point per connected component of `binary`, at its deepest interior
+    pixel (so rings and L-shapes get a point on themselves, not their
+    centroid). Returns (points (k, 2) as x, y, areas (k,)), largest first.
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(binary.astype(np.uint8), connectivity=8)
+    points, areas = [], []
+
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+        if area < min_area:
+            continue
+        crop = (labels[y:y + h, x:x + w] == label).astype(np.uint8)
+        dist = cv2.distanceTransform(np.pad(crop, 1), cv2.DIST_L2, 3)[1:-1, 1:-1]
+        py, px = np.unravel_index(int(np.argmax(dist)), dist.shape)
+        points.append((x + px, y + py))
+        areas.append(area)
+
+    if not points:
+        return np.zeros((0, 2), dtype=np.float64), np.zeros(0)
+
+    order = np.argsort(areas)[::-1]
+    return np.asarray(points, dtype=np.float64)[order], np.asarray(areas)[order]
+
+
+def _dedupe(points, min_spacing, taken=None):
+    """Drop points sharing a min_spacing cell with an earlier point (or one in `taken`)."""
+    cells = np.floor(points / max(min_spacing, 1)).astype(np.int64)
+    seen = set(taken) if taken is not None else set()
+    keep = []
+    for idx, cell in enumerate(map(tuple, cells)):
+        if cell not in seen:
+            seen.add(cell)
+            keep.append(idx)
+    return points[keep], seen
+
+
+def _spread(points, count, width, height):
+    """
+    Up to `count` of `points` (given largest component first), spread over
+    the image: a coarse grid of about `count` cells is filled round-robin,
+    the largest remaining component of each cell per round.
+    """
+    if len(points) <= count:
+        return points
+    if count <= 0:
+        return points[:0]
+
+    side = max(int(np.sqrt(count)), 1)
+    cell = np.minimum((points[:, 1] * side // height), side - 1) * side + np.minimum((points[:, 0] * side // width), side - 1)
+    # Rank of each point within its cell (input order is already by size)
+    order = np.argsort(cell, kind="stable")
+    sorted_cells = cell[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    rank = np.empty(len(points), dtype=np.int64)
+    rank[order] = np.arange(len(points)) - np.repeat(starts, np.diff(np.r_[starts, len(points)]))
+
+    chosen = np.lexsort((np.arange(len(points)), rank))[:count]
+    return points[np.sort(chosen)]
+
+
+def adaptive_point_grid(image,
+                        min_area=MIN_COMPONENT_AREA,
+                        coverage_per_side=COVERAGE_POINTS_PER_SIDE,
+                        max_points=MAX_PROMPT_POINTS,
+                        min_spacing=MIN_POINT_SPACING,
+                        region_share=REGION_BUDGET_SHARE):
+    """
+    Prompt points for one image as an (n, 2) array of normalised (x, y),
+    ready for SamAutomaticMaskGenerator(point_grids=[...]).
+
+    Budget when over `max_points`: the coverage grid always stays; enclosed
+    blank regions keep at least `region_share` of the rest (largest first)
+    and ink components get the remainder, subsampled evenly across the
+    image so dense text cannot crowd everything else out. A share one kind
+    does not need goes to the other.
+    """
+    height, width = image.shape[:2]
+    ink = ink_mask(image)
+
+    ink_points, _ = _interior_points(ink, min_area)
+    region_points, _ = _interior_points(~ink, min_area)
+
+    offset = 1 / (2 * coverage_per_side)
+    axis = np.linspace(offset, 1 - offset, coverage_per_side)
+    grid = np.stack(np.meshgrid(axis * width, axis * height), axis=-1).reshape(-1, 2)
+
+    # Points closer than min_spacing to an already kept point are dropped
+    grid, taken = _dedupe(grid[:max_points], min_spacing)
+    region_points, taken = _dedupe(region_points, min_spacing, taken)
+    ink_points, _ = _dedupe(ink_points, min_spacing, taken)
+
+    budget = max_points - len(grid)
+    region_count = min(len(region_points), max(int(budget * region_share), budget - len(ink_points)))
+    ink_points = _spread(ink_points, budget - region_count, width, height)
+
+    points = np.concatenate([ink_points, region_points[:region_count], grid])
+
+    # Pixel centres, normalised like segment_anything's build_point_grid
+    return np.column_stack([(points[:, 0] + 0.5) / width, (points[:, 1] + 0.5) / height])
@@ -0,0 +1,313 @@
+"""
+Persistent similarity graph for incremental regrouping.
+
+The graph built by grouping_engine is saved next to a room's analysis
+artifacts (similarity_graph.npz): per-mask feature columns, the edge list,
+component labels and the tolerances used. After manual edits only the edges
+touching changed masks are recomputed, and only the components those masks
+belonged to (or now connect to) are rebuilt.
+"""
+
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from services.room_analysis.feature_extractor import features_from_polygons
+from services.room_analysis.mask_edit_log import (
+    get_room_masks,
+    apply_room_mask_edits,
+    check_base_revision,
+)
+from services.room_analysis.grouping_engine import (
+    build_feature_table,
+    build_similarity_matrix,
+    hu_match_terms,
+    similar_pairs,
+    random_color,
+    random_name,
+)
+
+SIMILARITY_GRAPH_FILENAME = "similarity_graph.npz"
+
+DEFAULT_TOLERANCES = {"area_tol": 0.08, "size_tol": 0.20, "shape_tol": 0.04, "vertex_tol": 2}
+
+_COLUMNS = ("area", "height", "width", "vertex", "has_contour", "hu")
+
+# Per-graph locks are striped so their number stays fixed
+LOCK_STRIPES = 64
+
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+class SimilarityGraph:
+    def __init__(self, mask_ids, table, neighbours, labels, tolerances=None):
+        self.mask_ids = list(mask_ids)
+        self.table = table
+        self.neighbours = neighbours          # node -> set(node)
+        self.labels = labels                  # node -> component label
+        self.alive = np.ones(len(self.mask_ids), dtype=bool)
+        self.tolerances = dict(tolerances or DEFAULT_TOLERANCES)
+        self._node_of = {mask_id: node for node, mask_id in enumerate(self.mask_ids)}
+
+    # ----------------------------
+    # Build / persist
+    # ----------------------------
+    @classmethod
+    def build(cls, mask_ids, features, tolerances=None):
+        tolerances = dict(tolerances or DEFAULT_TOLERANCES)
+        table = build_feature_table(features)
+        adjacency = build_similarity_matrix(table, **tolerances).tocoo()
+
+        neighbours = {node: set() for node in range(len(mask_ids))}
+        for a, b in zip(adjacency.row.tolist(), adjacency.col.tolist()):
+            neighbours[a].add(b)
+
+        graph = cls(mask_ids, table, neighbours, np.zeros(len(mask_ids), dtype=np.int64), tolerances)
+        graph._relabel(set(range(len(mask_ids))))
+        return graph
+
+    def save(self, path):
+        rows, cols = [], []
+        for a, nbrs in self.neighbours.items():
+            for b in nbrs:
+                if a < b:
+                    rows.append(a)
+                    cols.append(b)
+
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            mask_ids=np.asarray(self.mask_ids, dtype=np.int64),
+            alive=self.alive,
+            labels=self.labels,
+            edges=np.asarray([rows, cols], dtype=np.int64).reshape(2, -1),
+            tolerances=np.asarray([self.tolerances[k] for k in DEFAULT_TOLERANCES], dtype=np.float64),
+            **{f"col_{name}": self.table[name] for name in _COLUMNS},
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            table = {name: data[f"col_{name}"] for name in _COLUMNS}
+            table["hu_terms"], table["hu_valid"] = hu_match_terms(table["hu"])
+
+            neighbours = {node: set() for node in range(len(data["mask_ids"]))}
+            for a, b in data["edges"].T.tolist():
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+
+            tolerances = dict(zip(DEFAULT_TOLERANCES, data["tolerances"].tolist()))
+            tolerances["vertex_tol"] = int(tolerances["vertex_tol"])
+
+            graph = cls(data["mask_ids"].tolist(), table, neighbours, data["labels"].copy(), tolerances)
+            graph.alive = data["alive"].copy()
+        return graph
+
+    # ----------------------------
+    # Queries
+    # ----------------------------
+    def live_mask_ids(self):
+        return [m for node, m in enumerate(self.mask_ids) if self.alive[node]]
+
+    def components(self, nodes=None):
+        """{label: [mask_id, ...]} for live nodes (optionally only `nodes`)."""
+        nodes = range(len(self.mask_ids)) if nodes is None else nodes
+        comps = {}
+        for node in nodes:
+            if self.alive[node]:
+                comps.setdefault(int(self.labels[node]), []).append(self.mask_ids[node])
+        return comps
+
+    # ----------------------------
+    # Incremental update
+    # ----------------------------
+    def _relabel(self, nodes):
+        """Recompute component labels for `nodes` (a union of whole old components)."""
+        next_label = int(self.labels.max()) + 1 if len(self.labels) else 0
+        seen = set()
+        for start in sorted(nodes):
+            if start in seen or not self.alive[start]:
+                continue
+            stack = [start]
+            seen.add(start)
+            while stack:
+                node = stack.pop()
+                self.labels[node] = next_label
+                for nbr in self.neighbours[node]:
+                    if nbr not in seen:
+                        seen.add(nbr)
+                        stack.append(nbr)
+            next_label += 1
+
+    def _append_node(self, mask_id):
+        node = len(self.mask_ids)
+        self.mask_ids.append(mask_id)
+        self._node_of[mask_id] = node
+        self.neighbours[node] = set()
+        self.alive = np.append(self.alive, True)
+        self.labels = np.append(self.labels, -1)
+        for name in _COLUMNS:
+            col = self.table[name]
+            self.table[name] = np.concatenate([col, np.zeros((1,) + col.shape[1:], dtype=col.dtype)])
+        self.table["hu_terms"] = np.concatenate([self.table["hu_terms"], np.zeros((1, 7))])
+        self.table["hu_valid"] = np.concatenate([self.table["hu_valid"], np.zeros((1, 7), dtype=bool)])
+        return node
+
+    def _set_features(self, node, feat):
+        row = build_feature_table([feat])
+        for name in list(_COLUMNS) + ["hu_terms", "hu_valid"]:
+            self.table[name][node] = row[name][0]
+
+    def update(self, changed=None, removed=()):
+        """
+        Apply edits: `changed` maps mask_id -> features (new or redrawn masks),
+        `removed` lists deleted mask ids. Returns the affected nodes, whose
+        component labels have been recomputed.
+        """
+        changed = changed or {}
+        touched = set()
+
+        for mask_id in removed:
+            node = self._node_of.get(mask_id)
+            if node is None or not self.alive[node]:
+                continue
+            touched.add(node)
+            touched |= self.neighbours[node]
+            for nbr in self.neighbours[node]:
+                self.neighbours[nbr].discard(node)
+            self.neighbours[node] = set()
+            self.alive[node] = False
+
+        changed_nodes = []
+        for mask_id, feat in changed.items():
+            node = self._node_of.get(mask_id)
+            if node is None:
+                node = self._append_node(mask_id)
+            else:
+                self.alive[node] = True
+            self._set_features(node, feat)
+            changed_nodes.append(node)
+
+        live = np.flatnonzero(self.alive)
+        for node in changed_nodes:
+            touched.add(node)
+            touched |= self.neighbours[node]
+            for nbr in self.neighbours[node]:
+                self.neighbours[nbr].discard(node)
+
+            others = live[live != node]
+            lo, hi = np.minimum(others, node), np.maximum(others, node)
+            new_nbrs = set(others[similar_pairs(self.table, lo, hi, **self.tolerances)].tolist())
+
+            self.neighbours[node] = new_nbrs
+            for nbr in new_nbrs:
+                self.neighbours[nbr].add(node)
+            touched |= new_nbrs
+
+        # Whole old components of every touched node must be relabelled
+        touched_labels = {int(self.labels[n]) for n in touched if self.labels[n] >= 0}
+        affected = set(np.flatnonzero(np.isin(self.labels, list(touched_labels))).tolist()) | touched
+        affected = {n for n in affected if self.alive[n]}
+        self._relabel(affected)
+        return affected
+
+
+def regroup_ops(graph, affected, payload):
+    """
+    Turn recomputed components into mask edit operations against the current
+    masks_polygons payload. A new component keeps the id/name/colour of the
+    group most of its masks were already in; otherwise a new group is created.
+    Groups left empty are deleted.
+    """
+    groups = payload.get("groups", {})
+    current_group = {m["id"]: m.get("group_id") for m in payload.get("masks", [])}
+    groups_before = set(current_group.values())
+    ops = []
+    claimed = set()
+
+    existing_numbers = [int(g.split("_")[-1]) for g in groups if g.split("_")[-1].isdigit()]
+    next_number = max(existing_numbers, default=0) + 1
+
+    for label, members in sorted(graph.components(affected).items(), key=lambda kv: min(kv[1])):
+        members = [m for m in members if m in current_group]
+        if not members:
+            continue
+
+        votes = {}
+        for m in members:
+            gid = current_group[m]
+            if gid is not None and gid not in claimed:
+                votes[gid] = votes.get(gid, 0) + 1
+
+        if votes:
+            group_id = max(votes, key=lambda g: (votes[g], g))
+        else:
+            group_id = f"group_{next_number}"
+            next_number += 1
+            ops.append({"op": "create_group", "group": {
+                "id": group_id, "name": random_name(), "code": "", "color": list(random_color())
+            }})
+        claimed.add(group_id)
+
+        moved = [m for m in members if current_group[m] != group_id]
+        if moved:
+            ops.append({"op": "regroup", "mask_ids": moved, "group_id": group_id})
+            for m in moved:
+                current_group[m] = group_id
+
+    # Only groups emptied by this regroup are removed, not ones the user left empty
+    still_used = set(current_group.values())
+    for group_id in groups:
+        if group_id in groups_before and group_id not in still_used:
+            ops.append({"op": "delete_group", "group_id": group_id})
+
+    return ops
+
+
+def _lock_for(graph_path):
+    return _locks[zlib.crc32(graph_path.encode()) % LOCK_STRIPES]
+
+
+def regroup_room_masks(json_path, base_revision, changed_mask_ids=(), base_analysis_id=None):
+    """
+    Regroup a room's masks after manual edits without re-running the full
+    grouping. Masks added or removed since the graph was saved are detected
+    by diffing against the current masks; masks whose polygons were redrawn
+    must be listed in `changed_mask_ids`. Features of edited masks come from
+    their polygons.
+
+    Returns (revision, ops). Raises MaskEditConflict if `base_revision` is stale.
+    """
+    graph_path = os.path.join(os.path.dirname(json_path), SIMILARITY_GRAPH_FILENAME)
+
+    with _lock_for(graph_path):
+        payload = get_room_masks(json_path)
+        check_base_revision(payload, base_revision, base_analysis_id)
+
+        polygons = {m["id"]: m.get("polygons") or [] for m in payload["masks"]}
+
+        if os.path.exists(graph_path):
+            graph = SimilarityGraph.load(graph_path)
+            live = set(graph.live_mask_ids())
+            removed = live - polygons.keys()
+            changed = (polygons.keys() - live) | (set(changed_mask_ids) & polygons.keys())
+            affected = graph.update(
+                {mask_id: features_from_polygons(polygons[mask_id]) for mask_id in sorted(changed)},
+                removed
+            )
+        else:
+            # Rooms analysed before the graph was persisted: build it once from the polygons
+            mask_ids = sorted(polygons)
+            graph = SimilarityGraph.build(mask_ids, [features_from_polygons(polygons[m]) for m in mask_ids])
+            affected = set(range(len(mask_ids)))
+
+        ops = regroup_ops(graph, affected, payload)
+        revision = base_revision
+        if ops:
+            revision = apply_room_mask_edits(json_path, base_revision, ops, base_analysis_id=base_analysis_id)
+
+        graph.save(graph_path)
+        return revision, ops
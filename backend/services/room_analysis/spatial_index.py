@@ -0,0 +1,141 @@
+"""
+Uniform-grid spatial index over a room's mask polygons.
+
+Lets the editor ask the server "which mask is at (x, y)" and "which masks
+intersect this viewport" instead of receiving and hit-testing every polygon
+client-side. Each mask's polygon bbox is registered in every grid cell it
+overlaps; queries only look at the cells they touch.
+
+Indexes are cached per masks_polygons.json and rebuilt when the revision
+(including pending edit-log entries) changes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from services.room_analysis.mask_edit_log import get_room_masks, get_room_masks_revision
+
+GRID_CELL_SIZE = 256
+SPATIAL_INDEX_CACHE_SIZE = 8
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+class SpatialGrid:
+    def __init__(self, masks, cell_size=GRID_CELL_SIZE):
+        self.masks = masks
+        self.cell_size = cell_size
+
+        n = len(masks)
+        self.bboxes = np.zeros((n, 4), dtype=np.int64)   # x0, y0, x1, y1 (inclusive)
+        self._points = []
+        valid = np.zeros(n, dtype=bool)
+
+        for i, mask in enumerate(masks):
+            polys = [np.asarray(p, dtype=np.int32).reshape(-1, 2) for p in mask.get("polygons") or [] if len(p)]
+            self._points.append(polys)
+            if polys:
+                pts = np.concatenate(polys)
+                self.bboxes[i, :2] = pts.min(axis=0)
+                self.bboxes[i, 2:] = pts.max(axis=0)
+                valid[i] = True
+
+        self.areas = (self.bboxes[:, 2] - self.bboxes[:, 0] + 1) * (self.bboxes[:, 3] - self.bboxes[:, 1] + 1)
+
+        cells = {}
+        cell_bounds = np.floor_divide(self.bboxes, cell_size)
+        for i in np.flatnonzero(valid):
+            cx0, cy0, cx1, cy1 = cell_bounds[i].tolist()
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    cells.setdefault((cx, cy), []).append(i)
+        self.cells = {key: np.asarray(idx, dtype=np.int64) for key, idx in cells.items()}
+        # Occupied cell range (cx0, cy0, cx1, cy1); query rects are clamped to it
+        keys = np.asarray(list(self.cells), dtype=np.int64).reshape(-1, 2)
+        self.cell_range = (*keys.min(axis=0).tolist(), *keys.max(axis=0).tolist()) if len(keys) else None
+
+    def _candidates(self, x0, y0, x1, y1):
+        if self.cell_range is None:
+            return np.zeros(0, dtype=np.int64)
+        # Query rects come from clients: only walk cells that can hold masks
+        cs = self.cell_size
+        gx0, gy0, gx1, gy1 = self.cell_range
+        cx0, cy0 = max(int(max(x0, gx0 * cs)) // cs, gx0), max(int(max(y0, gy0 * cs)) // cs, gy0)
+        cx1, cy1 = min(int(min(x1, (gx1 + 1) * cs)) // cs, gx1), min(int(min(y1, (gy1 + 1) * cs)) // cs, gy1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            found = [idx for (cx, cy), idx in self.cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            found = [
+                self.cells[(cx, cy)]
+                for cy in range(cy0, cy1 + 1)
+                for cx in range(cx0, cx1 + 1)
+                if (cx, cy) in self.cells
+            ]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found)) if len(found) > 1 else found[0]
+
+    def query_rect(self, x0, y0, x1, y1, min_size=0):
+        """Indices of masks whose bbox intersects the rect and spans at least `min_size` pixels."""
+        idx = self._candidates(x0, y0, x1, y1)
+        b = self.bboxes[idx]
+        keep = (b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)
+        if min_size > 0:
+            keep &= np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]) + 1 >= min_size
+        return idx[keep]
+
+    def query_point(self, x, y):
+        """Indices of masks containing (x, y), smallest first (the most specific hit)."""
+        hits = [
+            i for i in self.query_rect(x, y, x, y)
+            if any(cv2.pointPolygonTest(poly, (float(x), float(y)), False) >= 0 for poly in self._points[i])
+        ]
+        return sorted(hits, key=lambda i: self.areas[i])
+
+
+def get_room_spatial_index(json_path):
+    """(revision, SpatialGrid) for the room's current masks, built on first use per revision."""
+    revision = get_room_masks_revision(json_path)
+    # A fresh analysis starts over at revision 0, so the snapshot file is part of the key
+    version = (revision, os.stat(json_path).st_mtime_ns if os.path.exists(json_path) else None)
+
+    with _index_cache_lock:
+        cached = _index_cache.get(json_path)
+        if cached and cached[0] == version:
+            _index_cache.move_to_end(json_path)
+            return cached[1]
+
+    payload = get_room_masks(json_path)
+    entry = (payload["revision"], SpatialGrid(payload["masks"]))
+
+    with _index_cache_lock:
+        _index_cache[json_path] = (version, entry)
+        _index_cache.move_to_end(json_path)
+        while len(_index_cache) > SPATIAL_INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return entry
+
+
+def hit_test(json_path, x, y):
+    """Masks under (x, y), most specific first."""
+    revision, grid = get_room_spatial_index(json_path)
+    return {"revision": revision, "masks": [grid.masks[i] for i in grid.query_point(x, y)]}
+
+
+def query_viewport(json_path, x0, y0, x1, y1, zoom=1.0, min_screen_size=2):
+    """
+    Masks intersecting the viewport rect (image coordinates). Masks smaller
+    than `min_screen_size` screen pixels at `zoom` are culled.
+    """
+    revision, grid = get_room_spatial_index(json_path)
+    min_size = min_screen_size / zoom if zoom > 0 else 0
+    idx = grid.query_rect(x0, y0, x1, y1, min_size=min_size)
+    return {"revision": revision, "masks": [grid.masks[i] for i in np.sort(idx)]}
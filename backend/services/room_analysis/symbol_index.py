@@ -0,0 +1,245 @@
+"""
+Project-level index of mask shape descriptors for cross-room symbol search.
+
+Every analysed room persists its per-mask features in similarity_graph.npz.
+This module gathers the live masks of all rooms of a project into one
+descriptor table (project_{id}/symbol_index.npz) and a KD-tree over the
+geometric part of the descriptor, so "find every instance of this symbol"
+is a ball query plus an exact check on a handful of candidates.
+
+The table is refreshed lazily: only rooms whose graph file changed since
+the last build are re-read.
+"""
+
+import glob
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from services.project_service import LOCAL_FILE_DB
+from services.room_analysis.similarity_graph import SimilarityGraph, SIMILARITY_GRAPH_FILENAME, DEFAULT_TOLERANCES
+from services.room_analysis.mask_edit_log import get_room_mask_ids, EDIT_LOG_FILENAME
+
+SYMBOL_INDEX_FILENAME = "symbol_index.npz"
+# KD-trees kept per index, one per distinct set of geometric tolerances
+TREE_CACHE_SIZE = 4
+# The tolerances that shape the tree; shape_tol is only used to filter candidates
+_TREE_TOLERANCES = ("area_tol", "size_tol", "vertex_tol")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _descriptors(table, nodes):
+    """Hu match terms plus geometric columns for the given graph nodes."""
+    return {
+        "area": table["area"][nodes],
+        "height": table["height"][nodes],
+        "width": table["width"][nodes],
+        "vertex": table["vertex"][nodes],
+        "has_contour": table["has_contour"][nodes],
+        "hu_terms": table["hu_terms"][nodes],
+        "hu_valid": table["hu_valid"][nodes],
+    }
+
+
+def _tree_points(desc, tolerances):
+    """
+    Log-scaled area/width/height and vertex count, each divided by the widest
+    step its tolerance allows, so every similar pair lies within Chebyshev
+    distance 1 of each other.
+    """
+    def scaled_log(values, tol):
+        return np.log(np.maximum(values, 1)) / -np.log(1 - min(tol, 0.99))
+
+    return np.column_stack([
+        scaled_log(desc["area"], tolerances["area_tol"]),
+        scaled_log(desc["width"], tolerances["size_tol"]),
+        scaled_log(desc["height"], tolerances["size_tol"]),
+        desc["vertex"] / max(tolerances["vertex_tol"], 1e-9),
+    ])
+
+
+class ProjectSymbolIndex:
+    def __init__(self, room_ids, mask_ids, desc, sources):
+        self.room_ids = room_ids            # np.array of str, one per row
+        self.mask_ids = mask_ids            # np.array of int, one per row
+        self.desc = desc
+        self.sources = sources              # room_id -> _room_source_key used for its rows
+        self._trees = OrderedDict()
+        self._trees_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mask_ids)
+
+    def _tree(self, tolerances):
+        key = tuple(float(tolerances[name]) for name in _TREE_TOLERANCES)
+        with self._trees_lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+                return tree
+
+        tree = cKDTree(_tree_points(self.desc, tolerances))
+        with self._trees_lock:
+            self._trees[key] = tree
+            while len(self._trees) > TREE_CACHE_SIZE:
+                self._trees.popitem(last=False)
+        return tree
+
+    def row_of(self, room_id, mask_id):
+        rows = np.flatnonzero((self.room_ids == str(room_id)) & (self.mask_ids == int(mask_id)))
+        return int(rows[0]) if len(rows) else None
+
+    def query(self, row, tolerances=None, limit=None):
+        """
+        Rows similar to `row` under grouping_engine's is_similar rules (the
+        query mask is the reference for the relative tolerances), closest
+        shape first. Returns [(row, shape_score)].
+        """
+        tolerances = dict(tolerances or DEFAULT_TOLERANCES)
+        tree = self._tree(tolerances)
+        candidates = np.asarray(tree.query_ball_point(tree.data[row], r=1.0, p=np.inf), dtype=np.int64)
+        candidates = candidates[candidates != row]
+
+        d = self.desc
+        keep = np.abs(d["area"][candidates] - d["area"][row]) / max(d["area"][row], 1) <= tolerances["area_tol"]
+        keep &= np.abs(d["height"][candidates] - d["height"][row]) / max(d["height"][row], 1) <= tolerances["size_tol"]
+        keep &= np.abs(d["width"][candidates] - d["width"][row]) / max(d["width"][row], 1) <= tolerances["size_tol"]
+        keep &= np.abs(d["vertex"][candidates] - d["vertex"][row]) <= tolerances["vertex_tol"]
+        keep &= d["has_contour"][candidates] & d["has_contour"][row]
+        candidates = candidates[keep]
+
+        both = d["hu_valid"][candidates] & d["hu_valid"][row]
+        diff = np.abs(d["hu_terms"][candidates] - d["hu_terms"][row])
+        scores = np.where(both, diff, 0.0).sum(axis=1)
+
+        within = scores <= tolerances["shape_tol"]
+        candidates, scores = candidates[within], scores[within]
+        order = np.argsort(scores, kind="stable")
+        if limit:
+            order = order[:limit]
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+
+# ----------------------------
+# Build / persist
+# ----------------------------
+def _room_graph_paths(project_id):
+    pattern = os.path.join(LOCAL_FILE_DB, f"project_{project_id}", "rooms", "*", "analysis", SIMILARITY_GRAPH_FILENAME)
+    return {os.path.basename(os.path.dirname(os.path.dirname(p))): p for p in glob.glob(pattern)}
+
+
+def _room_source_key(graph_path):
+    """
+    Changes whenever the room's graph, masks_polygons.json or edit log is
+    rewritten, so rows are refreshed after manual edits too.
+    """
+    analysis_dir = os.path.dirname(graph_path)
+    paths = (graph_path, os.path.join(analysis_dir, "masks_polygons.json"), os.path.join(analysis_dir, EDIT_LOG_FILENAME))
+    return max(os.stat(p).st_mtime_ns for p in paths if os.path.exists(p))
+
+
+def _load_room_rows(room_id, graph_path):
+    graph = SimilarityGraph.load(graph_path)
+    # Only masks the room currently has: graphs of older analyses also hold
+    # masks that never reached masks_polygons.json, and edits made since the
+    # last regroup are not in the graph
+    json_path = os.path.join(os.path.dirname(graph_path), "masks_polygons.json")
+    current = get_room_mask_ids(json_path) if os.path.exists(json_path) else set()
+    all_ids = np.asarray(graph.mask_ids, dtype=np.int64)
+    nodes = np.flatnonzero(graph.alive & np.isin(all_ids, list(current)))
+    mask_ids = all_ids[nodes]
+    return np.full(len(nodes), room_id, dtype=object), mask_ids, _descriptors(graph.table, nodes)
+
+
+def _concat(parts):
+    room_ids = np.concatenate([p[0] for p in parts]).astype(str) if parts else np.zeros(0, dtype=str)
+    mask_ids = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+    keys = ("area", "height", "width", "vertex", "has_contour", "hu_terms", "hu_valid")
+    if parts:
+        desc = {k: np.concatenate([p[2][k] for p in parts]) for k in keys}
+    else:
+        desc = {
+            "area": np.zeros(0), "height": np.zeros(0), "width": np.zeros(0),
+            "vertex": np.zeros(0, dtype=np.int64), "has_contour": np.zeros(0, dtype=bool), "hu_terms": np.zeros((0, 7)), "hu_valid": np.zeros((0, 7), dtype=bool),
+        }
+    return room_ids, mask_ids, desc
+
+
+def _save(path, index):
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(
+        tmp_path,
+        room_ids=index.room_ids,
+        mask_ids=index.mask_ids,
+        source_rooms=np.asarray(list(index.sources), dtype=str),
+        source_mtimes=np.asarray(list(index.sources.values()), dtype=np.int64),
+        **{f"desc_{k}": v for k, v in index.desc.items()},
+    )
+    os.replace(tmp_path, path)
+
+
+def _load(path):
+    with np.load(path) as data:
+        desc = {k[len("desc_"):]: data[k] for k in data.files if k.startswith("desc_")}
+        sources = dict(zip(data["source_rooms"].tolist(), data["source_mtimes"].tolist()))
+        return ProjectSymbolIndex(data["room_ids"], data["mask_ids"], desc, sources)
+
+
+def get_project_symbol_index(project_id):
+    """The project's symbol index, refreshing rows of rooms whose graph changed."""
+    index_path = os.path.join(LOCAL_FILE_DB, f"project_{project_id}", SYMBOL_INDEX_FILENAME)
+    graph_paths = _room_graph_paths(project_id)
+    current = {room_id: _room_source_key(p) for room_id, p in graph_paths.items()}
+
+    with _indexes_lock:
+        index = _indexes.get(project_id)
+        if index is None and os.path.exists(index_path):
+            try:
+                index = _load(index_path)
+            except (OSError, KeyError, ValueError):
+                index = None
+        if index is not None and index.sources == current:
+            _indexes[project_id] = index
+            return index
+
+        parts = []
+        old = index
+        for room_id in sorted(current):
+            if old is not None and old.sources.get(room_id) == current[room_id]:
+                rows = old.room_ids == room_id
+                parts.append((old.room_ids[rows], old.mask_ids[rows], {k: v[rows] for k, v in old.desc.items()}))
+            else:
+                parts.append(_load_room_rows(room_id, graph_paths[room_id]))
+
+        index = ProjectSymbolIndex(*_concat(parts), current)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        _save(index_path, index)
+        _indexes[project_id] = index
+        return index
+
+
+def find_similar_symbols(project_id, room_id, mask_id, tolerances=None, limit=200):
+    """
+    Masks across every room of the project that look like `mask_id` of
+    `room_id`. Returns None if that mask is not in the index.
+    """
+    index = get_project_symbol_index(project_id)
+    row = index.row_of(room_id, mask_id)
+    if row is None:
+        return None
+
+    matches = index.query(row, tolerances, limit)
+    return {
+        "room_id": str(room_id),
+        "mask_id": int(mask_id),
+        "indexed_masks": len(index),
+        "matches": [
+            {"room_id": str(index.room_ids[r]), "mask_id": int(index.mask_ids[r]), "shape_score": score}
+            for r, score in matches
+        ],
+    }
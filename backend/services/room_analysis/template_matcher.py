@@ -0,0 +1,250 @@
+"""
+Template matching for repeated symbols SAM missed.
+
+One exemplar mask is cut out of the room's preprocessed image and searched
+for with normalised cross-correlation (cv2.matchTemplate, which correlates in
+the frequency domain for all but tiny templates) at a few scales and the four
+right-angle rotations. Candidates from the plain correlation are rescored
+comparing only the pixels inside the exemplar's outline, so whatever
+surrounds a symbol does not decide whether it matches. The image is split into overlapping tiles that are
+matched in parallel threads (OpenCV releases the GIL).
+
+Matches that overlap an existing mask of the exemplar's group are dropped;
+the rest are returned as polygons ready to be added to that group.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from services.room_analysis.mask_and_group_combiner import mask_to_polygons
+from services.room_analysis.mask_edit_log import get_room_masks, apply_room_mask_edits, check_base_revision, MaskEditError
+
+DEFAULT_SCALES = (0.9, 1.0, 1.1)
+DEFAULT_ROTATIONS = (0, 90, 180, 270)
+MATCH_TILE_SIZE = 1024
+MAX_PEAKS_PER_TILE = 200
+# Upper bound on matches added by one request
+MAX_MATCHES_LIMIT = 2000
+# Plain-correlation candidates are kept this far below the threshold, then
+# rescored with the outline mask (masked matching over a whole tile is ~3x slower)
+PREFILTER_MARGIN = 0.2
+# Pixels around each candidate searched when rescoring
+RESCORE_RADIUS = 2
+
+
+def _polygons_bbox(polygons):
+    pts = np.concatenate([np.asarray(p, dtype=np.int32).reshape(-1, 2) for p in polygons])
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def _iou_many(a, boxes):
+    """IoU of bbox `a` with each row of `boxes` ((n, 4) x0, y0, x1, y1, inclusive)."""
+    ix = np.minimum(a[2], boxes[:, 2]) - np.maximum(a[0], boxes[:, 0]) + 1
+    iy = np.minimum(a[3], boxes[:, 3]) - np.maximum(a[1], boxes[:, 1]) + 1
+    inter = np.clip(ix, 0, None) * np.clip(iy, 0, None)
+    area_a = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    return inter / (area_a + areas - inter).astype(np.float64)
+
+
+def _iou(a, b):
+    ix = min(a[2], b[2]) - max(a[0], b[0]) + 1
+    iy = min(a[3], b[3]) - max(a[1], b[1]) + 1
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    inter = ix * iy
+    area_a = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
+    area_b = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
+    return inter / float(area_a + area_b - inter)
+
+
+def build_template_variants(image_gray, polygons, scales=DEFAULT_SCALES, rotations=DEFAULT_ROTATIONS):
+    """
+    Cut the exemplar out of the image and return one (template, template_mask)
+    pair per scale/rotation combination.
+    """
+    x0, y0, x1, y1 = _polygons_bbox(polygons)
+    template = image_gray[y0:y1 + 1, x0:x1 + 1]
+
+    shape_mask = np.zeros(template.shape, dtype=np.uint8)
+    cv2.fillPoly(shape_mask, [np.asarray(p, dtype=np.int32).reshape(-1, 2) - [x0, y0] for p in polygons], 1)
+
+    variants = []
+    for scale in scales:
+        size = (max(int(round(template.shape[1] * scale)), 3), max(int(round(template.shape[0] * scale)), 3))
+        scaled = cv2.resize(template, size, interpolation=cv2.INTER_AREA)
+        scaled_mask = cv2.resize(shape_mask, size, interpolation=cv2.INTER_NEAREST)
+        for rotation in rotations:
+            k = (int(rotation) // 90) % 4
+            variants.append((np.ascontiguousarray(np.rot90(scaled, k)), np.ascontiguousarray(np.rot90(scaled_mask, k))))
+    return variants
+
+
+def _rescore_masked(region, template, template_mask, x, y, radius=RESCORE_RADIUS):
+    """Best outline-masked score within `radius` pixels of (x, y): (score, x, y)."""
+    th, tw = template.shape
+    x0, y0 = max(x - radius, 0), max(y - radius, 0)
+    x1 = min(x + radius + tw, region.shape[1])
+    y1 = min(y + radius + th, region.shape[0])
+
+    scores = cv2.matchTemplate(region[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED, mask=template_mask)
+    scores = np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0)
+    dy, dx = np.unravel_index(int(np.argmax(scores)), scores.shape)
+    return float(scores[dy, dx]), x0 + int(dx), y0 + int(dy)
+
+
+def _match_tile(image_gray, tile, variants, threshold):
+    """Peaks above `threshold` in one tile: [(score, x, y, variant_idx)] in image coordinates."""
+    tx0, ty0, tx1, ty1 = tile
+    region = image_gray[ty0:ty1, tx0:tx1]
+    peaks = []
+
+    for v_idx, (template, template_mask) in enumerate(variants):
+        th, tw = template.shape
+        if region.shape[0] < th or region.shape[1] < tw:
+            continue
+
+        # A shape filling its whole box needs no rescoring
+        masked = not template_mask.all()
+        cutoff = threshold - PREFILTER_MARGIN if masked else threshold
+
+        scores = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+        scores = np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0)
+
+        # Local maxima over half a template, so one symbol yields one peak
+        kernel = np.ones((max(th // 2, 1), max(tw // 2, 1)), dtype=np.uint8)
+        is_peak = (scores >= cutoff) & (scores >= cv2.dilate(scores, kernel))
+        ys, xs = np.nonzero(is_peak)
+        if len(ys) > MAX_PEAKS_PER_TILE:
+            top = np.argsort(scores[ys, xs])[::-1][:MAX_PEAKS_PER_TILE]
+            ys, xs = ys[top], xs[top]
+
+        for y, x in zip(ys, xs):
+            score, x, y = float(scores[y, x]), int(x), int(y)
+            if masked:
+                score, x, y = _rescore_masked(region, template, template_mask, x, y)
+                if score < threshold:
+                    continue
+            peaks.append((score, x + tx0, y + ty0, v_idx))
+
+    return peaks
+
+
+def _tiles(shape, overlap, tile_size=MATCH_TILE_SIZE):
+    """
+    Tiles overlapping by `overlap` so a match straddling a border is fully
+    inside one tile. Tiles grow to twice the overlap for large templates,
+    so each tile always advances by at least a template's size.
+    """
+    height, width = shape[:2]
+    tile_size = max(tile_size, 2 * overlap)
+    step = tile_size - overlap
+    for y in range(0, max(height - overlap, 1), step):
+        for x in range(0, max(width - overlap, 1), step):
+            yield x, y, min(x + tile_size, width), min(y + tile_size, height)
+
+
+def find_template_matches(image_gray, polygons, existing_bboxes=(), threshold=0.8,
+                          scales=DEFAULT_SCALES, rotations=DEFAULT_ROTATIONS,
+                          max_matches=500, workers=None):
+    """
+    Search `image_gray` for further instances of the shape outlined by
+    `polygons`. Returns [{"polygons", "score", "bbox"}] best first, with
+    overlapping matches suppressed and anything overlapping `existing_bboxes`
+    (x0, y0, x1, y1) removed.
+    """
+    variants = build_template_variants(image_gray, polygons, scales, rotations)
+    overlap = max(max(t.shape) for t, _ in variants)
+    tiles = list(_tiles(image_gray.shape, overlap))
+
+    workers = workers or min(os.cpu_count() or 1, 8)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        peaks = [p for tile_peaks in pool.map(lambda t: _match_tile(image_gray, t, variants, threshold), tiles) for p in tile_peaks]
+
+    peaks.sort(key=lambda p: p[0], reverse=True)
+    kept = []
+    blocked = []
+    existing = np.asarray(existing_bboxes, dtype=np.int64).reshape(-1, 4)
+
+    for score, x, y, v_idx in peaks:
+        th, tw = variants[v_idx][0].shape
+        bbox = (x, y, x + tw - 1, y + th - 1)
+        # Already a mask, or the same symbol found again by another tile/scale/rotation
+        if len(existing) and _iou_many(bbox, existing).max() > 0.3:
+            continue
+        if any(_iou(bbox, other) > 0.3 for other in blocked):
+            continue
+        blocked.append(bbox)
+        kept.append((score, bbox, v_idx))
+        if len(kept) >= max_matches:
+            break
+
+    # Polygon outline of each variant, computed once and shifted per match
+    outlines = {}
+    matches = []
+    for score, bbox, v_idx in kept:
+        if v_idx not in outlines:
+            outlines[v_idx] = mask_to_polygons(variants[v_idx][1], epsilon_ratio=0.005, min_area=1)
+        polygons_at = [(np.asarray(p) + [bbox[0], bbox[1]]).tolist() for p in outlines[v_idx]]
+        if polygons_at:
+            matches.append({"polygons": polygons_at, "score": round(score, 4), "bbox": list(bbox)})
+
+    return matches
+
+
+def add_template_matches(json_path, image_path, base_revision, mask_id, threshold=0.8,
+                         scales=DEFAULT_SCALES, rotations=DEFAULT_ROTATIONS, max_matches=500,
+                         base_analysis_id=None):
+    """
+    Find more instances of mask `mask_id` in the room's preprocessed image and
+    add them as new masks in its group (one logged edit). Returns
+    (revision, new_masks). Raises MaskEditConflict / MaskEditError.
+    """
+    if not 0 < threshold <= 1:
+        raise MaskEditError("threshold must be in (0, 1]")
+    if not 1 <= max_matches <= MAX_MATCHES_LIMIT:
+        raise MaskEditError(f"max_matches must be between 1 and {MAX_MATCHES_LIMIT}")
+
+    payload = get_room_masks(json_path)
+    check_base_revision(payload, base_revision, base_analysis_id)
+
+    masks_by_id = {m["id"]: m for m in payload["masks"]}
+    exemplar = masks_by_id.get(mask_id)
+    if exemplar is None or not exemplar.get("polygons"):
+        raise MaskEditError(f"Unknown mask {mask_id}")
+
+    image_gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image_gray is None:
+        raise MaskEditError("Room has no preprocessed image to search")
+
+    group_id = exemplar.get("group_id")
+    # Masks of every group (or none): a symbol SAM already found under
+    # another group must not come back as a duplicate mask
+    existing = [_polygons_bbox(m["polygons"]) for m in payload["masks"] if m.get("polygons")]
+
+    matches = find_template_matches(
+        image_gray, exemplar["polygons"], existing,
+        threshold=threshold, scales=scales, rotations=rotations, max_matches=max_matches
+    )
+    if not matches:
+        return base_revision, []
+
+    next_id = max(masks_by_id, default=-1) + 1
+    new_masks = []
+    for offset, match in enumerate(matches):
+        new_masks.append({
+            "id": next_id + offset,
+            "polygons": match["polygons"],
+            "group_id": group_id,
+            "source": "template_match",
+            "score": match["score"],
+        })
+
+    ops = [{"op": "add_mask", "mask": dict(m)} for m in new_masks]
+    revision = apply_room_mask_edits(json_path, base_revision, ops, base_analysis_id=base_analysis_id)
+    return revision, new_masks
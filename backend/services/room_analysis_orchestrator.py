@@ -1,25 +1,90 @@
 import os
 import cv2
-import pickle
-from pymongo import MongoClient
+import numpy as np
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from bson import ObjectId
 from pathlib import Path
-from config import MONGO_URI, MONGO_DB_NAME
+from db.mongo import get_sync_db
+from config import SAM_MAX_SIDE
 from services.project_service import LOCAL_FILE_DB
 
-from services.room_analysis.image_preprocessor import preprocess_floorplan_for_sam
+from services.room_analysis.image_preprocessor import preprocess_floorplan_cached, image_content_hash
 from services.room_analysis.mask_generator import MaskGenerator
-from services.room_analysis.grouping_engine import build_groups, save_groups_to_json
-from services.room_analysis.mask_and_group_combiner import combine_masks_and_groups
-from services.room_analysis.mask_drawer import draw_masks_on_image
+from services.room_analysis.feature_extractor import extract_features
+from services.room_analysis.grouping_engine import (
+    groups_from_components,
+    save_groups_to_json,
+    build_feature_table,
+    build_merge_tree,
+    cut_merge_tree,
+    save_merge_tree,
+    load_merge_tree,
+    MERGE_TREE_FILENAME,
+)
+from services.room_analysis.similarity_graph import SimilarityGraph, SIMILARITY_GRAPH_FILENAME, DEFAULT_TOLERANCES
+from services.room_analysis.mask_and_group_combiner import write_masks_polygons, build_masks_polygons, collect_mask_polygons
+from services.room_analysis.mask_drawer import draw_masks_on_image, build_label_map, label_map_from_polygons, write_label_map, LABEL_MAP_FILENAME
+from services.room_analysis.mask_store import write_mask_store, MaskStore, MASK_STORE_FILENAME
+from services.room_analysis.mask_edit_log import reset_room_mask_edits, replace_room_masks, compact_room_masks, get_room_masks
+from services.room_analysis.spatial_index import get_room_spatial_index
+from services.room_analysis.analysis_cache import (
+    analysis_params_key,
+    image_dhash,
+    find_by_source_hash,
+    find_by_dhash,
+    store_analysis_result,
+    restore_analysis_result,
+)
+from services import analysis_events, sam_prewarm
+
+# Artifacts are written off the pipeline thread; stages hand data over in memory
+_artifact_writer = ThreadPoolExecutor(max_workers=3, thread_name_prefix="room-artifacts")
+_debug_overlay_lock = threading.Lock()
+_label_map_lock = threading.Lock()
+_sam_generator = None
+_sam_generator_lock = threading.Lock()
+
+DEBUG_OVERLAY_FILENAME = "sam_output.png"
+
+
+def get_room_analysis_dir(project_id: str, room_id: str) -> str:
+    """Folder holding a room's analysis artifacts (masks, groups, polygons...)"""
+    return os.path.join(LOCAL_FILE_DB, f"project_{project_id}", "rooms", str(room_id), "analysis")
+
+
+def get_debug_overlay_path(project_id: str, room_id: str):
+    """
+    Return the path of the room's mask debug overlay, rendering and caching it
+    on first request (or when the masks are newer than the cached image).
+    Returns None if the room has no analysis artifacts yet.
+    """
+    room_output_dir = get_room_analysis_dir(project_id, room_id)
+    image_path = os.path.join(room_output_dir, "preprocessed.png")
+    masks_path = os.path.join(room_output_dir, MASK_STORE_FILENAME)
+    output_path = os.path.join(room_output_dir, DEBUG_OVERLAY_FILENAME)
+
+    if not os.path.exists(masks_path):
+        legacy_pkl = os.path.join(room_output_dir, "masks.pkl")
+        if not os.path.exists(legacy_pkl):
+            return None
+        masks_path = legacy_pkl
+
+    if not os.path.exists(image_path):
+        return None
+
+    with _debug_overlay_lock:
+        if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(masks_path):
+            draw_masks_on_image(image_path=image_path, masks_path=masks_path, output_path=output_path)
+
+    return output_path if os.path.exists(output_path) else None
 
 
 def update_room_analysis_status(room_id: str, status: str, progress: int, message: str = "", extra_fields: dict = None):
     """Utility to update the MongoDB room document with processing state"""
     try:
-        client = MongoClient(MONGO_URI)
-        db = client[MONGO_DB_NAME]
-        rooms_coll = db["rooms"]
+        rooms_coll = get_sync_db()["rooms"]
         update_doc = {
             "analysis_status": status,
             "analysis_progress": progress,
@@ -32,14 +97,319 @@ def update_room_analysis_status(room_id: str, status: str, progress: int, messag
             {"_id": ObjectId(room_id)},
             {"$set": update_doc}
         )
-        client.close()
     except Exception as e:
         print(f"[Orchestrator] Failed to update status for room {room_id}: {e}")
 
+    # Mirror every status change onto the room's live analysis stream
+    analysis_events.publish(room_id, "status", {
+        "status": status,
+        "progress": progress,
+        "message": message,
+        **(extra_fields or {})
+    })
+    if status in ("completed", "error"):
+        analysis_events.finish(room_id)
+
+
+def _write_preprocessed(path, image):
+    """Write preprocessed.png via a temporary file (it may be hard-linked into the analysis cache)."""
+    tmp_path = f"{path}.tmp.png"
+    if not cv2.imwrite(tmp_path, image):
+        raise IOError(f"Could not write {path}")
+    os.replace(tmp_path, path)
+
+
+def _write_room_label_map(masks, mask_ids, shape, path):
+    write_label_map(path, build_label_map(masks, shape, smallest_on_top=True, mask_ids=mask_ids))
+
+
+def get_room_label_map_path(project_id: str, room_id: str):
+    """
+    Path of the room's label map PNG. The one written by the analysis is
+    used as long as the masks are unedited; after edits it is re-rendered
+    from the current polygons. Returns None without analysis polygons.
+    """
+    room_output_dir = get_room_analysis_dir(project_id, room_id)
+    json_path = os.path.join(room_output_dir, "masks_polygons.json")
+    output_path = os.path.join(room_output_dir, LABEL_MAP_FILENAME)
+
+    compact_room_masks(json_path)
+    if not os.path.exists(json_path):
+        return None
+
+    with _label_map_lock:
+        if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(json_path):
+            payload = get_room_masks(json_path)
+            shape = (payload.get("image_height", 0), payload.get("image_width", 0))
+            write_label_map(output_path, label_map_from_polygons(payload["masks"], shape))
+
+    return output_path
+
+
+def get_room_label_map_url(project_id: str, room_id: str, version: str = None) -> str:
+    """API URL of the room's label map; `version` (see get_room_masks_version) makes it cacheable."""
+    url = f"/projects/{project_id}/rooms/{room_id}/label-map"
+    return f"{url}?rev={version}" if version else url
+
+
+def get_room_analysis_base_url(project_id: str, room_id: str) -> str:
+    return f"/local_file_db/project_{project_id}/rooms/{room_id}/analysis"
+
+
+def new_mask_generator() -> MaskGenerator:
+    """Generator configured for room analysis (model not loaded yet)."""
+    return MaskGenerator(max_side=SAM_MAX_SIDE or None)
+
+
+def load_sam_generator() -> MaskGenerator:
+    """The process-wide generator, loading the SAM model on first use."""
+    global _sam_generator
+    with _sam_generator_lock:
+        if _sam_generator is None:
+            # Initialize generator (assuming model downloaded in root or accessible path)
+            try:
+                generator = new_mask_generator()
+                generator.load_model()
+            except Exception as e:
+                raise RuntimeError(f"Failed to load SAM model. Ensure sam_vit_h_4b8939.pth exists. Error: {e}")
+            _sam_generator = generator
+        return _sam_generator
+
+
+def prewarm_sam_input(image_path: str):
+    """
+    Speculative half of an analysis: preprocess `image_path` (filling the
+    preprocessing cache) and compute its SAM embedding, unless the analysis
+    cache already holds a result for it. Returns True if the encoder ran.
+    """
+    source = _read_source(image_path)
+    generator = new_mask_generator()
+    if find_by_source_hash(analysis_params_key(generator.cache_params(do_merge=True)), source[1]):
+        return False
+
+    sam_input_rgb, _ = _load_preprocessed(image_path, source)
+    return load_sam_generator().prewarm_embedding(sam_input_rgb)
+
+
+def _read_source(image_path: str):
+    """Raw bytes of a source image plus their content hash."""
+    with open(image_path, "rb") as f:
+        data = f.read()
+    return data, image_content_hash(data)
+
+
+def _load_preprocessed(image_path: str, source=None):
+    """
+    Read a source image once, hash its bytes and return the (cached)
+    SAM-ready preprocessed RGB image plus its (height, width).
+    `source` may pass in an already read (bytes, hash) pair.
+    """
+    data, source_hash = source or _read_source(image_path)
+
+    img_bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img_bgr is None:
+        raise ValueError(f"Could not read image using OpenCV: {image_path}")
+
+    sam_input_rgb = preprocess_floorplan_cached(img_bgr, source_hash=source_hash)
+    return sam_input_rgb, sam_input_rgb.shape[:2]
+
+
+def _write_merge_tree(table, path, mask_ids=None, mask_count=None):
+    """Merge tree over the rows of `table`, which belong to masks `mask_ids` (default 0..n-1)."""
+    edges, weights = build_merge_tree(table)
+    if mask_ids is None:
+        save_merge_tree(path, len(table["area"]), edges, weights)
+        return
+    mask_ids = np.asarray(mask_ids, dtype=np.int64)
+    save_merge_tree(path, mask_count, mask_ids[edges].reshape(-1, 2), weights, mask_ids=mask_ids)
+
+
+def get_room_merge_tree(project_id: str, room_id: str):
+    """
+    The room's merge tree as (n, edges, weights, max_threshold, mask_ids), built from
+    the mask store and saved on first use for rooms analysed before it
+    existed. Returns None if the room has no masks yet.
+    """
+    room_output_dir = get_room_analysis_dir(project_id, room_id)
+    tree_path = os.path.join(room_output_dir, MERGE_TREE_FILENAME)
+    if not os.path.exists(tree_path):
+        masks_store_path = os.path.join(room_output_dir, MASK_STORE_FILENAME)
+        if not os.path.exists(masks_store_path):
+            return None
+        json_path = os.path.join(room_output_dir, "masks_polygons.json")
+        with MaskStore(masks_store_path) as store:
+            features = store.extract_features()
+            # Only the analysis masks that made it into masks_polygons.json
+            mask_ids = sorted(m["id"] for m in get_room_masks(json_path)["masks"] if m["id"] < len(features))
+            table = build_feature_table([features[idx] for idx in mask_ids])
+        _write_merge_tree(table, tree_path, mask_ids, len(features))
+    return load_merge_tree(tree_path)
+
+
+def cut_room_merge_tree(project_id: str, room_id: str, threshold: float):
+    """Groups (lists of mask ids) at grouping strictness `threshold`; 1.0 = default tolerances."""
+    tree = get_room_merge_tree(project_id, room_id)
+    if tree is None:
+        return None
+    n, edges, weights, max_threshold, mask_ids = tree
+    return cut_merge_tree(n, edges, weights, min(threshold, max_threshold), mask_ids)
+
+
+def finalize_room_masks(room_id: str, project_id: str, masks_data: list, image_shape, room_output_dir: str, on_artifacts_written=None):
+    """
+    Stages after SAM, shared by single-room and diagram-level analysis:
+    persist masks, group them, write polygons and mark the room completed.
+    `on_artifacts_written` runs once every artifact is on disk, before the
+    room is reported completed (and can be edited).
+    """
+    image_height, image_width = image_shape[:2]
+    masks_store_path = os.path.join(room_output_dir, MASK_STORE_FILENAME)
+    groups_json_path = os.path.join(room_output_dir, "groups.json")
+    masks_polygons_json_path = os.path.join(room_output_dir, "masks_polygons.json")
+
+    # Persist the mask store in the background while the remaining stages run
+    pending_writes = [
+        _artifact_writer.submit(write_mask_store, masks_store_path, masks_data, (image_height, image_width))
+    ]
+
+    # 4. Convert masks to polygons
+    update_room_analysis_status(room_id, "combining", 70, "Converting masks to lightweight polygons...")
+    # Edits logged against the previous analysis no longer apply
+    reset_room_mask_edits(masks_polygons_json_path)
+    # Polygons are pushed to clients chunk by chunk as they are produced; group
+    # membership follows in the "groups" event
+    mask_polygons = collect_mask_polygons(
+        masks_data,
+        epsilon_ratio=0.0001,
+        min_area=50,
+        on_chunk=lambda chunk: analysis_events.publish(room_id, "polygons", {"masks": [
+            {"id": idx, "polygons": polygons, "group_id": None} for idx, polygons in chunk
+        ]})
+    )
+    # Masks without polygons never reach masks_polygons.json, so grouping, the
+    # similarity graph, the merge tree and the label map all leave them out too
+    written_ids = sorted(mask_polygons)
+
+    # 5. Group Masks
+    update_room_analysis_status(room_id, "grouping", 85, "Clustering similar masks into groups...")
+    features = extract_features([masks_data[idx] for idx in written_ids])
 
-def run_room_analysis_pipeline(room_id: str, project_id: str, room_image_url: str):
+    # Build relational groups dictionary; the graph is kept so manual edits
+    # can be regrouped incrementally later
+    graph = SimilarityGraph.build(written_ids, features)
+    groups_dict = groups_from_components(list(graph.components().values()))
+    del features
+    pending_writes.append(_artifact_writer.submit(save_groups_to_json, groups_dict, groups_json_path))
+    pending_writes.append(_artifact_writer.submit(graph.save, os.path.join(room_output_dir, SIMILARITY_GRAPH_FILENAME)))
+    # Hierarchy for the grouping strictness slider, built off the pipeline thread
+    pending_writes.append(_artifact_writer.submit(
+        _write_merge_tree, graph.table, os.path.join(room_output_dir, MERGE_TREE_FILENAME), written_ids, len(masks_data)
+    ))
+
+    write_masks_polygons(
+        masks_data,
+        groups_dict,
+        image_width,
+        image_height,
+        masks_polygons_json_path,
+        mask_polygons=mask_polygons,
+        # Revisions restart at 0, so edits are also checked against this id
+        analysis_id=uuid.uuid4().hex
+    )
+    del mask_polygons
+    # Build the hit-test / viewport index now rather than on the editor's first query
+    pending_writes.append(_artifact_writer.submit(get_room_spatial_index, masks_polygons_json_path))
+    # Written after the polygons so it is never older than masks_polygons.json
+    pending_writes.append(_artifact_writer.submit(
+        _write_room_label_map, masks_data, written_ids, (image_height, image_width),
+        os.path.join(room_output_dir, LABEL_MAP_FILENAME)
+    ))
+    analysis_events.publish(room_id, "groups", {
+        "groups": groups_dict,
+        "image_width": image_width,
+        "image_height": image_height
+    })
+
+    # Wait for every artifact to land on disk before reporting completion
+    done, _ = wait(pending_writes)
+    for future in done:
+        future.result()
+
+    if on_artifacts_written is not None:
+        on_artifacts_written()
+
+    # 6. Finalize Payload and Update MongoDB
+    _mark_room_completed(room_id, project_id, "Room analysis successfully completed.")
+
+
+def _mark_room_completed(room_id: str, project_id: str, message: str):
+    base_url = get_room_analysis_base_url(project_id, room_id)
+    update_room_analysis_status(
+        room_id=room_id,
+        status="completed",
+        progress=100,
+        message=message,
+        extra_fields={
+            "masks_polygons_url": f"{base_url}/masks_polygons.json",
+            "masks_groups_url": f"{base_url}/groups.json",
+            "masks_store_url": f"{base_url}/{MASK_STORE_FILENAME}",
+            # Served through get_room_label_map_path so it follows manual edits
+            "masks_label_map_url": get_room_label_map_url(project_id, room_id)
+        }
+    )
+
+
+def _restore_cached_analysis(room_id: str, project_id: str, entry_dir: str, room_output_dir: str, how: str):
+    restore_analysis_result(entry_dir, room_output_dir)
+    # Edits, overlay and indexes of a previous analysis of this room no longer apply
+    reset_room_mask_edits(os.path.join(room_output_dir, "masks_polygons.json"))
+    overlay_path = os.path.join(room_output_dir, DEBUG_OVERLAY_FILENAME)
+    if os.path.exists(overlay_path):
+        os.remove(overlay_path)
+    _mark_room_completed(room_id, project_id, f"Room analysis reused from a previously analysed copy of this image ({how}).")
+    print(f"[Orchestrator] Reused cached analysis for room {room_id} ({how})")
+
+
+def regroup_room(project_id: str, room_id: str, tolerances: dict = None):
+    """
+    Re-run only grouping and polygon combination on the stored SAM masks
+    with the given similarity tolerances (defaults for any not given).
+    Replaces the room's groups and polygons as a new revision; manual edits
+    are discarded, as after a fresh analysis. Returns None if the room has
+    no mask store, else {"revision", "groups", "tolerances"}.
+    """
+    room_output_dir = get_room_analysis_dir(project_id, room_id)
+    masks_store_path = os.path.join(room_output_dir, MASK_STORE_FILENAME)
+    if not os.path.exists(masks_store_path):
+        return None
+
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+
+    with MaskStore(masks_store_path) as store:
+        image_height, image_width = store.image_shape
+        # Only masks that yield polygons are grouped, as in finalize_room_masks
+        mask_polygons = collect_mask_polygons(store, epsilon_ratio=0.0001, min_area=50)
+        mask_ids = sorted(mask_polygons)
+        features = store.extract_features()
+        graph = SimilarityGraph.build(mask_ids, [features[idx] for idx in mask_ids], tolerances)
+        del features
+        groups_dict = groups_from_components(list(graph.components().values()))
+        payload = build_masks_polygons(store, groups_dict, image_width, image_height, mask_polygons=mask_polygons)
+
+    save_groups_to_json(groups_dict, os.path.join(room_output_dir, "groups.json"))
+    graph.save(os.path.join(room_output_dir, SIMILARITY_GRAPH_FILENAME))
+    revision = replace_room_masks(
+        os.path.join(room_output_dir, "masks_polygons.json"), payload["groups"], payload["masks"]
+    )
+    print(f"[Orchestrator] Regrouped room {room_id}: {len(groups_dict)} groups ({tolerances})")
+    return {"revision": revision, "groups": groups_dict, "tolerances": tolerances}
+
+
+def run_room_analysis_pipeline(room_id: str, project_id: str, room_image_url: str, force: bool = False):
     """
     Background Task: Executes the full SAM mask generation and grouping pipeline.
+    Results for an image already analysed with the same model and parameters
+    are reused from the analysis cache unless `force` is set.
     """
     try:
         print(f"[Orchestrator] Starting analysis for room {room_id}")
@@ -54,85 +424,52 @@ def run_room_analysis_pipeline(room_id: str, project_id: str, room_image_url: st
             raise FileNotFoundError(f"Source image not found at {input_image_path}")
             
         # Create output directory for this room's analysis artifacts
-        room_output_dir = os.path.join(LOCAL_FILE_DB, f"project_{project_id}", "rooms", str(room_id), "analysis")
+        room_output_dir = get_room_analysis_dir(project_id, room_id)
         os.makedirs(room_output_dir, exist_ok=True)
         
-        # Define output artifact paths
         preprocessed_img_path = os.path.join(room_output_dir, "preprocessed.png")
-        masks_pkl_path = os.path.join(room_output_dir, "masks.pkl")
-        groups_json_path = os.path.join(room_output_dir, "groups.json")
-        masks_polygons_json_path = os.path.join(room_output_dir, "masks_polygons.json")
+        # This analysis does the speculative work for this image itself
+        sam_prewarm.cancel([input_image_path])
 
-        base_url = f"/local_file_db/project_{project_id}/rooms/{room_id}/analysis"
+        # 1.5. Identical image already analysed with the same model/parameters?
+        source = _read_source(input_image_path)
+        source_hash = source[1]
+        params_key = analysis_params_key(new_mask_generator().cache_params(do_merge=True))
+        if not force:
+            entry_dir = find_by_source_hash(params_key, source_hash)
+            if entry_dir:
+                _restore_cached_analysis(room_id, project_id, entry_dir, room_output_dir, "exact match")
+                return
 
-        # 2. Preprocess Image
+        # 2. Preprocess Image (cached by source image hash + parameters)
         update_room_analysis_status(room_id, "preprocessing", 10, "Preprocessing image for SAM...")
-        img_bgr = cv2.imread(input_image_path)
-        if img_bgr is None:
-            raise ValueError(f"Could not read image using OpenCV: {input_image_path}")
-            
-        # preprocess_floorplan_for_sam(
-        #     img_bgr=img_bgr,
-        #     save_output=True,
-        #     output_dir=room_output_dir,
-        #     output_name="preprocessed.png"
-        # )
+        sam_input_rgb, image_shape = _load_preprocessed(input_image_path, source)
+
+        # Re-cropped / re-encoded copies of a known plan: compare what SAM would see
+        dhash = image_dhash(sam_input_rgb)
+        if not force:
+            entry_dir = find_by_dhash(params_key, dhash, image_shape)
+            if entry_dir:
+                _restore_cached_analysis(room_id, project_id, entry_dir, room_output_dir, "perceptual match")
+                return
+
+        # Kept next to the other artifacts for the lazy debug overlay
+        pending_preprocessed = _artifact_writer.submit(_write_preprocessed, preprocessed_img_path, sam_input_rgb)
 
         # 3. Generate Masks (SAM)
         update_room_analysis_status(room_id, "generating_masks", 30, "Generating segmentation masks using SAM Model (This may take a while)...")
-        # Initialize generator (assuming model downloaded in root or accessible path)
-        try:
-            generator = MaskGenerator()
-            generator.load_model()
-        except Exception as e:
-            raise RuntimeError(f"Failed to load SAM model. Ensure sam_vit_h_4b8939.pth exists. Error: {e}")
-            
-        generator.process_image(
-            image_path=preprocessed_img_path,
-            output_pkl_path=masks_pkl_path,
-            do_merge=True
-        )
+        with sam_prewarm.foreground():
+            generator = load_sam_generator()
+            masks_data = generator.generate_masks(sam_input_rgb, do_merge=True)
 
-        # 3.5. [DEBUG] Draw Masks overlaid on preprocessed image
-        debug_output_path = os.path.join(room_output_dir, "sam_output.png")
-        update_room_analysis_status(room_id, "generating_masks", 65, "Drawing mask debug overlay...")
-        draw_masks_on_image(
-            image_path=preprocessed_img_path,
-            pkl_path=masks_pkl_path,
-            output_path=debug_output_path
-        )
+        # 3.5. [DEBUG] The mask overlay is rendered lazily by get_debug_overlay_path
+        # the first time someone asks for it, not on every analysis.
+        del sam_input_rgb
+        pending_preprocessed.result()
 
-        # 4. Group Masks
-        update_room_analysis_status(room_id, "grouping", 70, "Clustering similar masks into groups...")
-        with open(masks_pkl_path, "rb") as f:
-            masks_data = pickle.load(f)
-            
-        # Build relational groups dictionary
-        groups_dict = build_groups(masks_data)
-        save_groups_to_json(groups_dict, groups_json_path)
-
-        # 5. Combine Masks and Groups into Polygons
-        update_room_analysis_status(room_id, "combining", 85, "Converting masks to lightweight polygons...")
-        combine_masks_and_groups(
-            pkl_path=masks_pkl_path,
-            groups_path=groups_json_path,
-            image_path=preprocessed_img_path,
-            output_json_path=masks_polygons_json_path,
-            epsilon_ratio=0.0001,
-            min_area=50
-        )
-
-        # 6. Finalize Payload and Update MongoDB
-        update_room_analysis_status(
-            room_id=room_id,
-            status="completed",
-            progress=100,
-            message="Room analysis successfully completed.",
-            extra_fields={
-                "masks_polygons_url": f"{base_url}/masks_polygons.json",
-                "masks_groups_url": f"{base_url}/groups.json",
-                "masks_pkl_url": f"{base_url}/masks.pkl"
-            }
+        finalize_room_masks(
+            room_id, project_id, masks_data, image_shape, room_output_dir,
+            on_artifacts_written=lambda: store_analysis_result(params_key, source_hash, dhash, image_shape, room_output_dir, replace=force)
         )
         print(f"[Orchestrator] Successfully completed analysis for room {room_id}")
 
@@ -141,3 +478,108 @@ def run_room_analysis_pipeline(room_id: str, project_id: str, room_image_url: st
         traceback.print_exc()
         print(f"[Orchestrator] Error processing room {room_id}: {e}")
         update_room_analysis_status(room_id, "error", 0, f"Error: {str(e)}")
+
+
+def room_frame_from_polygon(polygon, diagram_shape):
+    """
+    Reproduce the crop used by /projects/{id}/rooms/extract for a room polygon
+    (normalised {x, y} points). Returns ((x, y, w, h), polygon mask of the crop).
+    """
+    h, w = diagram_shape[:2]
+    pts = np.array([[int(p["x"] * w), int(p["y"] * h)] for p in polygon], dtype=np.int32)
+
+    rx, ry, rbw, rbh = cv2.boundingRect(pts)
+    rx, ry = max(0, rx), max(0, ry)
+    rbw = max(min(rbw, w - rx), 0)
+    rbh = max(min(rbh, h - ry), 0)
+
+    room_mask = np.zeros((rbh, rbw), dtype=np.uint8)
+    cv2.fillPoly(room_mask, [pts - [rx, ry]], 1)
+    return (rx, ry, rbw, rbh), room_mask.astype(bool)
+
+
+def assign_masks_to_room(masks_data, room_rect, room_mask, min_overlap=0.5):
+    """
+    Clip diagram-level CompactMasks to one room. A mask belongs to the room
+    when at least `min_overlap` of its pixels fall inside the room polygon;
+    it is cut down to the room's frame and polygon.
+    """
+    rx, ry, rbw, rbh = room_rect
+    room_masks = []
+
+    for mask in masks_data:
+        if mask.x0 >= rx + rbw or mask.y0 >= ry + rbh or mask.x1 <= rx or mask.y1 <= ry:
+            continue
+
+        inside = mask.clipped(room_rect, room_mask)
+        if inside is None or inside.area < min_overlap * max(mask.area, 1):
+            continue
+        room_masks.append(inside)
+
+    return room_masks
+
+
+def run_diagram_analysis_pipeline(diagram_id: str, project_id: str, room_ids: list):
+    """
+    Background Task: one SAM pass over a whole diagram, shared by all of its rooms.
+    Masks are assigned to each room polygon by intersection and every room gets
+    the same artifacts as run_room_analysis_pipeline produces.
+    """
+    try:
+        print(f"[Orchestrator] Starting diagram analysis for {diagram_id} ({len(room_ids)} rooms)")
+        db = get_sync_db()
+        diagram = db["diagrams"].find_one({"_id": ObjectId(diagram_id)})
+        if not diagram:
+            raise ValueError(f"Diagram {diagram_id} not found")
+
+        rel_img_path = diagram.get("diagram_image_url", "").replace("/local_file_db/", "").lstrip("/")
+        diagram_image_path = os.path.join(LOCAL_FILE_DB, rel_img_path)
+        if not os.path.exists(diagram_image_path):
+            raise FileNotFoundError(f"Diagram image not found at {diagram_image_path}")
+        diagram_rgb, diagram_shape = _load_preprocessed(diagram_image_path)
+
+        for room_id in room_ids:
+            update_room_analysis_status(room_id, "generating_masks", 30, "Generating diagram-level masks using SAM Model (This may take a while)...")
+
+        with sam_prewarm.foreground(diagram_image_path):
+            generator = load_sam_generator()
+            masks_data = generator.generate_masks(diagram_rgb, do_merge=True)
+        print(f"[Orchestrator] Diagram {diagram_id}: {len(masks_data)} masks")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"[Orchestrator] Error processing diagram {diagram_id}: {e}")
+        for room_id in room_ids:
+            update_room_analysis_status(room_id, "error", 0, f"Error: {str(e)}")
+        return
+
+    # Every room was set to generating_masks above, so each one must end in
+    # completed or error here; otherwise the UI keeps polling it
+    for room_id in room_ids:
+        try:
+            room_doc = db["rooms"].find_one({"_id": ObjectId(room_id)})
+            if not room_doc:
+                raise ValueError("Room no longer exists")
+            polygon = room_doc.get("mask_array") or []
+            if not polygon:
+                raise ValueError("Room has no polygon (mask_array)")
+
+            room_rect, room_mask = room_frame_from_polygon(polygon, diagram_shape)
+            rx, ry, rbw, rbh = room_rect
+            if rbw <= 0 or rbh <= 0:
+                raise ValueError("Room polygon lies outside the diagram")
+
+            room_output_dir = get_room_analysis_dir(project_id, room_id)
+            os.makedirs(room_output_dir, exist_ok=True)
+            # The room's slice of the SAM input, used by overlays and later regrouping
+            _write_preprocessed(os.path.join(room_output_dir, "preprocessed.png"), diagram_rgb[ry:ry + rbh, rx:rx + rbw])
+
+            # A room no diagram mask falls in still completes, with empty artifacts
+            room_masks = assign_masks_to_room(masks_data, room_rect, room_mask)
+            finalize_room_masks(room_id, project_id, room_masks, (rbh, rbw), room_output_dir)
+            print(f"[Orchestrator] Room {room_id}: {len(room_masks)} masks from diagram {diagram_id}")
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"[Orchestrator] Error processing room {room_id}: {e}")
+            update_room_analysis_status(room_id, "error", 0, f"Error: {str(e)}")
@@ -0,0 +1,175 @@
+"""
+sam_prewarm.py
+──────────────
+Speculative, low-priority SAM pre-warming.
+
+Once diagrams are selected or rooms extracted we already know which images
+are likely to be analysed next. A single background thread preprocesses
+them and computes their SAM image embeddings (see
+services/room_analysis/embedding_cache.py), so Analyze can skip the encoder.
+
+The work is purely speculative and gives way to real work:
+  • nothing new starts while an analysis is running (see `foreground`) or
+    while the machine is loaded; queued images simply wait
+  • images are dropped when the queue overflows, when they wait too long,
+    when an analysis of the same image starts, or on `cancel`
+  • the encoder runs on a single torch thread, so it leaves the other cores
+    to request handling and anything else that starts meanwhile
+An embedding pass that has already started runs to completion; the
+encoder cannot be interrupted midway. If an analysis starts during one,
+torch gets its full thread count back for the analysis.
+
+Disabled with SAM_PREWARM=0.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import SAM_PREWARM
+
+# Pending images beyond this drop the oldest
+PREWARM_MAX_QUEUE = 32
+# Seconds a queued image stays worth pre-warming
+PREWARM_MAX_AGE = 15 * 60
+# 1-minute load average per CPU above which no speculative work starts
+PREWARM_MAX_LOAD = 0.75
+# Seconds between load checks while deferring
+PREWARM_RETRY_INTERVAL = 5.0
+
+_queue = OrderedDict()          # image path -> time queued
+_cond = threading.Condition()
+_active_analyses = 0
+_worker_running = False
+# torch thread count to restore after a throttled pass (None when not throttled)
+_saved_threads = None
+
+
+def schedule(image_paths):
+    """Queue images for speculative pre-warming (most recent last; duplicates move to the back)."""
+    global _worker_running
+    if not SAM_PREWARM:
+        return
+    with _cond:
+        now = time.monotonic()
+        for path in image_paths:
+            if not path or not os.path.exists(path):
+                continue
+            _queue.pop(path, None)
+            _queue[path] = now
+        while len(_queue) > PREWARM_MAX_QUEUE:
+            _queue.popitem(last=False)
+
+        if _queue and not _worker_running:
+            _worker_running = True
+            threading.Thread(target=_run, name="sam-prewarm", daemon=True).start()
+        _cond.notify_all()
+
+
+def cancel(image_paths=None):
+    """Drop queued images (all of them when `image_paths` is None)."""
+    with _cond:
+        if image_paths is None:
+            _queue.clear()
+        else:
+            for path in image_paths:
+                _queue.pop(path, None)
+
+
+def pending():
+    with _cond:
+        return list(_queue)
+
+
+@contextmanager
+def foreground(image_path=None):
+    """
+    Wrap real analysis work: speculative jobs are held back until it ends,
+    and `image_path` (which the analysis embeds itself) is dropped from the queue.
+    """
+    global _active_analyses
+    with _cond:
+        _active_analyses += 1
+        if image_path:
+            _queue.pop(image_path, None)
+        _restore_threads()
+    try:
+        yield
+    finally:
+        with _cond:
+            _active_analyses -= 1
+            _cond.notify_all()
+
+
+def _overloaded():
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):  # not available on every platform
+        return False
+    return load / (os.cpu_count() or 1) > PREWARM_MAX_LOAD
+
+
+def _throttle_threads():
+    global _saved_threads
+    import torch
+
+    with _cond:
+        if _saved_threads is None and not _active_analyses:
+            _saved_threads = torch.get_num_threads()
+            torch.set_num_threads(1)
+
+
+def _restore_threads():
+    """Undo _throttle_threads (call with _cond held)."""
+    global _saved_threads
+    if _saved_threads is not None:
+        import torch
+
+        torch.set_num_threads(_saved_threads)
+        _saved_threads = None
+
+
+def _next_job():
+    """
+    Block until a job may run and return its image path; returns None (and
+    marks the worker as stopped) once the queue is empty.
+    """
+    global _worker_running
+    with _cond:
+        while True:
+            now = time.monotonic()
+            while _queue:
+                path, queued_at = next(iter(_queue.items()))
+                if now - queued_at <= PREWARM_MAX_AGE:
+                    break
+                _queue.popitem(last=False)
+
+            if not _queue:
+                _worker_running = False
+                return None
+            if _active_analyses or _overloaded():
+                _cond.wait(PREWARM_RETRY_INTERVAL)
+                continue
+            return _queue.popitem(last=False)[0]
+
+
+def _run():
+    while True:
+        path = _next_job()
+        if path is None:
+            return
+        try:
+            # Imported here: the orchestrator itself uses `foreground`
+            from services.room_analysis_orchestrator import prewarm_sam_input
+
+            started = time.monotonic()
+            _throttle_threads()
+            if prewarm_sam_input(path):
+                print(f"[Prewarm] Cached SAM embedding for {path} in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            print(f"[Prewarm] Skipped {path}: {e}")
+        finally:
+            with _cond:
+                _restore_threads()